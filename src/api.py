@@ -0,0 +1,228 @@
+"""
+Versioned JSON view of State for clients other than the web UI, like a
+phone or a home automation poller. Served by the web UI next to its
+pages under /api/v1:
+
+    GET  /api/v1/slots, /media, /drivers, /operations, /mode
+    POST /api/v1/operations  [{"op": "change_slot", "slot": "Slot_2"}]
+    GET  /api/v1/events      server-sent events with every change
+
+Resources carry an ETag made from the State version counters, so
+polling with If-None-Match costs a 304 while nothing changed. Posted
+operations are only accepted as application/json, which browsers
+cannot send to another site without asking it first.
+"""
+
+import os
+import json
+import queue
+import threading
+from time import sleep
+from typing import Dict, Iterator, List
+from operations import ChangeSlot, CreateSlot, DeleteSlot, TransferFiles
+from utils.state import OperationBase, State
+from utils.progress import TransferProgress, forget_transfers
+from utils.resilience import circuit_breaker
+
+class ApiError(Exception):
+    pass
+
+def slots_view(state: State) -> Dict:
+    fs = state.read("filesystem")
+    slots = {slot_id: {"name": data.name, "description": data.description, "last_access": data.last_access} for slot_id, data in fs["slots"].items()}
+    return {"active_slot": fs["active_slot"], "slots": slots, "stale": bool(state.read("stale"))}
+
+def media_view(state: State) -> Dict:
+    fs = state.read("filesystem")
+    progress = state.read("transfers") or {}
+    files = {name: dict(progress.get(name, {}), game=data.game, size=data.size, modified=data.modified, complete=not data.is_active) for name, data in fs["media"].items()}
+    return {"files": files, "space": state.read("media_space")}
+
+def drivers_view(state: State) -> List[Dict]:
+    # remotes are known by their connection status, the drivers themselves hold credentials
+    status = state.read("driver_status") or {}
+    return [dict(data, destination=destination, available=not circuit_breaker(destination).is_open) for destination, data in status.items()]
+
+def operations_view(state: State) -> List[Dict]:
+    ops = state.read("operations")
+    return [{"type": name, "overview": op.overview, "priority": op.priority.name.lower()} for name, op in ops.items()]
+
+def mode_view(state: State) -> Dict:
+    mode = state.read("mode")
+    luns = state.read("lun_modes") or {}
+    return {
+        "mode": None if mode is None else mode.name.lower(),
+        "luns": {name: lun_mode.name.lower() for name, lun_mode in luns.items()},
+        "fs_active": bool(state.read("fs_active")),
+        "stale": bool(state.read("stale")),
+    }
+
+def operation_from_spec(state: State, spec: Dict) -> OperationBase:
+    "Operation described by a JSON object like {\"op\": \"change_slot\", \"slot\": \"Slot_2\"}"
+    op = spec.get("op")
+    if op == "change_slot":
+        return ChangeSlot(spec["slot"])
+    if op == "create_slot":
+        return CreateSlot(clone_active=spec.get("clone_active", False))
+    if op == "delete_slot":
+        return DeleteSlot(spec["slot"])
+    if op == "transfer":
+        media = {name: data for name, data in state.read("filesystem")["media"].items() if not data.is_active}
+        if "files" in spec:
+            unknown = set(spec["files"]) - set(media)
+            if unknown:
+                raise ApiError(f"No complete media file {', '.join(sorted(unknown))}")
+            media = {name: media[name] for name in spec["files"]}
+        drivers = state.read("drivers")
+        if not media or not drivers:
+            raise ApiError("Nothing to transfer or no remotes configured")
+        return TransferFiles(media, drivers, TransferProgress(state))
+    raise ApiError(f"Unknown operation \"{op}\"")
+
+# an op of the same type has to leave the queue before the next one, it would replace it otherwise
+_QUEUE_POLL = .1
+
+def parse_operations(state: State, specs: List[Dict]) -> List[OperationBase]:
+    "Operations in the order to queue them, slots are deleted from the last so the numbers stay valid"
+    try:
+        operations = [operation_from_spec(state, spec) for spec in specs]
+        deletes = sorted((op for op in operations if isinstance(op, DeleteSlot)), key=lambda op: -int(op.slot_id.split("_")[1]))
+    except (KeyError, AssertionError, TypeError, ValueError, AttributeError) as e:
+        raise ApiError(f"Invalid operation: {e!r}")
+    return [deletes.pop(0) if isinstance(op, DeleteSlot) else op for op in operations]
+
+def queue_operations(state: State, specs: List[Dict]) -> int:
+    """
+    Check the operations and queue them in the background, those of
+    the same type can take minutes to be picked up one after another
+    """
+    operations = parse_operations(state, specs)
+    threading.Thread(target=_queue_in_order, args=(state, operations), name="Queue operations", daemon=True).start()
+    return len(operations)
+
+def _queue_in_order(state: State, operations: List[OperationBase]):
+    for op in operations:
+        # transfers merge with the queued one instead of replacing it
+        while not isinstance(op, TransferFiles) and type(op).__name__ in state.read("operations"):
+            sleep(_QUEUE_POLL)
+        state.queue_operation(op)
+
+class Api():
+    """
+    Resources and their ETags, and the event streams. Upload progress is
+    streamed per file, everything else as the whole changed resource.
+    """
+    _state: State
+    _lock: threading.Lock
+    _streams: List[queue.Queue]
+    _sent: Dict[str, str]
+    _transfers: Dict[str, Dict]
+    _epoch: str
+
+    PREFIX = "/api/v1/"
+
+    # State fields each resource is made from
+    _RESOURCES = {
+        "slots": (slots_view, ("filesystem", "stale")),
+        "media": (media_view, ("filesystem", "transfers", "media_space")),
+        "drivers": (drivers_view, ("driver_status",)),
+        "operations": (operations_view, ("operations",)),
+        "mode": (mode_view, ("mode", "lun_modes", "fs_active", "stale")),
+    }
+
+    # comments keep proxies from closing quiet streams and notice clients gone
+    _KEEPALIVE = 15
+
+    def __init__(self, state: State) -> None:
+        self._state = state
+        self._lock = threading.Lock()
+        self._streams = []
+        self._sent = {}
+        self._transfers = {}
+        # versions start over with every restart, old ETags must not match new data
+        self._epoch = os.urandom(4).hex()
+
+        fields = {field for _, fields in self._RESOURCES.values() for field in fields}
+        for field in sorted(fields - {"transfers"}):
+            state.register(field, lambda value, field=field: self._on_change(field))
+        state.register("transfers", self._on_transfers_update)
+        state.register("filesystem", self._on_fs_update)
+
+    @property
+    def resources(self) -> List[str]:
+        return list(self._RESOURCES)
+
+    def etag(self, resource: str) -> str:
+        versions = [str(self._state.version(field)) for field in self._RESOURCES[resource][1]]
+        if resource == "drivers":
+            # remotes giving up and recovering are not written to State
+            versions += ["1" if d["available"] else "0" for d in drivers_view(self._state)]
+        return f"\"{resource}-{self._epoch}-{'.'.join(versions)}\""
+
+    @staticmethod
+    def etag_matches(if_none_match: str, etag: str) -> bool:
+        "Whether an If-None-Match header names the ETag, weak ones compared like strong ones"
+        for candidate in (c.strip() for c in if_none_match.split(",")):
+            if candidate.startswith("W/"):
+                candidate = candidate[2:]
+            if candidate == "*" or candidate == etag:
+                return True
+        return False
+
+    def get(self, resource: str):
+        "Current ETag and body of the resource, ApiError if there is no such resource"
+        if resource not in self._RESOURCES:
+            raise ApiError(f"Unknown resource \"{resource}\"")
+        return self.etag(resource), self._RESOURCES[resource][0](self._state)
+
+    def queue(self, specs: List[Dict]) -> int:
+        return queue_operations(self._state, specs)
+
+    def _push(self, event: str, data, id: str=None):
+        message = f"event: {event}\n" + (f"id: {id}\n" if id is not None else "") + f"data: {json.dumps(data)}\n\n"
+        for stream in self._streams:
+            stream.put(message)
+
+    def _on_change(self, field: str):
+        with self._lock:
+            if not self._streams:
+                return
+
+            for resource, (view, fields) in self._RESOURCES.items():
+                if field not in fields:
+                    continue
+                etag = self.etag(resource)
+                # several fields change at once, a resource goes out once
+                if self._sent.get(resource) != etag:
+                    self._sent[resource] = etag
+                    self._push(resource, view(self._state), etag)
+
+    def _on_fs_update(self, fs):
+        if fs is not None:
+            forget_transfers(self._state, fs["media"])
+
+    def _on_transfers_update(self, transfers: Dict[str, Dict]):
+        with self._lock:
+            changed = {name: progress for name, progress in transfers.items() if self._transfers.get(name) != progress}
+            self._transfers = transfers
+            for name, progress in changed.items():
+                self._push("progress", dict(progress, file=name))
+
+    def stream(self) -> Iterator[str]:
+        "Server-sent events, starting with every resource as it is now"
+        events = queue.Queue()
+        with self._lock:
+            for resource in self._RESOURCES:
+                etag, data = self.get(resource)
+                events.put(f"event: {resource}\nid: {etag}\ndata: {json.dumps(data)}\n\n")
+            self._streams.append(events)
+
+        try:
+            while True:
+                try:
+                    yield events.get(timeout=self._KEEPALIVE)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+        finally:
+            with self._lock:
+                self._streams.remove(events)
@@ -0,0 +1,289 @@
+import json
+import remi
+import threading
+import gui
+from os import path
+from contextlib import closing
+from typing import Tuple
+from operations import ChangeSlot, CreateSlot, DeleteSlot, EditSlot, RestoreSlot, TransferFiles
+from drivers import DriverBase, connect_in_background
+from api import Api, ApiError
+from utils.delta import DeltaStore, remote_versions
+from utils.state import State
+from utils.throttle import upload_limit, ui_activity, kib_to_rate
+from utils.progress import TransferProgress
+from utils import metrics
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+
+class _TrackedWebSocketsHandler(remi.server.WebSocketsHandler):
+    "Websocket messages are UI callbacks, so count them as UI activity"
+    def on_message(self, message):
+        with ui_activity:
+            super().on_message(message)
+
+class PSBerry(remi.App):
+    _state: State
+    _delta: DeltaStore
+    _slot_list: gui.SlotList
+    _slot_buttons: gui.SlotButtonsPanel
+    _media_list: gui.MediaList
+    _media_buttons: gui.MediaButtonsPanel
+    _spool_panel: gui.SpoolPanel
+
+    _CONTAINER_STYLE = {"margin": "0px auto", "max-width": "400px"}
+
+    def __init__(self, *args):
+        super(PSBerry, self).__init__(*args, static_file_path={"root": ROOT})
+
+    def do_GET(self):
+        if self.headers.get("Upgrade", "").lower() == "websocket":
+            # websocket lives for the whole session, only its messages are tracked
+            _TrackedWebSocketsHandler(self.headers, self.request, self.client_address, self.server)
+            return
+
+        if self.path == "/metrics":
+            self._serve_metrics()
+            return
+
+        if self.path.startswith(Api.PREFIX):
+            self._serve_api()
+            return
+
+        with ui_activity:
+            super().do_GET()
+
+    def do_POST(self):
+        if self.path.startswith(Api.PREFIX):
+            self._serve_api()
+            return
+
+        with ui_activity:
+            super().do_POST()
+
+    def _send_json(self, status: int, data, etag: str=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if etag is not None:
+            self.send_header("ETag", etag)
+            # always revalidated, which costs a 304 while unchanged
+            self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _serve_api(self):
+        # shared by all sessions, handed over like the state
+        api: Api = self.server.userdata[2]
+        resource = self.path[len(Api.PREFIX):].split("?")[0].strip("/")
+
+        if self.command == "POST":
+            if resource != "operations":
+                self._send_json(405, {"error": "Only operations can be posted"})
+                return
+            if self.headers.get_content_type() != "application/json":
+                # a form or text/plain post from another site would not need a CORS preflight
+                self._send_json(415, {"error": "Operations have to be posted as application/json"})
+                return
+            try:
+                specs = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                queued = api.queue(specs if isinstance(specs, list) else [specs])
+            except (ValueError, AttributeError, ApiError) as e:
+                self._send_json(400, {"error": str(e)})
+                return
+            self._send_json(202, {"queued": queued})
+            return
+
+        if resource == "events":
+            self._serve_events(api)
+            return
+
+        try:
+            etag, data = api.get(resource)
+        except ApiError as e:
+            self._send_json(404, {"error": str(e)})
+            return
+
+        if Api.etag_matches(self.headers.get("If-None-Match", ""), etag):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self._send_json(200, data, etag)
+
+    def _serve_events(self, api: Api):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        # the request thread belongs to this client until it goes away
+        with closing(api.stream()) as events:
+            try:
+                for event in events:
+                    self.wfile.write(event.encode())
+                    self.wfile.flush()
+            except OSError:
+                pass
+
+    def _serve_metrics(self):
+        body = metrics.REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", metrics.CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def main(self, state: State, delta: DeltaStore=None, api: Api=None):
+        self._state = state
+        self._delta = delta
+
+        container = remi.gui.VBox(width="100%", style=self._CONTAINER_STYLE)
+
+        mode_panel = gui.ModePanel()
+        fs_active_panel = gui.FilesystemActivePanel()
+        self._stale_panel = gui.StalePanel()
+        tab_box = gui.StaticTabBox(dict([self._save_manager(), self._media_uploader()]))
+
+        container.append(mode_panel)
+        container.append(fs_active_panel)
+        container.append(self._stale_panel)
+        container.append(tab_box)
+
+        self._register("mode", mode_panel.set_mode)
+        self._register("fs_active", fs_active_panel.set_fs_active)
+        self._register("filesystem", self._on_fs_update)
+        self._register("stale", self._on_stale_update)
+        self._register("operations", self._slot_list.on_operations_update)
+        self._register("operations", self._slot_buttons.on_operations_update)
+        self._register("spool", self._spool_panel.set_spool)
+
+        return container
+
+    def _save_manager(self) -> Tuple[str, remi.gui.Container]:
+        save_manager = remi.gui.VBox(width="100%")
+
+        self._slot_list = gui.SlotList(self._on_slot_edit, self._on_slot_select)
+        save_manager.append(self._slot_list)
+
+        self._slot_buttons = gui.SlotButtonsPanel(self._on_slot_create)
+        save_manager.append(self._slot_buttons)
+        save_manager.append(gui.SlotBackupPanel(self._save_backup_automation, self._state.options.backup_slots))
+
+        return "Save Manager", save_manager
+
+    def _media_uploader(self) -> Tuple[str, remi.gui.Container]:
+        media_uploader = remi.gui.VBox(width="100%")
+
+        self._media_list = gui.MediaList(self._on_media_upload, self._on_media_delete)
+        media_uploader.append(self._media_list)
+
+        self._spool_panel = gui.SpoolPanel()
+        media_uploader.append(self._spool_panel)
+
+        self._media_buttons = gui.MediaButtonsPanel(self._on_media_upload, self._on_remotes_edit, self._save_upload_automation, self._state.options.upload_automatically)
+        media_uploader.append(self._media_buttons)
+
+        return "Media Uploader", media_uploader
+
+    def _register(self, field: str, callback):
+        "Register for state change, but also trigger if already set"
+        self._state.register(field, callback)
+        callback(self._state.read(field))
+
+    def _on_fs_update(self, fs):
+        if fs is None:
+            return
+
+        self._slot_list.update_items(fs["slots"])
+        self._slot_list.set_active(fs["active_slot"])
+        # "Upload All" only takes files which fully arrived
+        self._state.write("media", {name: data for name, data in fs["media"].items() if not data.is_active})
+        # remembered files might be gone by now, nothing is uploaded before the storage was checked
+        self._media_list.update_items(fs["media"], arrivals=not self._state.read("stale"))
+
+    def _on_stale_update(self, stale: bool):
+        self._stale_panel.set_stale(stale)
+        if stale is False:
+            # an unchanged first scan does not update the filesystem, arrivals are due anyway
+            self._on_fs_update(self._state.read("filesystem"))
+
+    def _on_slot_edit(self, slot_id: str):
+        fs = self._state.read("filesystem")
+        dialog = gui.SlotEditDialog(slot_id, fs["slots"][slot_id], style=self._CONTAINER_STYLE)
+        dialog.confirm_dialog.do(self._edit_slot)
+        dialog.show(self)
+
+        drivers = self._state.read("drivers")
+        if self._delta is not None and drivers:
+            # versions are listed from the first remote, the one restored from, and asking it can take a while
+            list_versions = lambda: dialog.set_versions(remote_versions(drivers[0], self._delta, slot_id))
+            threading.Thread(target=list_versions, name=f"List backups of {slot_id}", daemon=True).start()
+
+    def _edit_slot(self, dialog: gui.SlotEditDialog):
+        version = dialog.get_restore_version()
+        if version is not None and not dialog.is_maked_for_deletion():
+            self._state.queue_operation(RestoreSlot(dialog.slot_id, version, self._state.read("drivers")[0], self._delta))
+            return
+
+        o = DeleteSlot(dialog.slot_id) if dialog.is_maked_for_deletion() else \
+            EditSlot(dialog.slot_id, dialog.get_name(), dialog.get_description())
+        self._state.queue_operation(o)
+
+    def _on_slot_select(self, slot_id: str):
+        self._state.queue_operation(ChangeSlot(slot_id))
+
+    def _on_slot_create(self, clone_active: bool):
+        self._state.queue_operation(CreateSlot(clone_active=clone_active))
+
+    def _on_media_upload(self, media_data=None, listener=None):
+        if media_data is None or listener is None:
+            # called manually with the "Upload All" button
+
+            media = self._state.read("media")
+            if media is None or self._media_list is None:
+                # TODO: log "nothing to upload"
+                return
+
+            media_data, listener = media, self._media_list
+
+        else:
+            # called automatically as files fully arrive
+
+            if not self._state.options.upload_automatically or self._state.read("spool") is not None:
+                # staging area takes care of uploading arriving files
+                return
+
+        drivers = self._state.read("drivers")
+        if not len(drivers):
+            return
+
+        if len(media_data):
+            self._state.queue_operation(TransferFiles(media_data, drivers, TransferProgress(self._state, listener)))
+        else:
+            self._state.cancel_operation(TransferFiles)
+
+    def _on_media_delete(self, filename: str):
+        # stops at the next chunk if uploading, the file is then removed without being uploaded
+        self._state.cancel_operation(TransferFiles, key=filename)
+
+    def _on_remotes_edit(self, button: remi.gui.Button=None):
+        config = [d.config for d in self._state.read("drivers")]
+        dialog = gui.ConfigureRemotesDialog(config, DriverBase.empty_driver, self._state.options.upload_limit, self._state.read("driver_status"), style=self._CONTAINER_STYLE)
+        dialog.confirm_dialog.do(self._save_remotes_configuration)
+        dialog.show(self)
+
+    def _save_remotes_configuration(self, dialog: gui.ConfigureRemotesDialog):
+        self._state.options.remotes = dialog.get_configs()
+        self._state.options.upload_limit = dialog.get_upload_limit()
+        upload_limit.set_rate(kib_to_rate(self._state.options.upload_limit))
+        drivers = DriverBase.from_configs(dialog.get_configs(), connect=False)
+        self._state.write("drivers", drivers)
+        connect_in_background(drivers, self._state)
+
+    def _save_upload_automation(self, check: bool):
+        self._state.options.upload_automatically = check
+
+    def _save_backup_automation(self, check: bool):
+        self._state.options.backup_slots = check
@@ -0,0 +1,173 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess as sp
+from time import perf_counter, time
+from statistics import mean
+from typing import Callable, Dict, List
+from operations import ChangeSlot, CreateSlot, DeleteSlot, EditSlot, NullListener, TransferFiles, UpdateAddress
+from drivers import DriverLocal
+from system import SystemMock
+from utils.state import State
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def generate_tree(mount_point: str, slots: int, games: int, clips: int, clip_size: int, save_size: int):
+    "Create a synthetic image layout with `slots` save slots and `games` * `clips` video clips"
+    ps4 = os.path.join(mount_point, "PS4")
+    os.makedirs(ps4, exist_ok=True)
+
+    for slot in range(1, slots + 1):
+        # Slot_1 is the active one
+        save_dir = os.path.join(ps4, "SAVEDATA" if slot == 1 else f"SAVEDATA.Slot_{slot}")
+        os.makedirs(save_dir, exist_ok=True)
+
+        with open(os.path.join(save_dir, "meta.txt"), "w") as f:
+            f.write(f"Slot {slot}\nSynthetic save slot number {slot}")
+
+        with open(os.path.join(save_dir, "sdimg_save"), "wb") as f:
+            f.write(os.urandom(save_size))
+
+    clips_dir = os.path.join(mount_point, "PS5", "CREATE", "Video Clips")
+    for game in range(games):
+        game_dir = os.path.join(clips_dir, f"Game {game}")
+        os.makedirs(game_dir, exist_ok=True)
+
+        for clip in range(clips):
+            with open(os.path.join(game_dir, f"Game {game}_{clip:05}.mp4"), "wb") as f:
+                f.write(os.urandom(clip_size))
+
+def measure(name: str, func: Callable, repeat: int, setup: Callable=None, **extra) -> Dict:
+    runs = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = perf_counter()
+        func()
+        runs.append(perf_counter() - start)
+
+    print(f"{name}: {mean(runs) * 1000:.2f}ms mean over {repeat} runs", file=sys.stderr, flush=True)
+    return dict({"name": name, "runs": repeat, "min": min(runs), "mean": mean(runs), "max": max(runs)}, **extra)
+
+def bench_scan(system: SystemMock, repeat: int) -> List[Dict]:
+    return [measure("scan.update_filesystem", lambda: system._update_filesystem(remount=False), repeat)]
+
+def bench_state(state: State, repeat: int) -> List[Dict]:
+    fs = state.read("filesystem")
+    changed = state.read("filesystem")
+    changed["active_slot"] = "changed"
+
+    return [
+        measure("state.read", lambda: state.read("filesystem"), repeat),
+        measure("state.write.unchanged", lambda: state.write("filesystem", fs), repeat),
+        measure("state.write.changed", lambda: state.write("filesystem", changed), repeat, setup=lambda: state.write("filesystem", fs)),
+    ]
+
+def bench_operations(mount_point: str, repeat: int, font: str) -> List[Dict]:
+    results = [
+        measure("operation.ChangeSlot", lambda: ChangeSlot("Slot_2").run(mount_point), repeat, setup=lambda: ChangeSlot("Slot_1").run(mount_point)),
+        measure("operation.EditSlot", lambda: EditSlot("Slot_2", "Edited", "Edited slot").run(mount_point), repeat),
+    ]
+
+    # every created slot is removed again, so the tree stays the same across runs
+    created = lambda: f"Slot_{len([d for d in os.listdir(os.path.join(mount_point, 'PS4')) if 'SAVEDATA' in d])}"
+    results.append(measure("operation.CreateSlot", lambda: CreateSlot(clone_active=True).run(mount_point), repeat))
+    results.append(measure("operation.DeleteSlot", lambda: DeleteSlot(created()).run(mount_point), repeat, setup=lambda: CreateSlot(clone_active=True).run(mount_point)))
+
+    for _ in range(repeat):
+        DeleteSlot(created()).run(mount_point)
+
+    try:
+        results.append(measure("operation.UpdateAddress", lambda: UpdateAddress("192.168.0.2", 80, font).run(mount_point), repeat))
+    except OSError as e:
+        print(f"Skipping UpdateAddress: {e}", file=sys.stderr)
+
+    return results
+
+def bench_transfer(system: SystemMock, state: State, destination: str) -> List[Dict]:
+    "Runs last, because it deletes every transferred clip from the tree"
+    system._update_filesystem(remount=False)
+    media = state.read("filesystem")["media"]
+    if not media:
+        return []
+
+    size = sum(data.size for data in media.values())
+    driver = DriverLocal({"folder": destination})
+    assert not driver.errors, driver.errors
+
+    follow_up = []
+    result = measure("operation.TransferFiles", lambda: follow_up.extend(TransferFiles(media, [driver], NullListener()).run(system._mount_point)), 1)
+    result["bytes"] = size
+    result["bytes_per_second"] = size / result["mean"]
+
+    return [result] + [measure(f"operation.{type(op).__name__}", lambda: op.run(system._mount_point), 1) for op in follow_up]
+
+def bench_gui(state: State, repeat: int) -> List[Dict]:
+    try:
+        import gui
+    except ImportError as e:
+        print(f"Skipping GUI benchmarks: {e}", file=sys.stderr)
+        return []
+
+    fs = state.read("filesystem")
+    slot_list = gui.SlotList(lambda slot_id: None, lambda slot_id: None)
+    media_list = gui.MediaList(lambda media_data=None, listener=None: None, lambda filename: None)
+
+    return [
+        measure("gui.SlotList.rebuild", lambda: slot_list._rebuild(fs["slots"]), repeat),
+        measure("gui.SlotList.update_items", lambda: slot_list.update_items(fs["slots"]), repeat),
+        measure("gui.MediaList.rebuild", lambda: media_list._rebuild(fs["media"]), repeat),
+        measure("gui.MediaList.update_items", lambda: media_list.update_items(fs["media"]), repeat),
+    ]
+
+def get_commit() -> str:
+    result = sp.run(["git", "-C", ROOT, "rev-parse", "HEAD"], capture_output=True, text=True)
+    return result.stdout.strip() if result.returncode == 0 else ""
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Benchmark PSBerry hot paths against a synthetic image.")
+    parser.add_argument("--slots", default=20, type=int, help="Number of save slots to generate.")
+    parser.add_argument("--games", default=10, type=int, help="Number of games with video clips to generate.")
+    parser.add_argument("--clips", default=10, type=int, help="Number of video clips per game.")
+    parser.add_argument("--clip-size", default=256 * 1024, type=int, help="Size of a single video clip in bytes.")
+    parser.add_argument("--save-size", default=64 * 1024, type=int, help="Size of a single save slot in bytes.")
+    parser.add_argument("--repeat", "-r", default=10, type=int, help="Number of runs for each benchmark.")
+    parser.add_argument("--font", default="DejaVuSansMono.ttf", help="Font used by UpdateAddress.")
+    parser.add_argument("--output", "-o", default=None, type=argparse.FileType("w"), help="Write JSON results here instead of stdout.")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    workdir = tempfile.mkdtemp(prefix="psberry-bench-")
+
+    try:
+        mount_point = os.path.join(workdir, "mount")
+        destination = os.path.join(workdir, "remote")
+        os.makedirs(destination)
+        generate_tree(mount_point, args.slots, args.games, args.clips, args.clip_size, args.save_size)
+
+        state = State(workdir)
+        system = SystemMock(state, os.path.join(workdir, "storage.bin"), mount_point, 8080, args.font)
+
+        results = []
+        results += bench_scan(system, args.repeat)
+        results += bench_state(state, args.repeat)
+        results += bench_gui(state, args.repeat)
+        results += bench_operations(mount_point, args.repeat, args.font)
+        results += bench_transfer(system, state, destination)
+
+        report = {
+            "commit": get_commit(),
+            "timestamp": time(),
+            "parameters": {k: v for k, v in vars(args).items() if k != "output"},
+            "results": results,
+        }
+        json.dump(report, args.output or sys.stdout, indent=2)
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+"""
+Local control socket of a headless PSBerry, for scripts instead of the
+web UI. Like the privileged helper it speaks one JSON object per line
+in each direction:
+
+    {"cmd": "queue", "ops": [{"op": "create_slot", "clone_active": true}, {"op": "transfer"}]}
+    {"ok": true, "result": 2}
+
+"watch" keeps the connection open and sends one event per line until
+the client hangs up:
+
+    {"event": "progress", "file": "...", "size": 1048576, "done": 524288, "action": ""}
+"""
+
+import os
+import sys
+import json
+import queue
+import signal
+import socket
+import argparse
+import threading
+from typing import Dict, Iterator, List, Set
+from api import media_view, queue_operations, slots_view
+from operations import TransferFiles
+from utils.state import State
+from utils.progress import TransferProgress, forget_transfers
+
+class ControlError(Exception):
+    pass
+
+class ControlServer():
+    """
+    Server side, runs in the PSBerry process instead of the web UI. It
+    also stands in for the media list: arriving files are uploaded
+    automatically and upload progress goes out to the watchers.
+    """
+    _state: State
+    _socket_path: str
+    _lock: threading.Lock
+    _watchers: List[queue.Queue]
+    _completed: Set[str]
+    _transfers: Dict[str, Dict]
+    _published: Dict
+
+    _WATCHED = ("mode", "operations", "stale")
+
+    def __init__(self, state: State, socket_path: str) -> None:
+        self._state = state
+        self._socket_path = str(socket_path)
+        self._lock = threading.Lock()
+        self._watchers = []
+        self._completed = set()
+        self._transfers = {}
+        self._published = {}
+
+        for field in self._WATCHED:
+            state.register(field, lambda value, field=field: self._publish(field, value))
+        state.register("filesystem", self._on_fs_update)
+        state.register("stale", self._on_stale_update)
+        state.register("transfers", self._on_transfers_update)
+
+    def _publish(self, event: str, value):
+        if event == "mode":
+            value = str(value)
+        elif event == "operations":
+            value = [op.overview for op in value.values()]
+
+        with self._lock:
+            # the queue is written on every pop, even when nothing visible changed
+            if self._published.get(event) == value:
+                return
+            self._published[event] = value
+            for watcher in self._watchers:
+                watcher.put({"event": event, "value": value})
+
+    def _on_fs_update(self, fs):
+        if fs is None or self._state.read("stale"):
+            # remembered files might be gone by now, nothing is uploaded before the storage was checked
+            return
+
+        # upload each file once as it completes, like the media list does
+        with self._lock:
+            completed = {name for name, data in fs["media"].items() if not data.is_active}
+            arrived = {name: fs["media"][name] for name in completed - self._completed}
+            self._completed = completed
+        forget_transfers(self._state, fs["media"])
+
+        if not arrived or not self._state.options.upload_automatically or self._state.read("spool") is not None:
+            # staging area takes care of uploading arriving files
+            return
+
+        drivers = self._state.read("drivers")
+        if len(drivers):
+            self._state.queue_operation(TransferFiles(arrived, drivers, TransferProgress(self._state)))
+
+    def _on_stale_update(self, stale: bool):
+        if stale is False:
+            # an unchanged first scan does not update the filesystem, arrivals are due anyway
+            self._on_fs_update(self._state.read("filesystem"))
+
+    def _on_transfers_update(self, transfers: Dict[str, Dict]):
+        with self._lock:
+            changed = {name: progress for name, progress in transfers.items() if self._transfers.get(name) != progress}
+            self._transfers = transfers
+            for name, progress in changed.items():
+                for watcher in self._watchers:
+                    watcher.put(dict(progress, event="progress", file=name))
+
+    def slots(self) -> Dict:
+        return slots_view(self._state)
+
+    def media(self) -> Dict:
+        return media_view(self._state)
+
+    def queue(self, ops: List[Dict]) -> int:
+        return queue_operations(self._state, ops)
+
+    def _dispatch(self, request: Dict):
+        cmd = request.pop("cmd")
+        if cmd == "ping":
+            return "pong"
+        if cmd not in ("slots", "media", "queue"):
+            raise ControlError(f"Unknown command \"{cmd}\"")
+        return getattr(self, cmd)(**request)
+
+    def _watch(self, stream):
+        watcher = queue.Queue()
+        with self._lock:
+            self._watchers.append(watcher)
+
+        try:
+            stream.write(b"{\"ok\": true, \"result\": null}\n")
+            stream.flush()
+            while True:
+                stream.write(json.dumps(watcher.get()).encode() + b"\n")
+                stream.flush()
+        except OSError:
+            pass # client went away
+        finally:
+            with self._lock:
+                self._watchers.remove(watcher)
+
+    def _handle(self, conn: socket.socket):
+        with conn, conn.makefile("rwb") as stream:
+            for line in stream:
+                try:
+                    request = json.loads(line)
+                    if request.get("cmd") == "watch":
+                        self._watch(stream)
+                        return
+                    response = {"ok": True, "result": self._dispatch(request)}
+                except Exception as e:
+                    response = {"ok": False, "error": str(e)}
+
+                stream.write(json.dumps(response).encode() + b"\n")
+                stream.flush()
+
+    def serve(self):
+        "Blocks until interrupted or terminated"
+        def terminate(signum, frame):
+            raise KeyboardInterrupt
+        signal.signal(signal.SIGTERM, terminate)
+
+        if os.path.exists(self._socket_path):
+            os.remove(self._socket_path)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self._socket_path)
+        os.chmod(self._socket_path, 0o600)
+        server.listen()
+        print("#" * 3, f"Listening for control commands on {self._socket_path}", flush=True)
+
+        try:
+            while True:
+                conn, _ = server.accept()
+                threading.Thread(target=self._handle, args=(conn,), name="Control client", daemon=True).start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            os.remove(self._socket_path)
+
+class ControlClient():
+    "Client side, one connection per command"
+    _socket_path: str
+
+    def __init__(self, socket_path: str) -> None:
+        self._socket_path = socket_path
+
+    def _send(self, cmd: str, **args):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(self._socket_path)
+        stream = conn.makefile("rwb")
+        stream.write(json.dumps(dict(args, cmd=cmd)).encode() + b"\n")
+        stream.flush()
+
+        line = stream.readline()
+        if not line:
+            raise ControlError("PSBerry closed the connection")
+        response = json.loads(line)
+        if not response["ok"]:
+            raise ControlError(response["error"])
+        return conn, stream, response["result"]
+
+    def call(self, cmd: str, **args):
+        conn, stream, result = self._send(cmd, **args)
+        with conn, stream:
+            return result
+
+    def watch(self) -> Iterator[Dict]:
+        conn, stream, _ = self._send("watch")
+        with conn, stream:
+            for line in stream:
+                yield json.loads(line)
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Control a headless PSBerry.")
+    parser.add_argument("--socket", default="/tmp/psberry-control.sock", help="Control socket of the running PSBerry.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("slots", help="List save slots.")
+    commands.add_parser("media", help="List media files and their upload progress.")
+    commands.add_parser("watch", help="Stream mode, queue and upload progress changes as JSON lines.")
+
+    change = commands.add_parser("change", help="Switch to a save slot.")
+    change.add_argument("slot", help="Slot to switch to, like Slot_2.")
+    create = commands.add_parser("create", help="Create save slots.")
+    create.add_argument("--count", "-n", default=1, type=int, help="Number of slots to create.")
+    create.add_argument("--clone", default=False, action=argparse.BooleanOptionalAction, help="Clone the active slot instead of creating empty ones.")
+    delete = commands.add_parser("delete", help="Delete save slots.")
+    delete.add_argument("slots", nargs="+", help="Slots to delete, like Slot_3.")
+    upload = commands.add_parser("upload", help="Upload media files to the remotes.")
+    upload.add_argument("files", nargs="*", help="Files to upload, all complete ones if none are given.")
+    batch = commands.add_parser("queue", help="Queue a JSON list of operations, like [{\"op\": \"change_slot\", \"slot\": \"Slot_2\"}].")
+    batch.add_argument("file", type=argparse.FileType("r"), help="JSON file with the operations, - for stdin.")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    client = ControlClient(args.socket)
+
+    if args.command == "watch":
+        try:
+            for event in client.watch():
+                print(json.dumps(event), flush=True)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.command in ("slots", "media"):
+        result = client.call(args.command)
+    else:
+        if args.command == "change":
+            ops = [{"op": "change_slot", "slot": args.slot}]
+        elif args.command == "create":
+            ops = [{"op": "create_slot", "clone_active": args.clone}] * args.count
+        elif args.command == "delete":
+            ops = [{"op": "delete_slot", "slot": slot} for slot in args.slots]
+        elif args.command == "upload":
+            ops = [{"op": "transfer", "files": args.files} if args.files else {"op": "transfer"}]
+        else:
+            ops = json.load(args.file)
+        result = client.call("queue", ops=ops)
+
+    print(json.dumps(result, indent=2))
+
+if __name__ == "__main__":
+    try:
+        main()
+    except (OSError, ControlError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
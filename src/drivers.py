@@ -1,35 +1,106 @@
 import os
 import re
+import base64
 import hashlib
-from typing import Dict, List, Tuple
-import smbclient as smb
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, perf_counter_ns
+from urllib.parse import urlsplit, quote
+from typing import Dict, Iterator, List, Tuple
+from utils.throttle import upload_limit, ui_activity, remote_limit, kib_to_rate
+from utils.metrics import REGISTRY
+from utils.trace import TRACER
+from utils.scheduling import CancelToken, Cancelled, Preempted
+from utils.resilience import RetryPolicy, SourceGone, circuit_breaker
 
 _EMPTY_DRIVER = "None (removes driver)"
 
+_UPLOAD = REGISTRY.histogram("psberry_upload_seconds", "Duration of uploading a single file.", ["remote"], (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600))
+_UPLOADS = REGISTRY.counter("psberry_uploads_total", "Number of files uploaded.", ["remote", "result"])
+_UPLOAD_BYTES = REGISTRY.counter("psberry_upload_bytes_total", "Bytes of successfully uploaded files.", ["remote"])
+_UPLOAD_RATE = REGISTRY.gauge("psberry_upload_bytes_per_second", "Throughput of the last file uploaded.", ["remote"])
+
+def _effective_name(filename: str) -> str:
+    return re.sub(r"[^\w\-_\. ]", "_", filename)
+
+def _positive_int(value, default: int) -> int:
+    "Whole number from UI or config, the default on empty or invalid input"
+    try:
+        return max(int(float(value)), 1)
+    except (TypeError, ValueError):
+        return default
+
+def _ranges(size: int, range_size: int) -> List[Tuple[int, int]]:
+    return [(offset, min(range_size, size - offset)) for offset in range(0, size, range_size)]
+
+def _combined_digest(digests: List[str]) -> str:
+    "Hash list of the ranges in file order, equal only if every range is"
+    return hashlib.md5("".join(digests).encode()).hexdigest()
+
 class DriverBase():
     _config: Dict
     _errors: List[str]
+    _valid: bool
+    _connected: bool
+    _rate: int
+    _batch_start: int
+    _batch_bytes: int
+    _ui_bytes: int
+    _ui_wait_left: float
 
     empty_driver = _EMPTY_DRIVER
     description = "No driver implementation provided."
     fields = []
     required_fields = []
 
+    _TRACE_BATCH = 1024 * 1024
+
+    # the web UI is given room once per this many bytes, and for this long at most per file
+    _UI_CHECK_BYTES = 1024 * 1024
+    _UI_WAIT_PER_FILE = 10
+
+    # how failed uploads are attempted again, tuned to the transport
+    retry = RetryPolicy()
+
+    # appended to the fields of every real driver
+    shaping_fields = [
+        ("upload_limit", "number"), # KiB/s, empty or 0 for unlimited
+    ]
+
     def __init__(self, config: Dict) -> None:
         self._config = dict(config, **{"__description__": self.description})
         self._errors = []
+        self._rate = kib_to_rate(config.get("upload_limit"))
+
+        self._connected = False
 
         for field in self.required_fields:
             if field not in config or not config[field]:
                 self._errors.append(f"Missing field \"{field}\".")
 
-        if not self._errors:
-            self._errors.extend(self._connect())
+        self._valid = not self._errors
 
     @property
     def errors(self) -> List[str]:
         return self._errors
 
+    @property
+    def connected(self) -> bool:
+        return self._connected
+
+    def connect(self) -> bool:
+        """
+        Connect and test the remote, which can block for a whole network
+        timeout. Called on first upload if nobody did it before.
+        """
+        if not self._valid:
+            return False
+
+        self._errors = self._connect()
+        self._connected = not self._errors
+        return self._connected
+
     def _connect(self) -> List[str]:
         """
         Individual drivers attempt connecting and testing here,
@@ -46,15 +117,176 @@ class DriverBase():
         """
         return "No driver implementation provided."
 
-    def upload(self, source: str, filename: str, listener) -> bool:
-        return False if self._errors else self._upload(source, filename, listener)
+    @property
+    def available(self) -> bool:
+        "False while the remote failed too often and is waiting to recover"
+        return circuit_breaker(self.destination).allow()
+
+    def _transient_errors(self) -> Tuple:
+        "Errors worth another attempt, like a dropped connection"
+        return (OSError, http.client.HTTPException)
+
+    def _probe(self) -> bool:
+        return not self._connect()
+
+    def upload(self, source: str, filename: str, listener, token: CancelToken=None) -> bool:
+        """
+        Upload the file, checking the token between chunks. Raises
+        Cancelled or Preempted when the upload was stopped by it.
+        Failed attempts are retried, and remotes failing over and over
+        are skipped until they recover. Raises SourceGone when the file
+        was deleted meanwhile.
+        """
+        token = token or CancelToken()
+        if not os.path.isfile(source):
+            raise SourceGone(source)
+
+        breaker = circuit_breaker(self.destination)
+        if not breaker.allow():
+            _UPLOADS.inc(remote=self.destination, result="skipped")
+            return False
 
-    def _upload(self, source: str, filename: str, listener):
+        for attempt, delay in enumerate(self.retry.delays()):
+            if attempt:
+                listener.set_media_action(filename, f"Retrying {self.destination} in {delay:.0f}s...")
+                token.wait(delay, filename)
+
+            # an unreachable remote costs a whole network timeout, not worth retrying right away
+            if not self._connected and not self.connect():
+                break
+
+            if self._upload_attempt(source, filename, listener, token):
+                breaker.record_success()
+                return True
+
+        breaker.record_failure(self._probe)
+        return False
+
+    def _upload_attempt(self, source: str, filename: str, listener, token: CancelToken) -> bool:
+        self._batch_start, self._batch_bytes = perf_counter_ns(), 0
+        self._ui_bytes, self._ui_wait_left = 0, self._UI_WAIT_PER_FILE
+        try:
+            with _UPLOAD.time(remote=self.destination) as timer, TRACER.span("upload", "driver", remote=self.destination, file=filename):
+                success = self._upload(source, filename, listener, token)
+        except (Cancelled, Preempted):
+            _UPLOADS.inc(remote=self.destination, result="interrupted")
+            raise
+        except self._transient_errors() as e:
+            if not os.path.isfile(source):
+                # deleted by the console or already staged, the remote did nothing wrong
+                _UPLOADS.inc(remote=self.destination, result="gone")
+                raise SourceGone(source) from e
+            print("#" * 3, f"Uploading {filename} to {self.destination} failed: {e}", flush=True)
+            # connection might be gone, connect again before the next attempt
+            self._connected = False
+            success = False
+
+        _UPLOADS.inc(remote=self.destination, result="success" if success else "failure")
+        if success:
+            size = os.stat(source).st_size
+            _UPLOAD_BYTES.inc(size, remote=self.destination)
+            _UPLOAD_RATE.set(size / max(timer.elapsed, 1e-6), remote=self.destination)
+        return success
+
+    def _upload(self, source: str, filename: str, listener, token: CancelToken):
         """
         Individual drivers upload file from source to {remote}/filename here.
         """
         return False
 
+    def upload_stream(self, chunks: Iterator[bytes], filename: str, token: CancelToken=None) -> bool:
+        """
+        Upload data produced on the fly, like an archive, without a
+        source file. The size is only known once the stream ends.
+        """
+        breaker = circuit_breaker(self.destination)
+        if not breaker.allow():
+            _UPLOADS.inc(remote=self.destination, result="skipped")
+            return False
+
+        if not self._connected and not self.connect():
+            breaker.record_failure(self._probe)
+            return False
+
+        size = 0
+
+        def counted():
+            nonlocal size
+            for chunk in chunks:
+                if token is not None:
+                    token.check(filename)
+                size += len(chunk)
+                yield chunk
+
+        self._batch_start, self._batch_bytes = perf_counter_ns(), 0
+        self._ui_bytes, self._ui_wait_left = 0, self._UI_WAIT_PER_FILE
+        try:
+            with _UPLOAD.time(remote=self.destination) as timer, TRACER.span("upload_stream", "driver", remote=self.destination, file=filename):
+                success = self._upload_stream(counted(), filename)
+        except (Cancelled, Preempted):
+            _UPLOADS.inc(remote=self.destination, result="interrupted")
+            raise
+        except self._transient_errors() as e:
+            # a stream cannot be replayed, only the breaker learns about it
+            print("#" * 3, f"Uploading {filename} to {self.destination} failed: {e}", flush=True)
+            self._connected = False
+            success = False
+
+        if success:
+            breaker.record_success()
+        else:
+            breaker.record_failure(self._probe)
+
+        _UPLOADS.inc(remote=self.destination, result="success" if success else "failure")
+        if success:
+            _UPLOAD_BYTES.inc(size, remote=self.destination)
+            _UPLOAD_RATE.set(size / max(timer.elapsed, 1e-6), remote=self.destination)
+        return success
+
+    def _upload_stream(self, chunks: Iterator[bytes], filename: str) -> bool:
+        """
+        Individual drivers upload the chunks in order to {remote}/filename here.
+        """
+        return False
+
+    def download(self, filename: str) -> bytes:
+        "Fetch a small file previously uploaded, like backup chunks and manifests"
+        if not self._connected and not self.connect():
+            raise IOError(f"Cannot connect to {self.destination}: {' '.join(self._errors)}")
+
+        with TRACER.span("download", "driver", remote=self.destination, file=filename):
+            return self._download(filename)
+
+    def _download(self, filename: str) -> bytes:
+        """
+        Individual drivers return the contents of {remote}/filename here,
+        raising IOError if it cannot be read, with ENOENT if it does not
+        exist.
+        """
+        raise IOError("No driver implementation provided.")
+
+    def _throttle(self, amount: int):
+        """
+        Individual drivers call this for every chunk sent, which applies
+        this remote's limit, the global limit and backs off for web UI.
+        """
+        # chunks are small, waiting for the UI on every one of them would stall the upload
+        self._ui_bytes += amount
+        if self._ui_bytes >= self._UI_CHECK_BYTES and self._ui_wait_left > 0:
+            self._ui_bytes = 0
+            start = monotonic()
+            ui_activity.wait_until_idle(min(self._ui_wait_left, 2.0))
+            self._ui_wait_left -= monotonic() - start
+        remote_limit(self.destination, self._rate).consume(amount)
+        upload_limit.consume(amount)
+
+        if TRACER.enabled:
+            self._batch_bytes += amount
+            if self._batch_bytes >= self._TRACE_BATCH:
+                now = perf_counter_ns()
+                TRACER.complete("upload_batch", "driver", self._batch_start, now - self._batch_start, {"bytes": self._batch_bytes})
+                self._batch_start, self._batch_bytes = now, 0
+
     @property
     def config(self):
         return self._config
@@ -67,7 +299,7 @@ class DriverBase():
     def get_fields(cls, description: str) -> List[Tuple[str, str]]:
         for c in cls.__subclasses__():
             if c.description == description:
-                return c.fields
+                return c.fields + cls.shaping_fields if c.fields else c.fields
         assert False, f"Invalid description: \"{description}\"."
 
     @classmethod
@@ -82,9 +314,34 @@ class DriverBase():
         assert False, f"Invalid description: \"{description}\"."
 
     @classmethod
-    def from_configs(cls, configs: List[Dict]) -> List["DriverBase"]:
+    def from_configs(cls, configs: List[Dict], connect: bool=True) -> List["DriverBase"]:
         drivers = [cls.from_description(c["__description__"], c) for c in configs]
-        return [d for d in drivers if d is not None]
+        drivers = [d for d in drivers if d is not None]
+
+        if connect:
+            for driver in drivers:
+                driver.connect()
+
+        return drivers
+
+
+def connect_in_background(drivers: List[DriverBase], state):
+    """
+    Connect every driver on its own thread, so an unreachable remote does
+    not hold up anything else. Progress is published as "driver_status".
+    """
+    lock = threading.Lock()
+    status = {d.destination: {"connected": False, "errors": [], "pending": True} for d in drivers}
+    state.write("driver_status", dict(status))
+
+    def connect(driver: DriverBase):
+        driver.connect()
+        with lock:
+            status[driver.destination] = {"connected": driver.connected, "errors": driver.errors, "pending": False}
+            state.write("driver_status", dict(status))
+
+    for driver in drivers:
+        threading.Thread(target=connect, args=(driver,), name=f"Connect {driver.destination}", daemon=True).start()
 
 
 class DriverRemover(DriverBase):
@@ -94,6 +351,8 @@ class DriverRemover(DriverBase):
 class DriverSMB(DriverBase):
     _remote_root: str
     _chunk_size: int
+    _streams: int
+    _range_size: int
 
     description = "SMB/Samba server"
     fields = [
@@ -101,16 +360,32 @@ class DriverSMB(DriverBase):
         ("folder", "text"),
         ("username", "text"),
         ("password", "password"),
+        ("parallel_streams", "number"), # empty for 4
+        ("range_size", "number"), # MiB, empty for 64
     ]
     required_fields = ["remote", "folder"]
 
+    # NAS boxes over Wi-Fi drop out for a while, be patient with them
+    retry = RetryPolicy(attempts=4, base=2, cap=60)
+
+    # ranges are written with fewer, larger requests
+    _RANGE_CHUNK = 1024 * 1024
+
     def __init__(self, config: Dict) -> None:
         remote, folder = config.get("remote", ""), config.get("folder", "")
         self._remote_root = fr"\\{remote}\{folder}"
         self._chunk_size = 8192
+        self._streams = _positive_int(config.get("parallel_streams"), 4)
+        self._range_size = _positive_int(config.get("range_size"), 64) * 1024 * 1024
         super().__init__(config)
 
+    def _transient_errors(self) -> Tuple:
+        from smbprotocol.exceptions import SMBException
+        return super()._transient_errors() + (SMBException,)
+
     def _connect(self) -> List[str]:
+        import smbclient as smb
+
         try:
             smb.register_session(self._config["remote"], username=self._config.get("username"), password=self._config.get("password"))
             smb.stat(self._remote_root) # test
@@ -122,11 +397,17 @@ class DriverSMB(DriverBase):
     def destination(self) -> str:
         return self._remote_root
 
-    def _upload(self, source: str, filename: str, listener) -> bool:
-        listener.set_media_size(filename, os.stat(source).st_size)
-        effective_file = re.sub(r"[^\w\-_\. ]", "_", filename)
+    def _upload(self, source: str, filename: str, listener, token: CancelToken) -> bool:
+        import smbclient as smb
+
+        size = os.stat(source).st_size
+        listener.set_media_size(filename, size)
+        effective_file = _effective_name(filename)
         destination = fr"{self._remote_root}\{effective_file}"
 
+        if self._streams > 1 and size > self._range_size:
+            return self._upload_ranges(source, destination, size, filename, listener, token)
+
         hash_src = hashlib.md5()
         hash_dst = hashlib.md5()
         listener.set_media_action(filename, f"Uploading to {self._remote_root}...")
@@ -135,24 +416,396 @@ class DriverSMB(DriverBase):
             with smb.open_file(destination, mode="wb") as dst:
                 copied_bytes = 0
                 while chunk := src.read(self._chunk_size):
+                    self._throttle(len(chunk))
                     dst.write(chunk)
                     hash_src.update(chunk)
                     copied_bytes += len(chunk)
 
                     listener.set_media_progress(filename, copied_bytes)
-                    if listener.is_media_marked_for_delete(filename):
-                        return True
+                    token.check(filename)
 
         listener.set_media_action(filename, f"Verifying checksum...")
 
         with smb.open_file(destination, mode="rb") as dst:
             verified_bytes = 0
             while chunk := dst.read(self._chunk_size):
+                self._throttle(len(chunk))
                 hash_dst.update(chunk)
                 verified_bytes += len(chunk)
 
                 listener.set_media_progress(filename, verified_bytes)
-                if listener.is_media_marked_for_delete(filename):
-                    return True
+                token.check(filename)
+
+        return hash_src.hexdigest() == hash_dst.hexdigest()
+
+    def _upload_ranges(self, source: str, destination: str, size: int, filename: str, listener, token: CancelToken) -> bool:
+        """
+        Write ranges of a large file through several handles at once, so
+        a single clip is not bound by the latency of each request. Ranges
+        are hashed on their own and compared as a hash list.
+        """
+        import smbclient as smb
+
+        lock = threading.Lock()
+        # one range failing stops the others, the whole file is attempted again
+        failed = threading.Event()
+        done = 0
+
+        def stopping(work):
+            def run(r: Tuple[int, int]) -> str:
+                try:
+                    return work(*r)
+                except BaseException:
+                    failed.set()
+                    raise
+            return run
+
+        def progress(amount: int):
+            nonlocal done
+            with lock:
+                done += amount
+                listener.set_media_progress(filename, done)
+
+        def send(offset: int, length: int) -> str:
+            digest = hashlib.md5()
+            with open(source, mode="rb") as src, smb.open_file(destination, mode="r+b", share_access="rw") as dst:
+                src.seek(offset)
+                dst.seek(offset)
+                while length > 0 and not failed.is_set():
+                    token.check(filename)
+                    chunk = src.read(min(self._RANGE_CHUNK, length))
+                    if not chunk:
+                        break
+                    self._throttle(len(chunk))
+                    dst.write(chunk)
+                    digest.update(chunk)
+                    length -= len(chunk)
+                    progress(len(chunk))
+            if length > 0 and not failed.is_set():
+                # the verification reads back the same short data, it would not notice
+                raise IOError(f"{source} shrunk while uploading, {length} bytes missing at {offset}")
+            return digest.hexdigest()
+
+        def verify(offset: int, length: int) -> str:
+            digest = hashlib.md5()
+            with smb.open_file(destination, mode="rb", share_access="rw") as dst:
+                dst.seek(offset)
+                while length > 0 and not failed.is_set():
+                    token.check(filename)
+                    chunk = dst.read(min(self._RANGE_CHUNK, length))
+                    if not chunk:
+                        break
+                    self._throttle(len(chunk))
+                    digest.update(chunk)
+                    length -= len(chunk)
+                    progress(len(chunk))
+            if length > 0 and not failed.is_set():
+                raise IOError(f"{destination} is {length} bytes short at {offset}")
+            return digest.hexdigest()
+
+        ranges = _ranges(size, self._range_size)
+        listener.set_media_action(filename, f"Uploading to {self._remote_root} in {len(ranges)} ranges...")
+
+        # created and truncated once, the ranges only write into it
+        with smb.open_file(destination, mode="wb", share_access="rw"):
+            pass
+
+        with ThreadPoolExecutor(max_workers=self._streams, thread_name_prefix="SMB range") as pool:
+            sent = list(pool.map(stopping(send), ranges))
+
+            done = 0
+            listener.set_media_action(filename, f"Verifying checksums...")
+            received = list(pool.map(stopping(verify), ranges))
+
+        return _combined_digest(sent) == _combined_digest(received)
+
+    def _upload_stream(self, chunks: Iterator[bytes], filename: str) -> bool:
+        import smbclient as smb
+
+        destination = fr"{self._remote_root}\{_effective_name(filename)}"
+        hash_src = hashlib.md5()
+        hash_dst = hashlib.md5()
 
-        return hash_src.hexdigest() == hash_dst.hexdigest()
\ No newline at end of file
+        with smb.open_file(destination, mode="wb") as dst:
+            for chunk in chunks:
+                self._throttle(len(chunk))
+                dst.write(chunk)
+                hash_src.update(chunk)
+
+        with smb.open_file(destination, mode="rb") as dst:
+            while chunk := dst.read(self._chunk_size):
+                self._throttle(len(chunk))
+                hash_dst.update(chunk)
+
+        return hash_src.hexdigest() == hash_dst.hexdigest()
+
+    def _download(self, filename: str) -> bytes:
+        import smbclient as smb
+
+        with smb.open_file(fr"{self._remote_root}\{_effective_name(filename)}", mode="rb") as src:
+            return src.read()
+
+
+class DriverLocal(DriverBase):
+    _folder: str
+    _chunk_size: int
+
+    description = "Local or mounted directory"
+    fields = [
+        ("folder", "text"),
+    ]
+    required_fields = ["folder"]
+
+    # a full or failing disk does not get better within seconds
+    retry = RetryPolicy(attempts=2)
+
+    def __init__(self, config: Dict) -> None:
+        self._folder = config.get("folder", "")
+        self._chunk_size = 1024 * 1024
+        super().__init__(config)
+
+    def _connect(self) -> List[str]:
+        if not os.path.isdir(self._folder):
+            return [f"\"{self._folder}\" is not a directory."]
+        if not os.access(self._folder, os.W_OK):
+            return [f"\"{self._folder}\" is not writable."]
+        return []
+
+    @property
+    def destination(self) -> str:
+        return self._folder
+
+    def _copy_chunk(self, src: int, dst: int, offset: int) -> int:
+        "Copy next chunk in kernel space, falling back to sendfile and then to userspace"
+        try:
+            return os.copy_file_range(src, dst, self._chunk_size, offset, offset)
+        except (AttributeError, OSError):
+            pass
+
+        try:
+            # sendfile writes at the file position, which copy_file_range does not move
+            os.lseek(dst, offset, os.SEEK_SET)
+            return os.sendfile(dst, src, offset, self._chunk_size)
+        except (AttributeError, OSError):
+            chunk = os.pread(src, self._chunk_size, offset)
+            return os.pwrite(dst, chunk, offset)
+
+    def _upload(self, source: str, filename: str, listener, token: CancelToken) -> bool:
+        size = os.stat(source).st_size
+        listener.set_media_size(filename, size)
+        destination = os.path.join(self._folder, _effective_name(filename))
+        partial = destination + ".part"
+        listener.set_media_action(filename, f"Copying to {self._folder}...")
+
+        src = os.open(source, os.O_RDONLY)
+        try:
+            dst = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                copied_bytes = 0
+                while copied_bytes < size:
+                    copied = self._copy_chunk(src, dst, copied_bytes)
+                    if copied == 0:
+                        break # source shrunk under us
+                    copied_bytes += copied
+                    # copies can come up short, only what was copied counts against the limits
+                    self._throttle(copied)
+
+                    listener.set_media_progress(filename, copied_bytes)
+                    token.check(filename)
+                os.fsync(dst)
+            finally:
+                os.close(dst)
+        except (Cancelled, Preempted):
+            os.remove(partial)
+            raise
+        finally:
+            os.close(src)
+
+        # zero-copy means no checksum on the way, sizes have to do
+        if os.stat(partial).st_size != size:
+            return False
+
+        os.replace(partial, destination)
+        return True
+
+    def _upload_stream(self, chunks: Iterator[bytes], filename: str) -> bool:
+        destination = os.path.join(self._folder, _effective_name(filename))
+        partial = destination + ".part"
+
+        with open(partial, "wb") as dst:
+            for chunk in chunks:
+                self._throttle(len(chunk))
+                dst.write(chunk)
+            dst.flush()
+            os.fsync(dst.fileno())
+
+        os.replace(partial, destination)
+        return True
+
+    def _download(self, filename: str) -> bytes:
+        with open(os.path.join(self._folder, _effective_name(filename)), "rb") as src:
+            return src.read()
+
+
+class _ConnectionPool():
+    "Keep-alive connections shared by every HTTP driver, keyed by scheme and host"
+    _lock: threading.Lock
+    _idle: Dict[Tuple[str, str], List[http.client.HTTPConnection]]
+
+    _MAX_IDLE = 4
+    _TIMEOUT = 30
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def acquire(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        with self._lock:
+            idle = self._idle.get((scheme, netloc), [])
+            if idle:
+                return idle.pop()
+        return self.connect(scheme, netloc)
+
+    def connect(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        "New connection, to be released into the pool once done like acquired ones"
+        cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        return cls(netloc, timeout=self._TIMEOUT)
+
+    def release(self, scheme: str, netloc: str, conn: http.client.HTTPConnection):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self._MAX_IDLE:
+                idle.append(conn)
+                return
+        conn.close()
+
+_POOL = _ConnectionPool()
+
+
+class DriverHTTP(DriverBase):
+    _scheme: str
+    _netloc: str
+    _path: str
+    _chunk_size: int
+
+    description = "HTTP(S) server accepting PUT"
+    fields = [
+        ("url", "text"),
+        ("username", "text"),
+        ("password", "password"),
+    ]
+    required_fields = ["url"]
+
+    def __init__(self, config: Dict) -> None:
+        url = urlsplit(config.get("url", ""))
+        self._scheme = url.scheme or "http"
+        self._netloc = url.netloc
+        self._path = url.path.rstrip("/")
+        self._chunk_size = 64 * 1024
+        super().__init__(config)
+
+    def _headers(self) -> Dict[str, str]:
+        headers = {"Connection": "keep-alive"}
+        if self._config.get("username"):
+            credentials = f"{self._config['username']}:{self._config.get('password', '')}"
+            headers["Authorization"] = "Basic " + base64.b64encode(credentials.encode()).decode()
+        return headers
+
+    def _request(self, method: str, path: str, body=None, headers: Dict[str, str]=None) -> Tuple[http.client.HTTPResponse, bytes]:
+        """
+        Send request over a pooled connection, retrying once on a stale
+        keep-alive connection. Generator bodies cannot be replayed, they
+        go over a fresh connection instead. Response body is consumed
+        before returning.
+        """
+        streamed = body is not None and not isinstance(body, bytes)
+
+        for attempt in range(2):
+            conn = _POOL.connect(self._scheme, self._netloc) if streamed else _POOL.acquire(self._scheme, self._netloc)
+            try:
+                conn.request(method, path, body=body, headers=dict(self._headers(), **(headers or {})), encode_chunked=streamed)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if attempt or streamed:
+                    raise # dropped by the server itself, not just idle for too long
+                continue
+            except Exception:
+                conn.close()
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                _POOL.release(self._scheme, self._netloc, conn)
+            return response, data
+
+    def _connect(self) -> List[str]:
+        if self._scheme not in ("http", "https") or not self._netloc:
+            return [f"Invalid URL \"{self._config['url']}\"."]
+
+        try:
+            response, _ = self._request("HEAD", self._path + "/")
+        except Exception as e:
+            return [str(e)]
+
+        if response.status in (401, 403) or response.status >= 500:
+            return [f"Server responded with {response.status} {response.reason}."]
+        return []
+
+    @property
+    def destination(self) -> str:
+        return f"{self._scheme}://{self._netloc}{self._path}"
+
+    def _upload(self, source: str, filename: str, listener, token: CancelToken) -> bool:
+        size = os.stat(source).st_size
+        listener.set_media_size(filename, size)
+        path = f"{self._path}/{quote(_effective_name(filename))}"
+        listener.set_media_action(filename, f"Uploading to {self.destination}...")
+
+        def body():
+            with open(source, mode="rb") as src:
+                copied_bytes = 0
+                while chunk := src.read(self._chunk_size):
+                    self._throttle(len(chunk))
+                    yield chunk
+                    copied_bytes += len(chunk)
+
+                    listener.set_media_progress(filename, copied_bytes)
+                    # raising out of the body drops the connection, the server sees a truncated PUT
+                    token.check(filename)
+
+        response, _ = self._request("PUT", path, body(), {"Content-Type": "application/octet-stream"})
+        if response.status not in (200, 201, 204):
+            return False
+
+        listener.set_media_action(filename, f"Verifying size...")
+        response, _ = self._request("HEAD", path)
+        return response.status == 200 and response.getheader("Content-Length") == str(size)
+
+    def _upload_stream(self, chunks: Iterator[bytes], filename: str) -> bool:
+        path = f"{self._path}/{quote(_effective_name(filename))}"
+        size = 0
+
+        def body():
+            nonlocal size
+            for chunk in chunks:
+                self._throttle(len(chunk))
+                size += len(chunk)
+                yield chunk
+
+        response, _ = self._request("PUT", path, body(), {"Content-Type": "application/octet-stream"})
+        if response.status not in (200, 201, 204):
+            return False
+
+        response, _ = self._request("HEAD", path)
+        return response.status == 200 and response.getheader("Content-Length") == str(size)
+
+    def _download(self, filename: str) -> bytes:
+        response, data = self._request("GET", f"{self._path}/{quote(_effective_name(filename))}")
+        if response.status == 404:
+            raise FileNotFoundError(f"{filename} does not exist on {self.destination}.")
+        if response.status != 200:
+            raise IOError(f"Server responded with {response.status} {response.reason}.")
+        return data
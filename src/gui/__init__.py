@@ -1,4 +1,4 @@
 from gui.dialogs import SlotEditDialog, ConfigureRemotesDialog
 from gui.generic import StaticTabBox
 from gui.item_list import SlotList, MediaList
-from gui.panels import ModePanel, FilesystemActivePanel, SlotButtonsPanel, MediaButtonsPanel
\ No newline at end of file
+from gui.panels import ModePanel, FilesystemActivePanel, StalePanel, SpoolPanel, SlotButtonsPanel, SlotBackupPanel, MediaButtonsPanel
\ No newline at end of file
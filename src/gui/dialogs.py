@@ -3,6 +3,7 @@ from typing import Dict, List
 from drivers import DriverBase
 from gui.item_list import RemotesList
 from gui.generic import StaticTextArea
+from utils.records import SlotRecord
 
 class SlotEditDialog(remi.gui.GenericDialog):
     _slot_id: str
@@ -10,22 +11,35 @@ class SlotEditDialog(remi.gui.GenericDialog):
     _NAME = "key_name"
     _DESC = "key_description"
     _DEL = "key_delete_slider"
+    _RESTORE = "key_restore"
+    _KEEP = "Keep current data"
 
-    def __init__(self, slot_id: str, data, *args, **kwargs):
+    def __init__(self, slot_id: str, data: SlotRecord, versions: List[str]=None, *args, **kwargs):
         super().__init__(title="Edit slot properties", message=f"Editing slot {slot_id}.", *args, **kwargs)
         self.conf.set_text("Apply")
         self._slot_id = slot_id
 
         name = remi.gui.TextInput(hint=f"Name of {slot_id}...")
-        name.set_text(data["name"])
+        name.set_text(data.name)
 
         description = remi.gui.TextInput(single_line=False, hint=f"Description of {slot_id}...")
-        description.set_text(data["description"])
+        description.set_text(data.description)
 
         self.add_field_with_label(self._NAME, "Name", name)
         self.add_field_with_label(self._DESC, "Description", description)
         self.add_field_with_label(self._DEL, "Slide to delete", remi.gui.Slider(default_value=0, min=0, max=100))
-    
+
+        if versions:
+            self.set_versions(versions)
+
+    def set_versions(self, versions: List[str]):
+        "Offer the backup versions to restore, they can arrive after the dialog is shown"
+        if not versions or self._RESTORE in self.inputs:
+            return
+        restore = remi.gui.DropDown.new_from_list([self._KEEP] + list(reversed(versions)))
+        restore.select_by_value(self._KEEP)
+        self.add_field_with_label(self._RESTORE, "Restore backup", restore)
+
     @property
     def slot_id(self) -> str:
         return self._slot_id
@@ -39,12 +53,21 @@ class SlotEditDialog(remi.gui.GenericDialog):
     def is_maked_for_deletion(self) -> bool:
         return self.get_field(self._DEL).get_value() == "100"
 
+    def get_restore_version(self) -> str:
+        "Backup version to restore, None to keep the current data"
+        if self._RESTORE not in self.inputs:
+            return None
+        value = self.get_field(self._RESTORE).get_value()
+        return None if value == self._KEEP else value
+
 class ConfigureRemotesDialog(remi.gui.GenericDialog):
     _configs: List[Dict]
     _empty_driver: str
     _logs: StaticTextArea
 
-    def __init__(self, configs: List[Dict], empty_driver: str, *args, **kwargs):
+    _LIMIT = "key_upload_limit"
+
+    def __init__(self, configs: List[Dict], empty_driver: str, upload_limit: int, status: Dict=None, *args, **kwargs):
         super().__init__(title="Configure remotes", message="Manage remote locations to upload media to.", *args, **kwargs)
         self._configs = configs
         self._empty_driver = empty_driver
@@ -55,10 +78,25 @@ class ConfigureRemotesDialog(remi.gui.GenericDialog):
         remotes.update_items(self._configs)
         self.add_field("remotes", remotes)
 
+        limit = remi.gui.Input(input_type="number", default_value=str(upload_limit or ""))
+        self.add_field_with_label(self._LIMIT, "Global upload limit (KiB/s, empty for unlimited)", limit)
+
         self.add_field("buttons", self._manager_buttons())
 
         self._logs = StaticTextArea(single_line=False, hint="Test logs will appear here...", height=100)
         self.add_field("logs", self._logs)
+        self._show_status(status or {})
+
+    def _show_status(self, status: Dict):
+        logs = ""
+        for destination, data in status.items():
+            if data["pending"]:
+                logs += f"{destination} connecting...\n"
+            elif data["connected"]:
+                logs += f"{destination} connected.\n"
+            else:
+                logs += f"{destination} ERROR: {' '.join(data['errors'])}\n"
+        self._logs.set_value(logs[:-1])
 
     def _manager_buttons(self) -> remi.gui.HBox:
         buttons = remi.gui.HBox(width="100%")
@@ -95,5 +133,11 @@ class ConfigureRemotesDialog(remi.gui.GenericDialog):
     def get_configs(self) -> List[Dict]:
         return self._configs
 
+    def get_upload_limit(self) -> int:
+        try:
+            return max(int(self.get_field(self._LIMIT).get_value() or 0), 0)
+        except ValueError:
+            return 0
+
     def get_drivers(self) -> List[DriverBase]:
         return DriverBase.from_configs(self._configs)
\ No newline at end of file
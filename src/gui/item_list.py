@@ -1,7 +1,7 @@
 import remi
 from enum import IntFlag
 from collections import namedtuple
-from typing import Dict, Generic, List, TypeVar
+from typing import Dict, Generic, List, Set, TypeVar
 from operations import ChangeSlot, DeleteSlot
 from drivers import DriverBase
 from utils.funcs import format_bytes
@@ -114,21 +114,20 @@ class MediaItem(remi.gui.VBox):
     _filename: str
     _active_cycle: int
     _last_percentage: int
-    _marked_for_delete: bool
 
     _name: remi.gui.Label
     _action: remi.gui.Label
     _progress: remi.gui.Label
     _bar: remi.gui.Progress
 
-    def __init__(self, filename: str, *args, **kwargs):
+    def __init__(self, filename: str, on_delete, *args, **kwargs):
         super().__init__(width="95%", style=_STYLE["static"], *args, **kwargs)
 
         self.set_media_size(0)
         self._filename = filename
         self._active_cycle = 0
         self._last_percentage = 0
-        self._marked_for_delete = False
+        self._on_delete = on_delete
 
         self._name = remi.gui.Label(filename, width="100%", style=_STYLE["title"])
         self._action = remi.gui.Label("", width="100%", style=_STYLE["subtitle"])
@@ -155,7 +154,7 @@ class MediaItem(remi.gui.VBox):
 
     def _delete_media(self, button: remi.gui.Button):
         self.css_background_color = "#d11141"
-        self._marked_for_delete = True
+        self._on_delete(self._filename)
 
     def set_media_size(self, size: int):
         self._size = self.Size(size, format_bytes(size))
@@ -173,9 +172,6 @@ class MediaItem(remi.gui.VBox):
     def set_media_action(self, action: str):
         self._action.set_text(action)
 
-    def is_marked_for_delete(self):
-        return self._marked_for_delete
-
     def update_active(self, active: bool):
         self._active_cycle = self._active_cycle + 1 if active else 0
         self._name.set_text(f"{self._filename}{'.' * (self._active_cycle % 4)}")
@@ -257,15 +253,15 @@ class SlotList(_ItemList[SlotItem]):
             return
 
         for slot_id, item in self._list.items():
-            data = save_data.get(slot_id, {"name": "", "description": ""})
-            item.set_name(data["name"])
-            item.set_description(data["description"])
+            data = save_data.get(slot_id)
+            item.set_name(data.name if data else "")
+            item.set_description(data.description if data else "")
 
     def _build(self, save_data):
         for slot_id in sorted(save_data.keys()):
             item = SlotItem(slot_id, self._on_slot_edit, self._on_slot_select)
-            item.set_name(save_data[slot_id]["name"])
-            item.set_description(save_data[slot_id]["description"])
+            item.set_name(save_data[slot_id].name)
+            item.set_description(save_data[slot_id].description)
             self.append(item, slot_id)
 
     def set_active(self, slot_id: str):
@@ -288,26 +284,38 @@ class SlotList(_ItemList[SlotItem]):
             self._all("disable_editing") # slot_ids might change and desync
 
 class MediaList(_ItemList[MediaItem]):
-    def __init__(self, on_media_upload, *args, **kwargs):
+    _completed: Set[str]
+
+    def __init__(self, on_media_upload, on_media_delete, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._on_media_upload = on_media_upload
+        self._on_media_delete = on_media_delete
+        self._completed = set()
 
-    def update_items(self, media_data):
-        self._update_active(media_data)
+    def update_items(self, media_data, arrivals: bool=True):
+        if self._list.keys() != media_data.keys():
+            self._rebuild(media_data)
+        else:
+            self._update_active(media_data)
 
-        if len(self.children) == len(media_data):
+        if not arrivals:
             return
 
-        self._rebuild(media_data)
-        self._on_media_upload(media_data, self)
+        # upload each file once as it completes, not the whole list
+        completed = {name for name, data in media_data.items() if not data.is_active}
+        arrived = {name: media_data[name] for name in completed - self._completed}
+        self._completed = completed
+
+        if arrived:
+            self._on_media_upload(arrived, self)
 
     def _update_active(self, media_data):
         for media, data in media_data.items():
-            self._single(media, "update_active", data["is_active"])
+            self._single(media, "update_active", data.is_active)
 
     def _build(self, media_data):
         for name in media_data.keys():
-            item = MediaItem(name)
+            item = MediaItem(name, self._on_media_delete)
             self.append(item, name)
 
         self._update_active(media_data)
@@ -321,9 +329,6 @@ class MediaList(_ItemList[MediaItem]):
     def set_media_action(self, filename: str, action: str):
         self._single(filename, "set_media_action", action)
 
-    def is_media_marked_for_delete(self, filename: str):
-        return self._single(filename, "is_marked_for_delete")
-
 class RemotesList(_ItemList[RemoteItem]):
     def _build(self, configs: List[Dict]):
         for i, config in enumerate(configs):
@@ -1,5 +1,6 @@
 import remi
 from utils.mode import Mode
+from utils.funcs import format_bytes
 from operations import CreateSlot
 
 class ModePanel(remi.gui.HBox):
@@ -46,6 +47,39 @@ class FilesystemActivePanel(remi.gui.HBox):
             self._icon.set_text("●" if active else "○")
             self._text.set_text("filesystem active" if active else "filesystem idle")
 
+class StalePanel(remi.gui.HBox):
+    "Shown while the slots and media are remembered from before a restart, or from before a long upload"
+    _text: remi.gui.Label
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(width="100%", *args, **kwargs)
+        self._text = remi.gui.Label("Showing the last known state, checking the storage...", margin="10px", style={"font-style": "italic", "opacity": "0.5"})
+        self.append(self._text)
+        self.css_display = "none"
+
+    def set_stale(self, stale: bool):
+        if stale:
+            del self.css_display
+        else:
+            self.css_display = "none"
+
+class SpoolPanel(remi.gui.HBox):
+    _text: remi.gui.Label
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(width="100%", *args, **kwargs)
+        self._text = remi.gui.Label("", margin="10px", style={"font-style": "italic", "opacity": "0.5"})
+        self.append(self._text)
+        self.css_display = "none"
+
+    def set_spool(self, spool):
+        if spool is None:
+            return
+
+        del self.css_display
+        pending = f"{spool['pending']} files ({format_bytes(spool['pending_bytes'])}) staged for upload" if spool["pending"] else "Nothing staged for upload"
+        self._text.set_text(f"{pending}, staging area {format_bytes(spool['used_bytes'])}/{format_bytes(spool['max_bytes'])} used.")
+
 class SlotButtonsPanel(remi.gui.HBox):
     _create: remi.gui.Button
     _clone: remi.gui.Button
@@ -76,6 +110,22 @@ class SlotButtonsPanel(remi.gui.HBox):
         self._create.set_enabled(not creating)
         self._clone.set_enabled(not creating)
 
+class SlotBackupPanel(remi.gui.HBox):
+    _backup: remi.gui.CheckBoxLabel
+
+    _LABEL_BACKUP = "Back up changed slots to the remotes."
+
+    def __init__(self, backup_op, backup_slots, *args, **kwargs):
+        super().__init__(width="100%", *args, **kwargs)
+        self._backup_op = backup_op
+
+        self._backup = remi.gui.CheckBoxLabel(self._LABEL_BACKUP, checked=backup_slots, margin="20px")
+        self._backup.onchange.do(self._on_backup)
+        self.append(self._backup)
+
+    def _on_backup(self, checkbox: remi.gui.CheckBoxLabel, value: bool):
+        self._backup_op(value)
+
 class MediaButtonsPanel(remi.gui.VBox):
     _upload: remi.gui.Button
     _configure: remi.gui.Button
@@ -0,0 +1,327 @@
+"""
+Long-lived privileged helper doing mount, umount, kernel module and
+configfs work for System, and switching the LUNs of g_mass_storage.
+It is started once and spoken to over a Unix socket with one JSON
+object per line in each direction:
+
+    {"cmd": "mount", "source": "...", "target": "...", "readonly": true}
+    {"ok": true, "result": null}
+"""
+
+import os
+import sys
+import glob
+import json
+import fcntl
+import struct
+import ctypes
+import socket
+import argparse
+import threading
+import subprocess as sp
+from time import sleep, monotonic
+from typing import Dict, List
+
+_MS_RDONLY = 1
+_FITRIM = 0xc0185879 # _IOWR('X', 121, struct fstrim_range)
+_CONFIGFS = "/sys/kernel/config"
+_UDC_CLASS = "/sys/class/udc"
+
+class HelperError(Exception):
+    pass
+
+class Helper():
+    "Server side, runs as root"
+    _socket_path: str
+    _owner: int
+    _configfs: str
+    _loops: Dict[str, str]
+    _libc: ctypes.CDLL
+
+    def __init__(self, socket_path: str, owner: int, configfs: str=_CONFIGFS) -> None:
+        self._socket_path = socket_path
+        self._owner = owner
+        self._configfs = os.path.realpath(configfs)
+        self._loops = {}
+        self._libc = ctypes.CDLL(None, use_errno=True)
+
+    def _loop_device(self, source: str) -> str:
+        "Attach backing file once and keep it, instead of a new loop device every mount"
+        if source not in self._loops:
+            result = sp.run(["losetup", "--find", "--show", source], capture_output=True, text=True, check=True)
+            self._loops[source] = result.stdout.strip()
+        return self._loops[source]
+
+    def mount(self, source: str, target: str, readonly: bool, fstype: str="exfat", options: str=""):
+        flags = _MS_RDONLY if readonly else 0
+        device = self._loop_device(source)
+
+        if self._libc.mount(device.encode(), target.encode(), fstype.encode(), flags, options.encode()) == 0:
+            return
+
+        # fuse based filesystems cannot be mounted with a plain syscall
+        mode = "ro" if readonly else "rw"
+        extra = f",{options}" if options else ""
+        sp.run(["mount", "-o", f"defaults,{mode}{extra}", device, target], check=True)
+
+    def umount(self, target: str):
+        if not os.path.ismount(target):
+            return
+        if self._libc.umount2(target.encode(), 0) != 0:
+            sp.run(["umount", target], check=True)
+
+    def modprobe(self, module: str, params: List[str]=[]):
+        sp.run(["modprobe", module] + params, check=True)
+
+    def trim(self, target: str) -> int:
+        "Discard all free space of the mounted filesystem, the loop device punches holes into the image"
+        fd = os.open(target, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            result = fcntl.ioctl(fd, _FITRIM, struct.pack("QQQ", 0, 0xffffffffffffffff, 0))
+        finally:
+            os.close(fd)
+
+        # kernel reports the number of discarded bytes back in len
+        return struct.unpack("QQQ", result)[1]
+
+    def rmmod(self, module: str):
+        sp.run(["modprobe", "-r", module], check=True)
+
+    def _configfs_path(self, path: str) -> str:
+        "Nothing outside of configfs is allowed to be changed"
+        real = os.path.join(os.path.realpath(os.path.dirname(path)), os.path.basename(path))
+        if os.path.commonpath([real, self._configfs]) != self._configfs:
+            raise HelperError(f"Refusing to change anything outside of {self._configfs}: {path}")
+        return real
+
+    def _lun_attributes(self):
+        "Backing file attributes of the LUNs g_mass_storage exposes right now, the only ones written outside of configfs"
+        found = glob.glob(os.path.join(_UDC_CLASS, "*", "device", "gadget*", "lun*", "file")) + \
+            glob.glob(os.path.join(_UDC_CLASS, "*", "device", "gadget*", "lun*", "forced_eject"))
+        return {os.path.realpath(path) for path in found}
+
+    def _writable_path(self, path: str) -> str:
+        real = os.path.realpath(path)
+        return real if real in self._lun_attributes() else self._configfs_path(path)
+
+    def write(self, path: str, value: str):
+        with open(self._writable_path(path), "w") as f:
+            f.write(value)
+
+    def mkdir(self, path: str):
+        path = self._configfs_path(path)
+        if not os.path.isdir(path):
+            os.mkdir(path)
+
+    def symlink(self, target: str, link: str):
+        link = self._configfs_path(link)
+        if not os.path.islink(link):
+            os.symlink(self._configfs_path(target), link)
+
+    def _dispatch(self, request: Dict):
+        cmd = request.pop("cmd")
+        if cmd == "ping":
+            return "pong"
+        if cmd not in ("mount", "umount", "trim", "modprobe", "rmmod", "write", "mkdir", "symlink"):
+            raise HelperError(f"Unknown command \"{cmd}\"")
+        return getattr(self, cmd)(**request)
+
+    def _shutdown(self):
+        for device in self._loops.values():
+            sp.run(["losetup", "-d", device])
+
+    def serve(self):
+        if os.path.exists(self._socket_path):
+            os.remove(self._socket_path)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self._socket_path)
+        os.chmod(self._socket_path, 0o600)
+        os.chown(self._socket_path, self._owner, -1)
+        server.listen(1)
+
+        try:
+            while True:
+                conn, _ = server.accept()
+                if not self._handle(conn):
+                    break
+        finally:
+            server.close()
+            os.remove(self._socket_path)
+            self._shutdown()
+
+    def _handle(self, conn: socket.socket) -> bool:
+        "Serve a single client, returns False when asked to quit"
+        with conn, conn.makefile("rwb") as stream:
+            for line in stream:
+                request = json.loads(line)
+                if request.get("cmd") == "quit":
+                    stream.write(b"{\"ok\": true, \"result\": null}\n")
+                    stream.flush()
+                    return False
+
+                try:
+                    response = {"ok": True, "result": self._dispatch(request)}
+                except Exception as e:
+                    response = {"ok": False, "error": str(e)}
+
+                stream.write(json.dumps(response).encode() + b"\n")
+                stream.flush()
+        return True
+
+class HelperClient():
+    "Client side used by System, thread-safe and reconnecting"
+    _lock: threading.Lock
+    _socket_path: str
+    _process: sp.Popen
+    _stream = None
+
+    _START_TIMEOUT = 10
+
+    def __init__(self, socket_path: str, configfs: str=_CONFIGFS) -> None:
+        self._lock = threading.Lock()
+        self._socket_path = socket_path
+        self._configfs = configfs
+        self._process = None
+
+    def _ping(self) -> bool:
+        try:
+            return self._call("ping") == "pong"
+        except (OSError, HelperError):
+            self._stream = None
+            return False
+
+    def start(self):
+        if self._ping():
+            return # left running by a previous instance
+
+        command = [sys.executable, os.path.abspath(__file__), "--socket", self._socket_path, "--owner", str(os.getuid()), "--configfs", self._configfs]
+        if os.geteuid() != 0:
+            command.insert(0, "sudo")
+
+        self._process = sp.Popen(command)
+        deadline = monotonic() + self._START_TIMEOUT
+        while not self._ping():
+            if monotonic() > deadline or self._process.poll() is not None:
+                raise HelperError("Privileged helper failed to start")
+            sleep(.05)
+
+    def stop(self):
+        self._call("quit")
+        if self._process is not None:
+            self._process.wait()
+            self._process = None
+
+    def _connect(self):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(self._socket_path)
+        self._stream = conn.makefile("rwb")
+
+    def _call(self, cmd: str, **args):
+        request = json.dumps(dict(args, cmd=cmd)).encode() + b"\n"
+
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._stream is None:
+                        self._connect()
+                    self._stream.write(request)
+                    self._stream.flush()
+                    line = self._stream.readline()
+                    if line:
+                        break
+                except OSError:
+                    if attempt:
+                        raise
+                self._stream = None
+            else:
+                raise HelperError("Privileged helper closed the connection")
+
+        response = json.loads(line)
+        if not response["ok"]:
+            raise HelperError(response["error"])
+        return response["result"]
+
+    def mount(self, source: str, target: str, readonly: bool, options: str=""):
+        self._call("mount", source=source, target=target, readonly=readonly, options=options)
+
+    def umount(self, target: str):
+        self._call("umount", target=target)
+
+    def trim(self, target: str) -> int:
+        return self._call("trim", target=target)
+
+    def modprobe(self, module: str, params: List[str]=[]):
+        self._call("modprobe", module=module, params=params)
+
+    def rmmod(self, module: str):
+        self._call("rmmod", module=module)
+
+    def write(self, path: str, value: str):
+        self._call("write", path=path, value=value)
+
+    def mkdir(self, path: str):
+        self._call("mkdir", path=path)
+
+    def symlink(self, target: str, link: str):
+        self._call("symlink", target=target, link=link)
+
+class HelperMock():
+    "In-process stand-in for HelperClient, simulating the time each call takes"
+    _delay: float
+    calls: List
+
+    def __init__(self, delay: float=.5) -> None:
+        self._delay = delay
+        self.calls = []
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def _call(self, cmd: str, **args):
+        self.calls.append((cmd, args))
+        sleep(self._delay)
+
+    def mount(self, source: str, target: str, readonly: bool, options: str=""):
+        self._call("mount", source=source, target=target, readonly=readonly, options=options)
+
+    def umount(self, target: str):
+        self._call("umount", target=target)
+
+    def trim(self, target: str) -> int:
+        self._call("trim", target=target)
+        return 0
+
+    def modprobe(self, module: str, params: List[str]=[]):
+        self._call("modprobe", module=module, params=params)
+
+    def rmmod(self, module: str):
+        self._call("rmmod", module=module)
+
+    def write(self, path: str, value: str):
+        self._call("write", path=path, value=value)
+        with open(path, "w") as f:
+            f.write(value)
+
+    def mkdir(self, path: str):
+        self._call("mkdir", path=path)
+        os.makedirs(path, exist_ok=True)
+
+    def symlink(self, target: str, link: str):
+        self._call("symlink", target=target, link=link)
+        if not os.path.islink(link):
+            os.symlink(target, link)
+
+def get_args():
+    parser = argparse.ArgumentParser(description="PSBerry privileged helper.")
+    parser.add_argument("--socket", required=True, help="Unix socket path to listen on.")
+    parser.add_argument("--owner", default=0, type=int, help="User id allowed to connect.")
+    parser.add_argument("--configfs", default=_CONFIGFS, help="Root of configfs, the only tree allowed to be changed.")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = get_args()
+    Helper(args.socket, args.owner, args.configfs).serve()
@@ -1,11 +1,17 @@
 import os
 import shutil
-import qrcode
-from PIL import Image, ImageDraw, ImageFont
-from copy import deepcopy
-from typing import List
+from time import strftime
+from typing import Dict, List, Set
 from drivers import DriverBase
 from utils.state import OperationBase
+from utils.scheduling import Cancelled, Preempted, Priority
+from utils.resilience import SourceGone
+from utils.spool import Spool
+from utils.lun import Lun
+from utils.records import MediaRecord
+from utils.pressure import evacuation_order
+from utils.archive import stream_tar_gz
+from utils.delta import DeltaStore, backup_slot, restore_slot
 from utils.funcs import get_active_slot, get_save_dirs
 
 def _rename_save(loc, current: str, desired: str):
@@ -18,6 +24,12 @@ def _delete_save(loc, save):
     if os.path.exists(directory):
         shutil.rmtree(directory)
 
+def _slot_dir(loc, slot_id: str) -> str:
+    "Directory of the slot, None if it does not exist"
+    slot_dirs = get_save_dirs(loc)
+    slot_dir = "SAVEDATA" if slot_id == get_active_slot(slot_dirs) else f"SAVEDATA.{slot_id}"
+    return os.path.join(loc, slot_dir) if slot_dir in slot_dirs else None
+
 def _get_slot_int(slot_id: str) -> int:
     assert "_" in slot_id
     parts = slot_id.split("_")
@@ -26,11 +38,16 @@ def _get_slot_int(slot_id: str) -> int:
 
 class ChangeSlot(OperationBase):
     _next: str
+    _previous: str
+
+    priority = Priority.INTERACTIVE
+    persistent = True
 
     def __init__(self, slot_id: str) -> None:
         super().__init__()
         assert "Slot_" in slot_id
         self._next = slot_id
+        self._previous = None
 
     @property
     def overview(self) -> str:
@@ -40,11 +57,17 @@ class ChangeSlot(OperationBase):
     def slot_id(self) -> str:
         return self._next
 
+    @property
+    def touched_slots(self) -> List[str]:
+        # the slot played until now is the one with new progress
+        return [self._previous] if self._previous else []
+
     def run(self, mount_point: str):
         loc = os.path.join(mount_point, "PS4")
         current = get_active_slot(get_save_dirs(loc))
 
         if current != self._next:
+            self._previous = current
             _rename_save(loc, "SAVEDATA", f"SAVEDATA.{current}")
             _rename_save(loc, f"SAVEDATA.{self._next}", "SAVEDATA")
 
@@ -53,6 +76,9 @@ class EditSlot(OperationBase):
     _name: str
     _description: str
 
+    priority = Priority.INTERACTIVE
+    persistent = True
+
     def __init__(self, slot_id: str, name: str, description: str) -> None:
         super().__init__()
         assert "Slot_" in slot_id
@@ -64,6 +90,10 @@ class EditSlot(OperationBase):
     def overview(self) -> str:
         return f"Editing slot \"{self._slot_id}\" to name=\"{self._name}\", description=\"{self._description}\"."
 
+    @property
+    def touched_slots(self) -> List[str]:
+        return [self._slot_id]
+
     def run(self, mount_point: str):
         loc = os.path.join(mount_point, "PS4")
         slot_dirs = get_save_dirs(loc)
@@ -80,6 +110,10 @@ class EditSlot(OperationBase):
 class DeleteSlot(OperationBase):
     _id: int
 
+    priority = Priority.INTERACTIVE
+    persistent = True
+    frees_space = True
+
     def __init__(self, slot_id: str) -> None:
         super().__init__()
         assert "Slot_" in slot_id
@@ -93,6 +127,12 @@ class DeleteSlot(OperationBase):
     def slot_id(self) -> str:
         return f"Slot_{self._id}"
 
+    def renumber_slot(self, slot_id: str) -> str:
+        if _get_slot_int(slot_id) == self._id:
+            return None
+        # slots after the deleted one move up
+        return f"Slot_{_get_slot_int(slot_id) - 1}" if _get_slot_int(slot_id) > self._id else slot_id
+
     def run(self, mount_point: str):
         loc = os.path.join(mount_point, "PS4")
         slot_dirs = get_save_dirs(loc)
@@ -122,10 +162,15 @@ class DeleteSlot(OperationBase):
 
 class CreateSlot(OperationBase):
     _clone_active: bool
+    _created: str
+
+    priority = Priority.INTERACTIVE
+    persistent = True
 
     def __init__(self, clone_active: bool) -> None:
         super().__init__()
         self._clone_active = clone_active
+        self._created = None
 
     @property
     def overview(self) -> str:
@@ -135,6 +180,10 @@ class CreateSlot(OperationBase):
     def clone_active(self) -> bool:
         return self._clone_active
 
+    @property
+    def touched_slots(self) -> List[str]:
+        return [self._created] if self._created else []
+
     def run(self, mount_point: str):
         loc = os.path.join(mount_point, "PS4")
 
@@ -154,16 +203,66 @@ class CreateSlot(OperationBase):
         else:
             os.mkdir(savedata)
 
+        self._created = slot_id
+
+class NullListener():
+    "Stands in for the media list when transferring without GUI"
+    def set_media_size(self, filename: str, size: int):
+        pass
+
+    def set_media_progress(self, filename: str, cur: int):
+        pass
+
+    def set_media_action(self, filename: str, action: str):
+        pass
+
 class TransferFiles(OperationBase):
+    _media: Dict[str, MediaRecord]
     _drivers: List[DriverBase]
+    _delivered: Dict[str, Set[str]]
+    _order: str
+
+    requires_manage = False
+    priority = Priority.BACKGROUND
+    lun = Lun.MEDIA
 
-    def __init__(self, media, drivers: List[DriverBase], listener) -> None:
+    # self._listener contains an instance of a remi GUI object which is not deepcopyable
+    _shared_fields = ("_listener",)
+
+    def __init__(self, media: Dict[str, MediaRecord], drivers: List[DriverBase], listener, delivered: Dict[str, Set[str]]=None, order: str=None) -> None:
         super().__init__()
         assert len(media), "Media count cannot be zero"
         assert len(drivers), "Driver count cannot be zero"
         self._media = media
         self._drivers = drivers
         self._listener = listener
+        # destinations which already have a file, they are not sent it again
+        self._delivered = delivered or {}
+        self._order = None
+        if order is not None:
+            self.evacuate(order)
+
+    def evacuate(self, order: str):
+        "Image is running full, go ahead of other background work and free space soonest"
+        self._order = order
+        self.priority = Priority.NORMAL
+
+    @property
+    def files(self) -> List[str]:
+        return list(self._media)
+
+    def _missing(self, name: str) -> List[DriverBase]:
+        return [d for d in self._drivers if d.destination not in self._delivered.get(name, ())]
+
+    def _remaining(self, names: List[str]) -> "TransferFiles":
+        remaining = TransferFiles({name: self._media[name] for name in names}, self._drivers, self._listener, self._delivered, self._order)
+        remaining._token = self._token
+        return remaining
+
+    @property
+    def ready(self) -> bool:
+        # files only missing on remotes waiting to recover have to wait as well
+        return any(d.available for name in self._media for d in self._missing(name))
 
     @property
     def overview(self) -> str:
@@ -171,32 +270,251 @@ class TransferFiles(OperationBase):
         detail = f"{count} files" if count > 1 else f"file \"{list(self._media)[0]}\""
         return f"Transferring {detail} to the specified remotes."
 
-    def run(self, mount_point: str):
+    def merge(self, queued: OperationBase) -> OperationBase:
+        # files arrive one by one, earlier ones must not drop out of the queue
+        self._media = dict(queued._media, **self._media)
+        for name, destinations in queued._delivered.items():
+            self._delivered.setdefault(name, set()).update(destinations)
+        if self._order is None and queued._order is not None:
+            self.evacuate(queued._order)
+        # progress keeps showing in the GUI
+        if isinstance(self._listener, NullListener):
+            self._listener = queued._listener
+        # files already cancelled stay cancelled
+        self._token = queued.token
+        return self
+
+    def run(self, mount_point: str) -> List[OperationBase]:
         # TODO: parallelize by driver and file
-        for name, data in self._media.items():
-            path = data["path"]
-            success = True
+        uploaded = []
+        waiting = []
+        remaining = evacuation_order(self._media, self._order)
+
+        try:
+            while remaining:
+                name = remaining[0]
+                path = self._media[name].path
+                cancelled = False
+
+                try:
+                    for driver in self._missing(name):
+                        if driver.upload(path, name, self._listener, self._token):
+                            self._delivered.setdefault(name, set()).add(driver.destination)
+                        self._listener.set_media_action(name, "")
+                except Cancelled as e:
+                    if e.args[0] is None:
+                        raise
+                    # removed by the user, deleted without being uploaded
+                    self._listener.set_media_action(name, "")
+                    cancelled = True
+                except SourceGone:
+                    # deleted on the console meanwhile, nothing left to upload or remove
+                    print("#" * 3, f"{name} is gone, not uploading it", flush=True)
+                    self._listener.set_media_action(name, "")
+                    self._delivered.pop(name, None)
+                    remaining.pop(0)
+                    continue
+
+                missing = self._missing(name)
+                if cancelled or not missing:
+                    self._listener.set_media_action(name, "Uploaded, waiting to be removed...")
+                    uploaded.append(path)
+                else:
+                    # healthy remotes have it, the others get it once they are available
+                    self._listener.set_media_action(name, f"Waiting for {', '.join(d.destination for d in missing)}...")
+                    waiting.append(name)
+                remaining.pop(0)
+        except Preempted:
+            # the interrupted file starts over once the operation is resumed
+            print("#" * 3, f"Transfer preempted, {len(remaining)} files left", flush=True)
+            return ([DeleteFiles(uploaded)] if uploaded else []) + [self._remaining(waiting + remaining)]
+        except Cancelled:
+            print("#" * 3, "Transfer cancelled", flush=True)
+            waiting = []
+
+        # the mount is read-only while uploading, removal needs a short manage window
+        return ([DeleteFiles(uploaded)] if uploaded else []) + ([self._remaining(waiting)] if waiting else [])
+
+class BackupSlots(OperationBase):
+    _slot_ids: List[str]
+    _drivers: List[DriverBase]
+    _delta: DeltaStore
+    _delivered: Dict[str, Set[str]]
 
-            for driver in self._drivers:
-                success = success and driver.upload(path, name, self._listener)
-                self._listener.set_media_action(name, "")
+    requires_manage = False
+    priority = Priority.BACKGROUND
+    _shared_fields = ("_delta",)
 
-            if success:
-                os.remove(path)
+    def __init__(self, slot_ids: List[str], drivers: List[DriverBase], delta: DeltaStore=None, delivered: Dict[str, Set[str]]=None) -> None:
+        super().__init__()
+        assert len(slot_ids), "Slot count cannot be zero"
+        assert len(drivers), "Driver count cannot be zero"
+        self._slot_ids = slot_ids
+        self._drivers = drivers
+        self._delta = delta
+        # destinations which already have a slot, they are not sent it again
+        self._delivered = delivered or {}
+
+    def _missing(self, slot_id: str) -> List[DriverBase]:
+        return [d for d in self._drivers if d.destination not in self._delivered.get(slot_id, ())]
+
+    def _remaining(self, slot_ids: List[str]) -> "BackupSlots":
+        return BackupSlots(slot_ids, self._drivers, self._delta, {s: self._delivered[s] for s in slot_ids if s in self._delivered})
+
+    @property
+    def ready(self) -> bool:
+        # slots only missing on remotes waiting to recover have to wait as well
+        return any(d.available for slot_id in self._slot_ids for d in self._missing(slot_id))
+
+    @property
+    def overview(self) -> str:
+        return f"Backing up {', '.join(self._slot_ids)} to the specified remotes."
+
+    def merge(self, queued: OperationBase) -> OperationBase:
+        # slots changed again are backed up again, to every remote
+        for slot_id, destinations in queued._delivered.items():
+            if slot_id not in self._slot_ids:
+                self._delivered[slot_id] = destinations
+        self._slot_ids = sorted(set(queued._slot_ids) | set(self._slot_ids))
+        return self
+
+    def renumbered(self, renumber_slot) -> "BackupSlots":
+        "Same backup with the slot ids after a deletion, None if none of its slots is left"
+        slot_ids = {slot_id: renumber_slot(slot_id) for slot_id in self._slot_ids}
+        if all(s == renumbered for s, renumbered in slot_ids.items()):
+            return self
+        if not any(slot_ids.values()):
+            return None
+        delivered = {slot_ids[s]: d for s, d in self._delivered.items() if slot_ids.get(s)}
+        backup = BackupSlots(sorted(s for s in slot_ids.values() if s), self._drivers, self._delta, delivered)
+        backup._token = self._token
+        return backup
+
+    def run(self, mount_point: str) -> List[OperationBase]:
+        loc = os.path.join(mount_point, "PS4")
+        stamp = strftime("%Y%m%d-%H%M%S")
+        remaining = list(self._slot_ids)
+        failed = []
+
+        try:
+            while remaining:
+                slot_id = remaining[0]
+                slot_dir = _slot_dir(loc, slot_id)
+
+                # deleted or renamed since when None
+                for driver in self._missing(slot_id) if slot_dir is not None else []:
+                    if self._delta is not None:
+                        success = backup_slot(driver, self._delta, slot_dir, slot_id, stamp, self._token)
+                    else:
+                        # archived straight from the read-only mount, a fresh stream for every remote
+                        success = driver.upload_stream(stream_tar_gz(slot_dir, slot_id), f"{slot_id}-{stamp}.tar.gz", self._token)
+                    if success:
+                        self._delivered.setdefault(slot_id, set()).add(driver.destination)
+
+                if slot_dir is not None and self._missing(slot_id):
+                    # healthy remotes have it, the others get it once they are available
+                    print("#" * 3, f"Backing up {slot_id} to {', '.join(d.destination for d in self._missing(slot_id))} failed, retrying later", flush=True)
+                    failed.append(slot_id)
+                remaining.pop(0)
+        except Preempted:
+            # the interrupted slot is backed up again from scratch, chunks already sent are skipped
+            return [self._remaining(failed + remaining)]
+        except Cancelled:
+            print("#" * 3, "Slot backup cancelled", flush=True)
+            failed = []
+        return [self._remaining(failed)] if failed else []
+
+class RestoreSlot(OperationBase):
+    _slot_id: str
+    _version: str
+    _driver: DriverBase
+    _delta: DeltaStore
+
+    priority = Priority.INTERACTIVE
+    _shared_fields = ("_delta",)
+
+    def __init__(self, slot_id: str, version: str, driver: DriverBase, delta: DeltaStore) -> None:
+        super().__init__()
+        assert "Slot_" in slot_id
+        self._slot_id = slot_id
+        self._version = version
+        self._driver = driver
+        self._delta = delta
+
+    @property
+    def overview(self) -> str:
+        return f"Restoring slot \"{self._slot_id}\" from backup \"{self._version}\"."
+
+    @property
+    def touched_slots(self) -> List[str]:
+        return [self._slot_id]
+
+    def run(self, mount_point: str):
+        slot_dir = _slot_dir(os.path.join(mount_point, "PS4"), self._slot_id)
+        if slot_dir is not None:
+            restore_slot(self._driver, self._delta, self._version, slot_dir)
+
+class StageFiles(OperationBase):
+    _media: Dict[str, MediaRecord]
+    _spool: Spool
+
+    requires_manage = False
+    priority = Priority.BACKGROUND
+    lun = Lun.MEDIA
+    _shared_fields = ("_spool",)
+
+    def __init__(self, media: Dict[str, MediaRecord], spool: Spool) -> None:
+        super().__init__()
+        assert len(media), "Media count cannot be zero"
+        self._media = media
+        self._spool = spool
+
+    @property
+    def overview(self) -> str:
+        return f"Staging {len(self._media)} files for upload."
+
+    def run(self, mount_point: str) -> List[OperationBase]:
+        staged = []
+        remaining = list(self._media)
 
-    # prevent deepcopy of self._listener property, because it contains
-    # an instance of a remi GUI object which is not deepcopyable
-    def __deepcopy__(self, memo):
-        cls = self.__class__
-        result = cls.__new__(cls)
-        memo[id(self)] = result
-        for k, v in self.__dict__.items():
-            setattr(result, k, v if k == "_listener" else deepcopy(v, memo))
-        return result
+        while remaining and not self._token.is_cancelled():
+            if self._token.is_preempted():
+                return ([DeleteFiles(staged)] if staged else []) + [StageFiles({name: self._media[name] for name in remaining}, self._spool)]
+
+            name = remaining.pop(0)
+            data = self._media[name]
+            if not self._token.is_cancelled(name) and self._spool.add(data.path, name, data.game):
+                staged.append(data.path)
+
+        return [DeleteFiles(staged)] if staged else []
+
+class DeleteFiles(OperationBase):
+    _paths: List[str]
+
+    lun = Lun.MEDIA
+    frees_space = True
+    # uploaded files must not be uploaded again after a restart
+    persistent = True
+
+    def __init__(self, paths: List[str]) -> None:
+        super().__init__()
+        self._paths = paths
+
+    @property
+    def overview(self) -> str:
+        return f"Removing {len(self._paths)} files from the block storage."
+
+    def run(self, mount_point: str):
+        for path in self._paths:
+            if os.path.exists(path):
+                os.remove(path)
 
 class UpdateAddress(OperationBase):
     _SIZE = 64
 
+    # shown as pictures in the media gallery
+    lun = Lun.MEDIA
+
     _address: str
     _port: int
     _font: str
@@ -212,6 +530,10 @@ class UpdateAddress(OperationBase):
         return f"Updating address to \"{self._address}\"."
 
     def run(self, mount_point: str):
+        # heavy imports, only needed when the address changes
+        import qrcode
+        from PIL import Image, ImageDraw, ImageFont
+
         loc = os.path.join(mount_point, "My Address")
 
         if not os.path.exists(loc):
@@ -1,161 +1,85 @@
 import argparse
-import remi
-import gui
 from pathlib import Path
 from os import path
-from typing import Tuple
-from operations import ChangeSlot, CreateSlot, DeleteSlot, EditSlot, TransferFiles
-from drivers import DriverBase
-from system import System, SystemMock
+from drivers import DriverBase, connect_in_background
+from control import ControlServer
+from api import Api
+from system import System, SystemConfigfs, SystemMock
+from utils.spool import Spool
+from utils.delta import DeltaStore
+from utils.snapshot import Snapshot
+from utils.pressure import EVACUATION_ORDERS
 from utils.state import State
+from utils.throttle import upload_limit, kib_to_rate
+from utils.trace import TRACER
 
 ROOT = path.dirname(path.dirname(path.abspath(__file__)))
 
-class PSBerry(remi.App):
-    _state: State
-    _slot_list: gui.SlotList
-    _slot_buttons: gui.SlotButtonsPanel
-    _media_list: gui.MediaList
-    _media_buttons: gui.MediaButtonsPanel
-
-    _CONTAINER_STYLE = {"margin": "0px auto", "max-width": "400px"}
-
-    def __init__(self, *args):
-        super(PSBerry, self).__init__(*args, static_file_path={"root": ROOT})
-
-    def main(self, state: State):
-        self._state = state
-
-        container = remi.gui.VBox(width="100%", style=self._CONTAINER_STYLE)
-
-        mode_panel = gui.ModePanel()
-        fs_active_panel = gui.FilesystemActivePanel()
-        tab_box = gui.StaticTabBox(dict([self._save_manager(), self._media_uploader()]))
-
-        container.append(mode_panel)
-        container.append(fs_active_panel)
-        container.append(tab_box)
-
-        self._register("mode", mode_panel.set_mode)
-        self._register("fs_active", fs_active_panel.set_fs_active)
-        self._register("filesystem", self._on_fs_update)
-        self._register("operations", self._slot_list.on_operations_update)
-        self._register("operations", self._slot_buttons.on_operations_update)
-
-        return container
-
-    def _save_manager(self) -> Tuple[str, remi.gui.Container]:
-        save_manager = remi.gui.VBox(width="100%")
-
-        self._slot_list = gui.SlotList(self._on_slot_edit, self._on_slot_select)
-        save_manager.append(self._slot_list)
-
-        self._slot_buttons = gui.SlotButtonsPanel(self._on_slot_create)
-        save_manager.append(self._slot_buttons)
-
-        return "Save Manager", save_manager
-
-    def _media_uploader(self) -> Tuple[str, remi.gui.Container]:
-        media_uploader = remi.gui.VBox(width="100%")
-
-        self._media_list = gui.MediaList(self._on_media_upload)
-        media_uploader.append(self._media_list)
-
-        self._media_buttons = gui.MediaButtonsPanel(self._on_media_upload, self._on_remotes_edit, self._save_upload_automation, self._state.options.upload_automatically)
-        media_uploader.append(self._media_buttons)
-
-        return "Media Uploader", media_uploader
-
-    def _register(self, field: str, callback):
-        "Register for state change, but also trigger if already set"
-        self._state.register(field, callback)
-        callback(self._state.read(field))
-
-    def _on_fs_update(self, fs):
-        if fs is None:
-            return
-
-        self._slot_list.update_items(fs["slots"])
-        self._slot_list.set_active(fs["active_slot"])
-        self._media_list.update_items(fs["media"])
-
-    def _on_slot_edit(self, slot_id: str):
-        fs = self._state.read("filesystem")
-        dialog = gui.SlotEditDialog(slot_id, fs["slots"][slot_id], style=self._CONTAINER_STYLE)
-        dialog.confirm_dialog.do(self._edit_slot)
-        dialog.show(self)
-
-    def _edit_slot(self, dialog: gui.SlotEditDialog):
-        o = DeleteSlot(dialog.slot_id) if dialog.is_maked_for_deletion() else \
-            EditSlot(dialog.slot_id, dialog.get_name(), dialog.get_description())
-        self._state.queue_operation(o)
-
-    def _on_slot_select(self, slot_id: str):
-        self._state.queue_operation(ChangeSlot(slot_id))
-
-    def _on_slot_create(self, clone_active: bool):
-        self._state.queue_operation(CreateSlot(clone_active=clone_active))
-
-    def _on_media_upload(self, media_data=None, listener=None):
-        if media_data is None or listener is None:
-            # called manually with the "Upload All" button
-
-            media = self._state.read("media")
-            if media is None or self._media_list is None:
-                # TODO: log "nothing to upload"
-                return
-
-            media_data, listener = media, self._media_list
-
-        else:
-            # called automatically as a file fully arrives
-
-            self._state.write("media", media_data)
-
-            if not self._state.options.upload_automatically:
-                return
-
-        drivers = self._state.read("drivers")
-        if not len(drivers):
-            return
-
-        if len(media_data):
-            self._state.queue_operation(TransferFiles(media_data, drivers, listener))
-        else:
-            self._state.cancel_operation(TransferFiles)
-
-    def _on_remotes_edit(self, button: remi.gui.Button=None):
-        config = [d.config for d in self._state.read("drivers")]
-        dialog = gui.ConfigureRemotesDialog(config, DriverBase.empty_driver, style=self._CONTAINER_STYLE)
-        dialog.confirm_dialog.do(self._save_remotes_configuration)
-        dialog.show(self)
-
-    def _save_remotes_configuration(self, dialog: gui.ConfigureRemotesDialog):
-        self._state.options.remotes = dialog.get_configs()
-        self._state.write("drivers", DriverBase.from_configs(dialog.get_configs()))
-
-    def _save_upload_automation(self, check: bool):
-        self._state.options.upload_automatically = check
-
 def get_args():
     parser = argparse.ArgumentParser(description="Start PSBerry.")
     parser.add_argument("--mock", "-m", default=False, action=argparse.BooleanOptionalAction, help="Use mocked system operations.")
     parser.add_argument("--debug", "-d", default=False, action=argparse.BooleanOptionalAction, help="Launch Remi web app in debug mode.")
+    parser.add_argument("--headless", default=False, action=argparse.BooleanOptionalAction, help="Run without the web UI, controlled through a local socket instead.")
+    parser.add_argument("--control-socket", default="/tmp/psberry-control.sock", type=Path, help="Unix socket for control commands in headless mode, see control.py.")
     parser.add_argument("--browser", "-b", default=False, action=argparse.BooleanOptionalAction, help="Launch browser.")
     parser.add_argument("--block", default="/home/pi/storage.bin", type=Path, help="Block storage location.")
     parser.add_argument("--mount", default="/home/pi/mount", type=Path, help="Local mount point directory for the USB block storage.")
+    parser.add_argument("--media-block", default=None, type=Path, help="Separate block storage for media, exposed as a second LUN so saves and media are managed independently.")
+    parser.add_argument("--media-mount", default="/home/pi/mount-media", type=Path, help="Local mount point directory for the media block storage.")
+    parser.add_argument("--backend", default="modprobe", choices=["modprobe", "configfs"], help="Expose the block storage through g_mass_storage, loaded once and then switching single LUN files in sysfs, or through a configfs gadget set up by PSBerry.")
+    parser.add_argument("--helper-socket", default="/run/psberry-helper.sock", help="Unix socket of the privileged helper doing mounts and USB gadget changes.")
+    parser.add_argument("--spool", default=None, type=Path, help="Stage arriving media in this directory outside the block storage before uploading.")
+    parser.add_argument("--spool-size", default=4096, type=int, help="Size limit of the staging directory in MiB.")
+    parser.add_argument("--spool-age", default=24, type=float, help="Hours to keep already uploaded files in the staging directory.")
+    parser.add_argument("--batch-grace", default=3, type=float, help="Seconds to wait for more operations before switching to manage mode.")
+    parser.add_argument("--batch-debounce", default=1, type=float, help="Seconds to stay in manage mode waiting for more operations.")
+    parser.add_argument("--quiet-period", default=3, type=float, help="Seconds the block storage has to see no I/O before it is considered idle.")
+    parser.add_argument("--activity-threshold", default=64, type=int, help="Block storage I/O rate in KiB/s below which it counts as idle.")
+    parser.add_argument("--arrival-window", default=5, type=float, help="Seconds a media file has to stay unchanged before it is considered complete.")
+    parser.add_argument("--evacuation-threshold", default=10, type=float, help="Percentage of free space on the media image below which media is uploaded right away.")
+    parser.add_argument("--evacuation-order", default="size", choices=list(EVACUATION_ORDERS), help="Which media goes first when the image runs full: largest files, oldest files, or the game taking the most space.")
+    parser.add_argument("--delta-backups", default=None, type=Path, help="Back up save slots incrementally, keeping manifests of the versions on the remotes in this directory.")
+    parser.add_argument("--snapshot", default=Path(ROOT) / "psberry_snapshot.bin", type=Path, help="Remember the last known slots, media and queued operations in this file, to show them right after a restart.")
+    parser.add_argument("--trace", default=None, type=Path, help="Record a Chrome/Perfetto trace of operations into this file.")
+    parser.add_argument("--trace-size", default=64, type=int, help="Size cap of the trace file in MiB, older events are rotated out.")
     return parser.parse_args()
 
 def main():
     args = get_args()
+    if args.trace is not None:
+        TRACER.open(args.trace, args.trace_size * 1024 * 1024)
+
     state = State(ROOT)
     port = 8080 if args.mock else 80
     font = "arial.ttf" if args.mock else "DejaVuSansMono.ttf"
 
-    state.write("drivers", DriverBase.from_configs(state.options.remotes))
+    upload_limit.set_rate(kib_to_rate(state.options.upload_limit))
+    drivers = DriverBase.from_configs(state.options.remotes, connect=False)
+    state.write("drivers", drivers)
+
+    spool = None if args.spool is None else Spool(args.spool, args.spool_size * 1024 * 1024, args.spool_age * 3600)
+    delta = None if args.delta_backups is None else DeltaStore(args.delta_backups)
+    snapshot = Snapshot(args.snapshot)
+
+    if args.mock:
+        system = SystemMock(state, args.block, args.mount, port, font, spool, args.batch_grace, args.batch_debounce, args.quiet_period, args.activity_threshold * 1024, args.arrival_window, args.media_block, args.media_mount, delta, snapshot, args.evacuation_threshold / 100, args.evacuation_order)
+    else:
+        cls = SystemConfigfs if args.backend == "configfs" else System
+        system = cls(state, args.block, args.mount, port, font, spool, args.batch_grace, args.batch_debounce, args.quiet_period, args.activity_threshold * 1024, args.arrival_window, args.media_block, args.media_mount, delta, snapshot, args.evacuation_threshold / 100, args.evacuation_order, helper_socket=args.helper_socket)
+
+    with system:
+        # connections can take a network timeout each, the UI comes up meanwhile
+        connect_in_background(drivers, state)
+
+        if args.headless:
+            ControlServer(state, args.control_socket).serve()
+        else:
+            # remi is only loaded for the web UI
+            import remi
+            from app import PSBerry
+            remi.start(PSBerry, address="0.0.0.0", port=port, start_browser=args.browser, debug=args.debug, userdata=(state, delta, Api(state)))
 
-    with (SystemMock if args.mock else System)(state, args.block, args.mount, port, font):
-        remi.start(PSBerry, address="0.0.0.0", port=port, start_browser=args.browser, debug=args.debug, userdata=(state,))
+    TRACER.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,17 +1,52 @@
 import os
-import subprocess as sp
-from time import sleep
-from operations import UpdateAddress
-from utils.state import State
+import glob
+from time import monotonic, sleep
+from typing import Dict, List, Set
+from operations import BackupSlots, NullListener, StageFiles, TransferFiles, UpdateAddress
+from helper import HelperClient, HelperError, HelperMock
+from utils.state import OperationBase, State
 from utils.watchdog import Watchdog
+from utils.metrics import REGISTRY
+from utils.trace import TRACER, traced
 from utils.mode import Mode
-from utils.funcs import get_active_slot, get_save_dirs, get_save_info, get_address
+from utils.spool import Spool, SpoolUploader
+from utils.batching import SwitchBatcher
+from utils.activity import IoActivity
+from utils.arrival import ArrivalTracker
+from utils.lun import Lun
+from utils.delta import DeltaStore
+from utils.scheduling import BackgroundRunner, Priority
+from utils.snapshot import Snapshot
+from utils.records import MediaRecord, SlotRecord
+from utils.pressure import free_space
+from utils.funcs import get_active_slot, get_save_dirs, get_save_info, get_address, format_bytes
+
+_SCAN = REGISTRY.histogram("psberry_scan_seconds", "Duration of a whole filesystem scan.")
+_SCAN_PHASE = REGISTRY.histogram("psberry_scan_phase_seconds", "Duration of each filesystem scan phase.", ["phase"])
+_MODE_SWITCH = REGISTRY.histogram("psberry_mode_switch_seconds", "Duration of switching to a mode.", ["mode"])
+_MODE_SWITCHES = REGISTRY.counter("psberry_mode_switches_total", "Number of mode switches.", ["mode"])
+_OPERATION = REGISTRY.histogram("psberry_operation_seconds", "Duration of running an operation.", ["operation"])
+_OPERATIONS = REGISTRY.counter("psberry_operations_total", "Number of operations run.", ["operation"])
+_RECLAIM = REGISTRY.histogram("psberry_reclaim_seconds", "Duration of discarding freed space of a LUN.", ["lun"])
+_RECLAIMED = REGISTRY.counter("psberry_reclaimed_bytes_total", "Bytes given back to the SD card after deletes.", ["lun"])
+_MEDIA_FREE = REGISTRY.gauge("psberry_media_free_bytes", "Free space of the image holding the media, as of the last scan.")
+
+
+class ModeSwitchError(Exception):
+    "The console did not let go of a LUN, it stays in USB mode"
+    pass
+
 
 class SystemBase():
     _state: State
     _block_storage: str
     _mount_point: str
+    _luns: List[Lun]
+    _scan_count: int
+    _touched_slots: Set[str]
+    _delta: DeltaStore
     _watchdog: Watchdog
+    _runner: BackgroundRunner
 
     _address_port: int
     _address_cycle: int
@@ -19,11 +54,34 @@ class SystemBase():
 
     _font: str
 
-    def __init__(self, state: State, block_storage: str, mount_point: str, port: int, font: str) -> None:
+    _spool: Spool
+    _spool_uploader: SpoolUploader
+
+    _batcher: SwitchBatcher
+    _activity: IoActivity
+    _arrivals: ArrivalTracker
+
+    _snapshot: Snapshot
+    _stale: Set[str]
+
+    _evacuation_threshold: float
+    _evacuation_order: str
+    _space_low: bool
+    _evacuated: Set[str]
+
+    def __init__(self, state: State, block_storage: str, mount_point: str, port: int, font: str, spool: Spool=None, batch_grace: float=3, batch_debounce: float=1, quiet_period: float=3, activity_threshold: int=64 * 1024, arrival_window: float=5, media_block: str=None, media_mount: str=None, delta: DeltaStore=None, snapshot: Snapshot=None, evacuation_threshold: float=.1, evacuation_order: str="size") -> None:
         self._state = state
         self._block_storage = block_storage
         self._mount_point = mount_point
-        self._watchdog = Watchdog(self._update_filesystem, self._update_idle, self._handle_operations)
+        self._luns = self._create_luns(block_storage, mount_point, media_block, media_mount)
+        self._scan_count = 0
+        self._touched_slots = set()
+        self._delta = delta
+        self._activity = self._create_activity(activity_threshold)
+        self._watchdog = Watchdog(self._update_filesystem, self._update_idle, self._handle_operations, self._activity, quiet_period)
+        self._runner = BackgroundRunner(self._next_background, self._run_background, lambda op: self._lun(op.lun))
+        self._batcher = SwitchBatcher(batch_grace, batch_debounce)
+        self._arrivals = ArrivalTracker(arrival_window)
 
         self._address_port = port
         self._address_cycle = 0
@@ -32,18 +90,88 @@ class SystemBase():
 
         self._font = font
 
+        self._spool = spool
+        self._spool_uploader = None
+        if spool is not None:
+            self._spool_uploader = SpoolUploader(spool, state)
+            state.write("spool", spool.summary())
+
+        self._evacuation_threshold = evacuation_threshold
+        self._evacuation_order = evacuation_order
+        self._space_low = False
+        self._evacuated = set()
+
+        self._snapshot = snapshot
+        self._stale = set()
+        if snapshot is not None:
+            self._restore(snapshot.load())
+            state.register("operations", self._on_operations_update)
+
     def __enter__(self):
         self._set_mode(Mode.USB)
+        if self._activity is not None:
+            self._activity.start()
         self._watchdog.start()
+        self._runner.start()
+        if self._spool_uploader is not None:
+            self._spool_uploader.start()
+        if self._snapshot is not None:
+            self._snapshot.start()
         return self
 
     def __exit__(self, type, value, traceback):
         self._watchdog.kill()
+        self._runner.kill()
+        if self._spool_uploader is not None:
+            self._spool_uploader.kill()
+            self._spool_uploader.join()
+        self._runner.join()
         self._watchdog.join()
+        if self._activity is not None:
+            self._activity.kill()
+        if self._snapshot is not None:
+            self._snapshot.kill()
+            self._snapshot.join()
+            self._snapshot.flush()
         return True
 
-    def _update_saves(self, fs):
-        loc = os.path.join(self._mount_point, "PS4")
+    def _restore(self, data):
+        "Show the last known state right away, marked stale until every LUN was scanned again"
+        if data is None or data["filesystem"] is None:
+            return
+
+        self._arrivals.restore(data["arrivals"])
+        for op in data["operations"]:
+            self._state.queue_operation(op)
+
+        self._stale = {lun.name for lun in self._luns}
+        self._state.write("stale", True)
+        self._state.write("filesystem", data["filesystem"])
+        print("#" * 3, f"Restored snapshot with {len(data['filesystem']['slots'])} slots, {len(data['filesystem']['media'])} media files and {len(data['operations'])} operations", flush=True)
+
+    def _on_operations_update(self, ops: Dict[str, OperationBase]):
+        self._snapshot.update(operations=[op for op in ops.values() if op.persistent])
+
+    @staticmethod
+    def _create_luns(block_storage: str, mount_point: str, media_block: str, media_mount: str) -> List[Lun]:
+        if media_block is None:
+            return [Lun("storage", 0, block_storage, mount_point, [Lun.SAVES, Lun.MEDIA])]
+
+        # saves rarely change, the media image is where clips keep arriving
+        return [
+            Lun("saves", 0, block_storage, mount_point, [Lun.SAVES], scan_every=2),
+            Lun("media", 1, media_block, media_mount, [Lun.MEDIA]),
+        ]
+
+    def _lun(self, role: str) -> Lun:
+        return next(lun for lun in self._luns if lun.serves(role))
+
+    def _create_activity(self, threshold: int) -> IoActivity:
+        "Block counter based idle detection, None to fall back to comparing scans"
+        return None
+
+    def _update_saves(self, fs, mount_point: str):
+        loc = os.path.join(mount_point, "PS4")
         save_dirs = get_save_dirs(loc)
         fs["active_slot"] = get_active_slot(save_dirs)
 
@@ -55,15 +183,9 @@ class SystemBase():
             name, description = get_save_info(save_dir)
             last_access = os.stat(save_dir).st_atime_ns
 
-            fs["slots"][slot_id] = {
-                "name": name.strip(),
-                "description": description.strip(),
-                "last_access": last_access
-            }
-
-    def _update_media(self, fs):
-        current = self._state.read("filesystem")
+            fs["slots"][slot_id] = SlotRecord(name.strip(), description.strip(), last_access)
 
+    def _update_media(self, fs, mount_point: str, fresh: bool):
         def browse(directory):
             if not os.path.isdir(directory):
                 return
@@ -72,21 +194,15 @@ class SystemBase():
                 for media in os.listdir(game_dir):
                     file_path = os.path.join(game_dir, media)
                     data = os.stat(file_path)
-                    current_data = current["media"].get(media)
-                    is_active = True if current_data is None else current_data["last_access"] != data.st_atime_ns
+                    complete = self._arrivals.observe(media, file_path, data.st_size, data.st_mtime_ns, fresh)
 
-                    fs["media"][media] = {
-                        "last_access": data.st_atime_ns,
-                        "is_active": is_active,
-                        "size": data.st_size,
-                        "game": game,
-                        "path": file_path,
-                    }
+                    fs["media"][media] = MediaRecord(file_path, game, data.st_size, data.st_mtime_ns, not complete)
 
-        browse(os.path.join(self._mount_point, "PS5", "CREATE", "Video Clips"))
+        browse(os.path.join(mount_point, "PS5", "CREATE", "Video Clips"))
+        self._arrivals.retain(fs["media"])
 
     def _is_address_up_to_date(self, address: str):
-        loc = os.path.join(self._mount_point, "My Address")
+        loc = os.path.join(self._lun(Lun.MEDIA).mount_point, "My Address")
         if not os.path.exists(loc):
             return False
 
@@ -120,113 +236,561 @@ class SystemBase():
     def _on_address_update(self, current: str):
         self._state.queue_operation(UpdateAddress(current, self._address_port, self._font))
 
-    def _update_filesystem(self, remount=True) -> bool:
-        if remount:
-            # remount the fs to have it update
-            self._umount()._mount(readonly=True)
-
-        fs = {"slots": {}, "media": {}}
-        self._update_saves(fs)
-        self._update_media(fs)
-        self._update_address()
+    def _update_filesystem(self, remount=True, luns: List[Lun]=None) -> bool:
+        "Scan the LUNs whose scan is due, or the given ones, keeping the last results of the others"
+        if luns is None:
+            luns = [lun for lun in self._luns if lun.scan_due(self._scan_count)]
+            self._scan_count += 1
+
+        fs = self._state.read("filesystem")
+        with _SCAN.time(), TRACER.span("update_filesystem", "system", remount=remount, luns=[lun.name for lun in luns]):
+            for lun in luns:
+                # a read-write mount in manage mode is up to date anyway
+                current = lun.mode == Mode.MANAGE
+                if remount and not current and self._runner.claim(lun):
+                    # remount the fs to have it update, unless a background operation still reads it
+                    try:
+                        with _SCAN_PHASE.time(phase="remount"):
+                            self._umount(lun)._mount(lun, readonly=True)
+                        current = True
+                    finally:
+                        self._runner.release(lun)
+
+                if current:
+                    self._stale.discard(lun.name)
+                else:
+                    # the console may have written since the last remount, nothing is decided from this scan
+                    self._stale.add(lun.name)
+
+                if lun.serves(Lun.SAVES):
+                    fs["slots"] = {}
+                    with _SCAN_PHASE.time(phase="saves"):
+                        self._update_saves(fs, lun.mount_point)
+
+                if lun.serves(Lun.MEDIA):
+                    fs["media"] = {}
+                    with _SCAN_PHASE.time(phase="media"):
+                        self._update_media(fs, lun.mount_point, current)
+                        if current:
+                            # remounted just now, so this is what the console sees, unknown if that failed
+                            self._state.write("media_space", free_space(lun.mount_point) if self._is_mounted(lun) else None)
+                    with _SCAN_PHASE.time(phase="address"):
+                        self._update_address()
+
+        if any(lun.serves(Lun.MEDIA) and lun.name not in self._stale for lun in luns):
+            self._stage_media(fs["media"])
+            self._evacuate(fs["media"])
+
+        changed = self._state.write("filesystem", fs)
+        if self._snapshot is not None:
+            self._snapshot.update(filesystem=fs, arrivals=self._arrivals.export())
+
+        # restored results of LUNs not scanned yet, or of mounts not refreshed, are shown as such
+        self._state.write("stale", bool(self._stale))
 
         # return if the write happened, i.e. filesystem changed
-        return self._state.write("filesystem", fs) or self._block_storage_written_to()
+        return changed or self._block_storage_written_to()
+
+    def _stage_media(self, media):
+        "Evacuate media which fully arrived into the spool, if there is one"
+        if self._spool is None:
+            return
+
+        arrived = {name: data for name, data in media.items() if not data.is_active}
+        if not arrived or StageFiles.__name__ in self._state.read("operations"):
+            return
+
+        self._state.queue_operation(StageFiles(arrived, self._spool))
+
+    def _evacuate(self, media: Dict[str, MediaRecord]):
+        """
+        Upload media right away once the image runs full, whether or not
+        uploading automatically is enabled, so the console can keep recording.
+        """
+        space = self._state.read("media_space")
+        if space is None:
+            return # not measured before the first remount
+        _MEDIA_FREE.set(space["free"])
+
+        low = space["free"] < space["total"] * self._evacuation_threshold
+        if low != self._space_low:
+            print("#" * 3, f"Media image {'running full' if low else 'has room again'}, {format_bytes(space['free'])} of {format_bytes(space['total'])} free", flush=True)
+            self._space_low = low
+        self._evacuated.intersection_update(media)
+
+        drivers = self._state.read("drivers")
+        if not low or not drivers:
+            return
+
+        # a queued transfer merges with this one and is reordered, a running one must not send files twice
+        scheduled = set(self._evacuated)
+        running = self._state.running_operation(TransferFiles)
+        if running is not None:
+            scheduled.update(running.files)
+
+        # staged files leave the image on their own, the spool uploads them
+        if self._spool is not None:
+            scheduled.update(name for name in media if self._spool.contains(name))
+
+        arrived = {name: data for name, data in media.items() if not data.is_active and name not in scheduled}
+        if arrived:
+            self._evacuated.update(arrived)
+            self._state.queue_operation(TransferFiles(arrived, drivers, NullListener(), order=self._evacuation_order))
 
     def _update_idle(self, active: bool):
         self._state.write("fs_active", active)
 
+    def _run_operation(self, op: OperationBase) -> List[OperationBase]:
+        if op.persistent and self._snapshot is not None:
+            # popped from the queue, a restart must not run it again, like deleting a slot with the next one's number
+            try:
+                self._snapshot.flush()
+            except OSError as e:
+                print("#" * 3, f"Writing snapshot failed: {e}", flush=True)
+
+        print("#" * 3, f"Running operation: {op.overview}", flush=True)
+        with self._state.running(op), _OPERATION.time(operation=type(op).__name__), TRACER.span(type(op).__name__, "operation", overview=op.overview):
+            follow_up = op.run(self._lun(op.lun).mount_point)
+        _OPERATIONS.inc(operation=type(op).__name__)
+        # deleting a slot moves the ones after it up, earlier ids have to follow
+        self._touched_slots = {slot_id for slot_id in map(op.renumber_slot, self._touched_slots) if slot_id is not None}
+        self._state.update_operation(BackupSlots, lambda backup: backup.renumbered(op.renumber_slot))
+        if self._delta is not None:
+            self._delta.renumber(op.renumber_slot)
+        self._touched_slots.update(op.touched_slots)
+        return follow_up or []
+
+    def _run_batch(self, lun: Lun, ops: List[OperationBase]) -> bool:
+        "Returns whether any of the operations freed space"
+        freed = False
+        while ops:
+            freed = freed or ops[0].frees_space
+            op = ops.pop(0)
+            try:
+                follow_up = self._run_operation(op)
+            except Exception as e:
+                # the rest of the batch still runs and the LUN goes back to the console
+                print("#" * 3, f"Operation failed: {op.overview} {e}", flush=True)
+                continue
+
+            for op in follow_up:
+                if lun.serves(op.lun):
+                    ops.append(op)
+                else:
+                    # other LUN stays with the console, picked up next time
+                    self._state.queue_operation(op)
+        return freed
+
+    def _linger(self, lun: Lun) -> bool:
+        "Stay in manage mode while operations keep arriving within the debounce interval"
+        deadline = monotonic() + self._batcher.max_hold
+        quiet_since = monotonic()
+        freed = False
+
+        while monotonic() - quiet_since < self._batcher.debounce and monotonic() < deadline:
+            ops = self._state.pop_operations(requires_manage=True, roles=lun.roles)
+            if ops:
+                freed = self._run_batch(lun, sorted(ops.values(), key=lambda op: op.priority)) or freed
+                quiet_since = monotonic()
+            else:
+                sleep(.1)
+
+        return freed
+
+    def _next_background(self, claimed: Set[str]) -> OperationBase:
+        "Most important operation the console can keep its drive for, None if there is none"
+        for lun in self._luns:
+            # manage mode work on the LUN goes first, its follow-ups are what is left to upload
+            if lun.name in claimed or lun.mode == Mode.MANAGE or self._state.waiting_priority(lun.roles) is not None:
+                continue
+
+            op = self._state.pop_operation(requires_manage=False, roles=lun.roles)
+            if op is not None:
+                return op
+        return None
+
+    def _run_background(self, op: OperationBase):
+        lun = self._lun(op.lun)
+        # slot changes the user waits for must not sit behind a long upload
+        op.token.preempt_when(lambda: self._state.waiting_priority(lun.roles) == Priority.INTERACTIVE)
+
+        try:
+            follow_up = self._run_operation(op)
+        except Exception as e:
+            print("#" * 3, f"Operation failed: {op.overview} {e}", flush=True)
+            return
+
+        for follow in follow_up:
+            self._state.queue_operation(follow)
+
     def _handle_operations(self):
-        if len(self._state.read("operations")) == 0:
+        "Runs operations requiring manage mode, the ones which do not are left to the background runner"
+        if self._state.waiting_priority([Lun.SAVES, Lun.MEDIA]) is None:
+            self._batcher.due(False)
             return False
 
-        self._set_mode(Mode.MANAGE)
-
-        for op in self._state.pop_operations().values():
-            print("#" * 3, f"Running operation: {op.overview}", flush=True)
-            op.run(self._mount_point)
+        # let more operations join the batch, unless space has to be freed now
+        if not self._batcher.due(True) and not self._space_low:
+            return False
 
-        fs_changed = self._update_filesystem(remount=False)
-        self._set_mode(Mode.USB)
+        fs_changed = False
+        for lun in self._luns:
+            # still read by a background operation, preempted or done soon
+            if not self._runner.claim(lun):
+                continue
+
+            try:
+                # only the LUNs operations touch go offline, one after another
+                ops = self._state.pop_operations(requires_manage=True, roles=lun.roles)
+                if ops:
+                    fs_changed = self._round_trip(lun, sorted(ops.values(), key=lambda op: op.priority)) or fs_changed
+            except ModeSwitchError as e:
+                print("#" * 3, f"{e}, trying again later", flush=True)
+                # operations queued meanwhile are newer, they win
+                queued = self._state.read("operations")
+                for name, op in ops.items():
+                    if name not in queued:
+                        self._state.queue_operation(op)
+            finally:
+                self._runner.release(lun)
 
         return fs_changed
 
-    def _set_mode(self, mode: Mode):
-        if self._state.read("mode") == mode:
-            return
+    def _round_trip(self, lun: Lun, ops: List[OperationBase]) -> bool:
+        switch_start = monotonic()
+        self._set_mode(Mode.MANAGE, lun)
+        switch_time = monotonic() - switch_start
 
-        print("#" * 3, f"Setting mode to {mode}...", flush=True)
+        freed = self._run_batch(lun, ops)
+        freed = self._linger(lun) or freed
+        if freed:
+            self._reclaim(lun)
+        fs_changed = self._update_filesystem(remount=False, luns=[lun])
 
-        if mode == Mode.USB:
-            self._umount()._load_usb()._mount(readonly=True)
-        elif mode == Mode.MANAGE:
-            self._umount()._unload_usb()._mount(readonly=False)
-        else:
-            assert False, "Invalid mode"
+        switch_start = monotonic()
+        self._set_mode(Mode.USB, lun)
+        switch_time += monotonic() - switch_start
+
+        self._batcher.record_round_trip(switch_time)
+        self._state.write("mode_switches", self._batcher.switches)
+        print("#" * 3, f"Manage round trip of {lun.name} took {switch_time:.2f}s, expecting {self._batcher.expected_cost:.2f}s, {self._batcher.switches} mode switches so far", flush=True)
 
-        self._state.write("mode", mode)
+        self._schedule_backup()
+        return fs_changed
+
+    def _schedule_backup(self):
+        "Back up slots changed by the last batch, reading them once the console has the drive again"
+        slots, self._touched_slots = self._touched_slots, set()
+        if not slots or not self._state.options.backup_slots:
+            return
+
+        drivers = self._state.read("drivers")
+        if drivers:
+            self._state.queue_operation(BackupSlots(sorted(slots), drivers, self._delta))
+
+    def _set_mode(self, mode: Mode, lun: Lun=None):
+        "Switch a single LUN, or all of them"
+        for lun in self._luns if lun is None else [lun]:
+            if lun.mode == mode:
+                continue
+
+            print("#" * 3, f"Setting mode of {lun.name} to {mode}...", flush=True)
+
+            with _MODE_SWITCH.time(mode=mode.name), TRACER.span("set_mode", "system", mode=mode.name, lun=lun.name):
+                if mode == Mode.USB:
+                    self._umount(lun)._load_usb(lun)._mount(lun, readonly=True)
+                elif mode == Mode.MANAGE:
+                    self._umount(lun)
+                    try:
+                        self._unload_usb(lun)
+                    except ModeSwitchError:
+                        # the console keeps the drive, so does the read-only mount
+                        self._mount(lun, readonly=True)
+                        raise
+                    self._mount(lun, readonly=False)
+                else:
+                    assert False, "Invalid mode"
+
+            lun.mode = mode
+            _MODE_SWITCHES.inc(mode=mode.name)
+
+        # console only sees all of PSBerry when no LUN is being managed
+        managed = any(lun.mode == Mode.MANAGE for lun in self._luns)
+        self._state.write("lun_modes", {lun.name: lun.mode for lun in self._luns})
+        self._state.write("mode", Mode.MANAGE if managed else Mode.USB)
+
+    def _reclaim(self, lun: Lun):
+        "Hand space freed by deletes back to the SD card, while the LUN is mounted writable"
+        allocated = os.stat(lun.block_storage).st_blocks * 512
+        start = monotonic()
+
+        with _RECLAIM.time(lun=lun.name), TRACER.span("reclaim", "system", lun=lun.name):
+            trimmed = self._trim(lun)
+
+        reclaimed = max(allocated - os.stat(lun.block_storage).st_blocks * 512, 0)
+        _RECLAIMED.inc(reclaimed, lun=lun.name)
+        print("#" * 3, f"Trimmed {format_bytes(trimmed)} of {lun.name}, {format_bytes(reclaimed)} given back to the SD card in {monotonic() - start:.2f}s", flush=True)
+
+    def _trim(self, lun: Lun) -> int:
+        return 0
 
     def _block_storage_written_to(self) -> bool:
         return False
 
-    def _mount(self, readonly: bool) -> "SystemBase":
-        print(f"Mounted {self._block_storage} under {self._mount_point} as readonly={readonly}", flush=True)
+    def _mount(self, lun: Lun, readonly: bool) -> "SystemBase":
+        print(f"Mounted {lun.block_storage} under {lun.mount_point} as readonly={readonly}", flush=True)
         return self
 
-    def _umount(self) -> "SystemBase":
-        print(f"Unmounted {self._mount_point}", flush=True)
+    def _umount(self, lun: Lun) -> "SystemBase":
+        print(f"Unmounted {lun.mount_point}", flush=True)
         return self
 
-    def _load_usb(self) -> "SystemBase":
-        print(f"Loaded mass storage kernel module with file={self._block_storage}", flush=True)
+    def _is_mounted(self, lun: Lun) -> bool:
+        "Whether the image is mounted, the free space of the directory below would be measured otherwise"
+        return os.path.isdir(lun.mount_point)
+
+    def _load_usb(self, lun: Lun) -> "SystemBase":
+        print(f"Loaded mass storage LUN {lun.index} with file={lun.block_storage}", flush=True)
         return self
 
-    def _unload_usb(self) -> "SystemBase":
-        print(f"Unloaded mass storage kernel module", flush=True)
+    def _unload_usb(self, lun: Lun) -> "SystemBase":
+        print(f"Unloaded mass storage LUN {lun.index}", flush=True)
         return self
 
 class System(SystemBase):
-    _last_modify_time = 0
+    _modify_times: Dict[str, int]
+    _helper: HelperClient
+    _exposed: List[str]
+    _udc_class: str
+
+    def __init__(self, *args, helper_socket: str="/run/psberry-helper.sock", helper: HelperClient=None, udc_class: str="/sys/class/udc", **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._helper = helper or HelperClient(helper_socket)
+        self._modify_times = {}
+        self._exposed = None
+        self._udc_class = udc_class
 
-    def _block_storage_written_to(self) -> bool:
-        modify_time = os.stat(self._block_storage).st_ctime_ns
+    def __enter__(self):
+        self._helper.start()
+        return super(System, self).__enter__()
 
-        result = self._last_modify_time != modify_time
-        self._last_modify_time = modify_time
+    def __exit__(self, type, value, traceback):
+        result = super(System, self).__exit__(type, value, traceback)
+        self._helper.stop()
+        return result
+
+    def _privileged(self, func, *args, **kwargs):
+        # failures are reported but not fatal, same as a failing shell command
+        try:
+            return func(*args, **kwargs)
+        except HelperError as e:
+            print("#" * 3, f"Privileged helper failed: {e}", flush=True)
+            return None
+
+    def _create_activity(self, threshold: int) -> IoActivity:
+        # all images usually live on the same SD card, its counters cover every LUN
+        activity = IoActivity.for_file(self._block_storage, threshold, images=[lun.block_storage for lun in self._luns])
+        if activity is None:
+            print("#" * 3, f"No block counters found for {self._block_storage}, detecting idle storage by scanning", flush=True)
+        return activity
+
+    def _block_storage_written_to(self) -> bool:
+        result = False
+        for lun in self._luns:
+            modify_time = os.stat(lun.block_storage).st_ctime_ns
+            result = result or self._modify_times.get(lun.name) != modify_time
+            self._modify_times[lun.name] = modify_time
 
         return result
 
-    def _mount(self, readonly: bool) -> SystemBase:
-        mode = "ro" if readonly else "rw"
-        sp.run(f"sudo mount -o defaults,loop,{mode} {self._block_storage} {self._mount_point}", shell=True)
-        return super(System, self)._mount(readonly)
+    @traced("mount", "system")
+    def _mount(self, lun: Lun, readonly: bool) -> SystemBase:
+        self._privileged(self._helper.mount, str(lun.block_storage), str(lun.mount_point), readonly)
+        return super(System, self)._mount(lun, readonly)
+
+    def _trim(self, lun: Lun) -> int:
+        return self._privileged(self._helper.trim, str(lun.mount_point)) or 0
+
+    @traced("umount", "system")
+    def _umount(self, lun: Lun) -> SystemBase:
+        if os.path.ismount(lun.mount_point):
+            self._privileged(self._helper.umount, str(lun.mount_point))
+        return super(System, self)._umount(lun)
+
+    def _is_mounted(self, lun: Lun) -> bool:
+        # a failed mount leaves the bare directory on the SD card
+        return os.path.ismount(lun.mount_point)
+
+    def _lun_dir(self, lun: Lun) -> str:
+        "Attributes of the LUN as g_mass_storage exposes them below the UDC, None while it is not loaded with it"
+        found = glob.glob(os.path.join(self._udc_class, "*", "device", "gadget*", f"lun{lun.index}"))
+        return found[0] if found else None
+
+    def _reload_usb(self, files: List[str]):
+        """
+        Without the LUN in sysfs yet g_mass_storage is (re)loaded with
+        the ones to keep, ejected ones left empty, which the console
+        sees as every LUN going away.
+        """
+        if files == self._exposed:
+            return
 
-    def _umount(self) -> SystemBase:
-        if os.path.ismount(self._mount_point):
-            sp.run(f"sudo umount {self._mount_point}", shell=True)
-        return super(System, self)._umount()
+        # loaded at boot with fewer LUNs, parameters of a second modprobe would be ignored
+        if self._exposed is not None and any(self._exposed) or self._lun_dir(self._luns[0]) is not None:
+            self._privileged(self._helper.rmmod, "g_mass_storage")
 
-    def _load_usb(self) -> SystemBase:
-        sp.run(f"sudo modprobe g_mass_storage file=\"{self._block_storage}\" removable=1 ro=0 stall=0", shell=True)
-        return super(System, self)._load_usb()
+        if any(files):
+            count = len(files)
+            params = [f"file={','.join(files)}", f"removable={','.join(['1'] * count)}", f"ro={','.join(['0'] * count)}", "stall=0"]
+            self._privileged(self._helper.modprobe, "g_mass_storage", params + ([f"luns={count}"] if count > 1 else []))
 
-    def _unload_usb(self) -> SystemBase:
-        sp.run(f"sudo modprobe -r g_mass_storage", shell=True)
-        return super(System, self)._unload_usb()
+        self._exposed = files
 
-class SystemMock(SystemBase):
-    def _mount(self, readonly: bool) -> SystemBase:
-        sleep(.5)
-        return super(SystemMock, self)._mount(readonly)
+    def _expose(self, lun: Lun, file: str):
+        "Remember what the LUN was switched to, a later reload keeps it"
+        if self._exposed is not None:
+            self._exposed[self._luns.index(lun)] = file
 
-    def _umount(self) -> SystemBase:
-        sleep(.5)
-        return super(SystemMock, self)._umount()
+    @traced("load_usb", "system")
+    def _load_usb(self, lun: Lun) -> SystemBase:
+        lun_dir = self._lun_dir(lun)
+        if lun_dir is None:
+            self._reload_usb([str(l.block_storage) if l is lun or l.mode != Mode.MANAGE else "" for l in self._luns])
+        else:
+            # only this LUN sees a medium change, the others stay untouched
+            self._privileged(self._helper.write, os.path.join(lun_dir, "file"), str(lun.block_storage))
+            self._expose(lun, str(lun.block_storage))
+        return super(System, self)._load_usb(lun)
+
+    @traced("unload_usb", "system")
+    def _unload_usb(self, lun: Lun) -> SystemBase:
+        lun_dir = self._lun_dir(lun)
+        if lun_dir is None:
+            self._reload_usb([str(l.block_storage) if l is not lun and l.mode != Mode.MANAGE else "" for l in self._luns])
+            return super(System, self)._unload_usb(lun)
+
+        file = os.path.join(lun_dir, "file")
+        forced_eject = os.path.join(lun_dir, "forced_eject")
+        if os.path.exists(forced_eject):
+            # detaches even if the console holds the medium locked
+            self._privileged(self._helper.write, forced_eject, "1")
+        else:
+            self._privileged(self._helper.write, file, "")
+
+        # refused while the console holds the medium locked, mounting it read-write then would corrupt it
+        with open(file, "r") as f:
+            if f.read().strip():
+                raise ModeSwitchError(f"Console did not release {lun.name}")
+        self._expose(lun, "")
+        return super(System, self)._unload_usb(lun)
+
+class SystemConfigfs(System):
+    """
+    Sets up a mass storage gadget through configfs once, after which
+    mode switches only eject and reattach the LUN's backing file. The
+    console sees a medium change instead of the whole device going away,
+    and the other LUNs stay untouched.
+    """
+    _gadget: str
+    _function: str
+
+    _NAME = "psberry"
+    _FUNCTION = "mass_storage.usb0"
+
+    def __init__(self, *args, configfs: str="/sys/kernel/config", **kwargs) -> None:
+        if kwargs.get("helper") is None:
+            kwargs["helper"] = HelperClient(kwargs.pop("helper_socket", "/run/psberry-helper.sock"), configfs)
+
+        super().__init__(*args, **kwargs)
+        self._gadget = os.path.join(configfs, "usb_gadget", self._NAME)
+        self._function = os.path.join(self._gadget, "functions", self._FUNCTION)
 
-    def _load_usb(self) -> SystemBase:
-        sleep(.5)
-        return super(SystemMock, self)._load_usb()
+    def __enter__(self):
+        self._helper.start()
+        self._setup_gadget()
+        return super(System, self).__enter__()
+
+    def _lun_dir(self, lun: Lun) -> str:
+        return os.path.join(self._function, f"lun.{lun.index}")
+
+    def _write(self, relative: str, value: str):
+        self._helper.write(os.path.join(self._gadget, relative), value)
+
+    def _setup_gadget(self):
+        udc = os.path.join(self._gadget, "UDC")
+        if os.path.exists(udc):
+            with open(udc, "r") as f:
+                if f.read().strip():
+                    return # configured by a previous run, keep the console connected
+
+        # module loaded at boot holds the UDC
+        self._privileged(self._helper.rmmod, "g_mass_storage")
+        self._privileged(self._helper.modprobe, "libcomposite")
+
+        function = self._function
+        config = os.path.join(self._gadget, "configs", "c.1")
+
+        # configfs creates most of these by itself, existing ones are skipped
+        for directory in [
+            self._gadget,
+            os.path.join(self._gadget, "strings"),
+            os.path.join(self._gadget, "strings", "0x409"),
+            os.path.join(self._gadget, "functions"),
+            function,
+            *[self._lun_dir(lun) for lun in self._luns],
+            os.path.join(self._gadget, "configs"),
+            config,
+            os.path.join(config, "strings"),
+            os.path.join(config, "strings", "0x409"),
+        ]:
+            self._helper.mkdir(directory)
+
+        self._write("idVendor", "0x1d6b") # Linux Foundation
+        self._write("idProduct", "0x0104") # Multifunction Composite Gadget
+        self._write("bcdDevice", "0x0100")
+        self._write("bcdUSB", "0x0200")
+        self._write("strings/0x409/manufacturer", "PSBerry")
+        self._write("strings/0x409/product", "PSBerry USB Drive")
+        self._write("strings/0x409/serialnumber", "0123456789")
+        self._write("configs/c.1/strings/0x409/configuration", "Mass Storage")
+        self._write("configs/c.1/MaxPower", "250")
+        self._write(f"functions/{self._FUNCTION}/stall", "0")
+        for lun in self._luns:
+            self._write(f"functions/{self._FUNCTION}/lun.{lun.index}/removable", "1")
+            self._write(f"functions/{self._FUNCTION}/lun.{lun.index}/ro", "0")
+            self._write(f"functions/{self._FUNCTION}/lun.{lun.index}/cdrom", "0")
+        self._helper.symlink(function, os.path.join(config, self._FUNCTION))
+
+        udcs = sorted(os.listdir(self._udc_class)) if os.path.isdir(self._udc_class) else []
+        assert udcs, "No USB device controller available, is dwc2 enabled?"
+        self._write("UDC", udcs[0])
 
-    def _unload_usb(self) -> SystemBase:
-        sleep(.5)
-        return super(SystemMock, self)._unload_usb()
\ No newline at end of file
+class SystemMock(SystemBase):
+    _helper: HelperMock
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._helper = HelperMock()
+
+    @traced("mount", "system")
+    def _mount(self, lun: Lun, readonly: bool) -> SystemBase:
+        self._helper.mount(str(lun.block_storage), str(lun.mount_point), readonly)
+        return super(SystemMock, self)._mount(lun, readonly)
+
+    def _trim(self, lun: Lun) -> int:
+        return self._helper.trim(str(lun.mount_point))
+
+    @traced("umount", "system")
+    def _umount(self, lun: Lun) -> SystemBase:
+        self._helper.umount(str(lun.mount_point))
+        return super(SystemMock, self)._umount(lun)
+
+    @traced("load_usb", "system")
+    def _load_usb(self, lun: Lun) -> SystemBase:
+        self._helper.modprobe("g_mass_storage", [f"file={lun.block_storage}", "removable=1", "ro=0", "stall=0"])
+        return super(SystemMock, self)._load_usb(lun)
+
+    @traced("unload_usb", "system")
+    def _unload_usb(self, lun: Lun) -> SystemBase:
+        self._helper.rmmod("g_mass_storage")
+        return super(SystemMock, self)._unload_usb(lun)
@@ -0,0 +1,139 @@
+import os
+import glob
+import threading
+from time import monotonic, sleep
+from typing import Dict, List, Tuple
+
+_SECTOR = 512
+
+class IoActivity(threading.Thread):
+    """
+    Samples block layer counters of the device backing a file and keeps
+    track of when the read/write rate was last above a threshold. Unlike
+    file timestamps this also sees the console reading, though only
+    what is not already served from the page cache.
+
+    The device is shared with everything else on the SD card, so the
+    I/O PSBerry causes itself is taken out again, each byte once: reads
+    from the loop devices of its own mounts of the images, and writes
+    of this process, which include those through the mounts. The
+    console is served by the USB gadget straight from the image files,
+    neither of the two sees it.
+    """
+    _stat_file: str
+    _images: List[str]
+    _interval: float
+    _threshold: int
+    _should_run: bool
+    _failed: bool
+    _rate: float
+    _last_active: float
+    _credit: int
+    _credit_until: float
+
+    # dirty pages are written back within this long, see vm.dirty_expire_centisecs
+    _WRITEBACK = 30
+
+    def __init__(self, stat_file: str, threshold: int, interval: float=.25, images: List[str]=()) -> None:
+        self._stat_file = stat_file
+        self._images = [os.path.realpath(image) for image in images]
+        self._interval = interval
+        self._threshold = threshold
+        self._should_run = True
+        self._failed = False
+        self._rate = 0.0
+        self._last_active = monotonic()
+        self._credit = 0
+        self._credit_until = 0
+        threading.Thread.__init__(self, name="IoActivity", daemon=True)
+
+    @classmethod
+    def for_file(cls, path: str, threshold: int, interval: float=.25, images: List[str]=()) -> "IoActivity":
+        "Detector for the block device holding `path`, None if its counters are not available"
+        dev = os.stat(path).st_dev
+        stat_file = f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}/stat"
+        return cls(stat_file, threshold, interval, images) if os.path.isfile(stat_file) else None
+
+    @staticmethod
+    def _stat_bytes(stat_file: str) -> Tuple[int, int]:
+        "Bytes read and written"
+        with open(stat_file, "r") as f:
+            fields = f.read().split()
+        # sectors read is the 3rd field, sectors written the 7th
+        return int(fields[2]) * _SECTOR, int(fields[6]) * _SECTOR
+
+    def _own_written(self) -> int:
+        "Bytes PSBerry wrote so far, to its own files and through its mounts alike, None without task I/O accounting"
+        try:
+            with open("/proc/self/io", "r") as f:
+                counters = dict(line.split(": ") for line in f.read().splitlines())
+            return int(counters["write_bytes"])
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def _own_read(self) -> Dict[str, int]:
+        "Bytes read through the loop devices of PSBerry's mounts so far, by device"
+        # reads are not taken from /proc/self/io as well, those through a mount would count twice
+        own = {}
+        # attached by the helper on the first mount, looked up every time
+        for backing in glob.glob("/sys/block/loop*/loop/backing_file"):
+            try:
+                with open(backing, "r") as f:
+                    if f.read().strip() not in self._images:
+                        continue
+                device = os.path.dirname(os.path.dirname(backing))
+                own[device] = self._stat_bytes(os.path.join(device, "stat"))[0]
+            except OSError:
+                pass # detached meanwhile
+        return own
+
+    def _sample(self) -> Tuple[float, Tuple[int, int], Dict[str, int], int]:
+        return monotonic(), self._stat_bytes(self._stat_file), self._own_read(), self._own_written()
+
+    def kill(self):
+        self._should_run = False
+
+    def run(self):
+        try:
+            last_time, (last_read, last_written), last_own_read, last_own_written = self._sample()
+
+            while self._should_run:
+                sleep(self._interval)
+                now, (read, written), own_read, own_written = self._sample()
+
+                # only devices seen both times count, a loop device attached meanwhile starts from zero
+                own_read_bytes = sum(own_read[d] - last_own_read[d] for d in own_read.keys() & last_own_read.keys())
+                own_written_bytes = own_written - last_own_written if own_written is not None and last_own_written is not None else 0
+                if own_written_bytes:
+                    self._credit_until = now + self._WRITEBACK
+                elif now > self._credit_until:
+                    self._credit = 0
+
+                # writes are counted for the process right away but reach the card later, they are kept as credit until then
+                available = self._credit + own_written_bytes
+                device_written = written - last_written
+                self._credit = max(available - device_written, 0)
+                # each side only takes out what the card really saw of it
+                others = max(read - last_read - own_read_bytes, 0) + max(device_written - available, 0)
+                self._rate = others / max(now - last_time, 1e-6)
+                if self._rate > self._threshold:
+                    self._last_active = now
+
+                last_time, last_read, last_written, last_own_read, last_own_written = now, read, written, own_read, own_written
+        except Exception as e:
+            print("#" * 3, f"Sampling block counters failed, detecting idle storage by scanning: {e}", flush=True)
+            self._failed = True
+
+    @property
+    def failed(self) -> bool:
+        "True once the counters could not be read anymore"
+        return self._failed
+
+    @property
+    def rate(self) -> float:
+        "Bytes per second read and written by others than PSBerry over the last sample"
+        return self._rate
+
+    def quiet_for(self) -> float:
+        "Seconds since the rate was last above the threshold"
+        return monotonic() - self._last_active
@@ -0,0 +1,84 @@
+import queue
+import tarfile
+import threading
+from typing import Iterator
+
+class _Aborted(Exception):
+    pass
+
+class _QueueWriter():
+    "File-like end of tarfile, cutting its output into chunks handed over through a bounded queue"
+    _queue: queue.Queue
+    _chunk_size: int
+    _aborted: threading.Event
+    _buffer: bytearray
+
+    def __init__(self, chunks: queue.Queue, chunk_size: int, aborted: threading.Event) -> None:
+        self._queue = chunks
+        self._chunk_size = chunk_size
+        self._aborted = aborted
+        self._buffer = bytearray()
+
+    def put(self, item):
+        # the consumer might give up at any point, never block for good
+        while True:
+            if self._aborted.is_set():
+                raise _Aborted()
+            try:
+                self._queue.put(item, timeout=.5)
+                return
+            except queue.Full:
+                pass
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= self._chunk_size:
+            self.put(bytes(self._buffer[:self._chunk_size]))
+            del self._buffer[:self._chunk_size]
+        return len(data)
+
+    def flush(self):
+        if self._buffer:
+            self.put(bytes(self._buffer))
+            self._buffer.clear()
+
+_DONE = object()
+
+def stream_tar_gz(directory: str, arcname: str, chunk_size: int=64 * 1024, depth: int=4) -> Iterator[bytes]:
+    """
+    Yield a gzipped tar of the directory chunk by chunk. It is produced
+    by a thread at most `depth` chunks ahead, so memory use stays bounded
+    no matter the size of the directory and nothing touches the disk.
+    """
+    chunks = queue.Queue(maxsize=depth)
+    aborted = threading.Event()
+
+    def produce():
+        writer = _QueueWriter(chunks, chunk_size, aborted)
+        try:
+            with tarfile.open(fileobj=writer, mode="w|gz") as tar:
+                tar.add(directory, arcname=arcname)
+            writer.flush()
+            writer.put(_DONE)
+        except _Aborted:
+            pass
+        except Exception as e:
+            try:
+                writer.put(e)
+            except _Aborted:
+                pass
+
+    producer = threading.Thread(target=produce, name="TarProducer", daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            item = chunks.get()
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        aborted.set()
+        producer.join()
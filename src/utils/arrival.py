@@ -0,0 +1,117 @@
+import os
+import struct
+from time import monotonic
+from typing import Dict, Iterable
+
+def _mp4_complete(f, size: int) -> bool:
+    "Top level boxes have to cover the file exactly and include the `moov` index"
+    offset = 0
+    has_moov = False
+
+    while offset < size:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            return False
+
+        box_size, box_type = struct.unpack(">I4s", header)
+        if box_size == 1:
+            large = f.read(8)
+            if len(large) < 8:
+                return False
+            box_size = struct.unpack(">Q", large)[0]
+        elif box_size == 0:
+            box_size = size - offset # box extends to the end of the file
+
+        if box_size < 8:
+            return False
+
+        has_moov = has_moov or box_type == b"moov"
+        offset += box_size
+
+    return has_moov and offset == size
+
+def _jpeg_complete(f, size: int) -> bool:
+    "Ends with the end of image marker"
+    f.seek(max(size - 2, 0))
+    return f.read(2) == b"\xff\xd9"
+
+def _png_complete(f, size: int) -> bool:
+    "Ends with the IEND chunk, followed only by its CRC"
+    f.seek(max(size - 8, 0))
+    return f.read(4) == b"IEND"
+
+_CHECKS = {
+    ".mp4": _mp4_complete,
+    ".mov": _mp4_complete,
+    ".jpg": _jpeg_complete,
+    ".jpeg": _jpeg_complete,
+    ".png": _png_complete,
+}
+
+def is_format_complete(path: str, size: int) -> bool:
+    "Cheap structural check of known formats, unknown ones are assumed complete"
+    check = _CHECKS.get(os.path.splitext(path)[1].lower())
+    if check is None:
+        return True
+
+    try:
+        with open(path, "rb") as f:
+            return check(f, size)
+    except OSError:
+        return False
+
+class ArrivalTracker():
+    """
+    Remembers size and mtime of every file across scans. A file counts
+    as complete once both stayed the same for `window` seconds and its
+    format looks whole, so uploads never start on a half written clip.
+    Only scans of a freshly remounted image count, a mount left alone
+    shows every file as unchanged.
+    """
+    _window: float
+    _files: Dict[str, Dict]
+
+    _PATIENCE = 12
+
+    def __init__(self, window: float) -> None:
+        self._window = window
+        self._files = {}
+
+    def observe(self, name: str, path: str, size: int, modified: int, fresh: bool=True) -> bool:
+        "Record a scan of the file, returns whether it is complete"
+        now = monotonic()
+        entry = self._files.get(name)
+
+        if entry is None or entry["size"] != size or entry["modified"] != modified:
+            entry = self._files[name] = {"size": size, "modified": modified, "stable_since": now, "checked": None, "complete": False}
+
+        if not fresh:
+            # the clip may still be growing behind the mount, it has to stay the same from the next remount on
+            if not entry["complete"]:
+                entry["stable_since"] = now
+            return entry["complete"]
+
+        stable_for = now - entry["stable_since"]
+        if not entry["complete"] and stable_for >= self._window and (entry["checked"] is None or now - entry["checked"] >= self._window):
+            entry["checked"] = now
+            # files which never become whole, like a clip cut short by a crash, get through eventually
+            entry["complete"] = stable_for >= self._window * self._PATIENCE or is_format_complete(path, size)
+
+        return entry["complete"]
+
+    def export(self) -> Dict[str, Dict]:
+        "Files known to be complete, as monotonic times do not survive a restart"
+        return {name: {"size": e["size"], "modified": e["modified"]} for name, e in self._files.items() if e["complete"]}
+
+    def restore(self, files: Dict[str, Dict]):
+        "Take over complete files of an export, they stay complete unless they changed since"
+        now = monotonic()
+        for name, e in files.items():
+            self._files[name] = {"size": e["size"], "modified": e["modified"], "stable_since": now, "checked": now, "complete": True}
+
+    def retain(self, names: Iterable[str]):
+        "Forget files which are gone"
+        names = set(names)
+        for name in [n for n in self._files if n not in names]:
+            del self._files[name]
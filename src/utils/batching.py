@@ -0,0 +1,62 @@
+from time import monotonic
+
+class SwitchBatcher():
+    """
+    Decides when queued operations are worth a manage mode round trip.
+    After the first operation is queued, waits for a grace period so
+    more can join the batch, but never longer than a round trip has
+    been measured to cost, because then paying another one is cheaper.
+    """
+    _grace: float
+    _debounce: float
+    _max_hold: float
+    _first_seen: float
+    _expected_cost: float
+    _switches: int
+
+    _SMOOTHING = .3
+
+    def __init__(self, grace: float, debounce: float, max_hold: float=30) -> None:
+        self._grace = grace
+        self._debounce = debounce
+        self._max_hold = max_hold
+        self._first_seen = None
+        self._expected_cost = None
+        self._switches = 0
+
+    @property
+    def debounce(self) -> float:
+        return self._debounce
+
+    @property
+    def max_hold(self) -> float:
+        return self._max_hold
+
+    @property
+    def expected_cost(self) -> float:
+        "Expected seconds of a USB->MANAGE->USB round trip, None until measured"
+        return self._expected_cost
+
+    @property
+    def switches(self) -> int:
+        return self._switches
+
+    def due(self, has_operations: bool) -> bool:
+        if not has_operations:
+            self._first_seen = None
+            return False
+
+        now = monotonic()
+        if self._first_seen is None:
+            self._first_seen = now
+
+        wait = self._grace if self._expected_cost is None else min(self._grace, self._expected_cost)
+        return now - self._first_seen >= wait
+
+    def record_round_trip(self, duration: float):
+        self._first_seen = None
+        self._switches += 2
+        if self._expected_cost is None:
+            self._expected_cost = duration
+        else:
+            self._expected_cost += self._SMOOTHING * (duration - self._expected_cost)
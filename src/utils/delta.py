@@ -0,0 +1,227 @@
+import os
+import json
+import errno
+import hashlib
+import threading
+from typing import Dict, Iterator, List, Set
+
+def content_chunks(f, size: int=64 * 1024) -> Iterator[bytes]:
+    """
+    Split a file into chunks of 64KiB. The console rewrites save data
+    in place, blocks it did not touch stay where they are, so unchanged
+    parts of a blob are never resent.
+    """
+    while chunk := f.read(size):
+        yield chunk
+
+def _chunk_name(digest: str) -> str:
+    return f"chunk-{digest}"
+
+def _manifest_name(key: str, stamp: str) -> str:
+    return f"manifest-{key}-{stamp}.json"
+
+def _index_name(key: str) -> str:
+    return f"manifests-{key}.json"
+
+def _remote_index(driver, key: str) -> List[str]:
+    "Manifest names listed on the remote, empty if none were backed up there yet"
+    try:
+        return json.loads(driver.download(_index_name(key)))
+    except OSError as e:
+        if isinstance(e, FileNotFoundError) or e.errno == errno.ENOENT:
+            return []
+        raise
+
+def remote_versions(driver, store: "DeltaStore", slot_id: str) -> List[str]:
+    """
+    Manifest names of a slot on the remote, oldest first. Remotes cannot
+    be listed, every backup uploads the list of all of them instead, so
+    this also finds versions the local store does not know about.
+    """
+    versions = set(store.versions(driver.destination, slot_id))
+    if not driver.available:
+        return sorted(versions) # not kept waiting on a remote which keeps failing
+    try:
+        versions.update(_remote_index(driver, store.slot_key(slot_id)))
+    except Exception as e:
+        print("#" * 3, f"Listing backups of {slot_id} on {driver.destination} failed, showing known ones: {e}", flush=True)
+    return sorted(versions)
+
+class DeltaStore():
+    """
+    Local copy of the manifests stored on every remote, and the chunks
+    each remote already has. Remotes hold flat `chunk-<sha256>` files
+    shared by all versions, plus one manifest per backed up version.
+    Manifests are named by a key kept for each slot, deleting a slot
+    renumbers the ones after it but they keep their backups.
+    """
+    _lock: threading.Lock
+    _root: str
+    _chunks: Dict[str, Set[str]]
+    _slots: Dict[str, str]
+
+    _CHUNKS = "chunks.json"
+    _SLOTS = "slots.json"
+
+    def __init__(self, root: str) -> None:
+        self._lock = threading.Lock()
+        self._root = str(root)
+        self._chunks = {}
+        os.makedirs(self._root, exist_ok=True)
+
+        self._slots = {}
+        path = os.path.join(self._root, self._SLOTS)
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                self._slots = json.load(f)
+
+    def _dir(self, destination: str) -> str:
+        path = os.path.join(self._root, hashlib.sha1(destination.encode()).hexdigest()[:16])
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def _write(self, path: str, data):
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    def slot_key(self, slot_id: str) -> str:
+        "Key the backups of a slot are named by, new slots get a fresh one"
+        with self._lock:
+            if slot_id not in self._slots:
+                self._slots[slot_id] = os.urandom(8).hex()
+                self._write(os.path.join(self._root, self._SLOTS), self._slots)
+            return self._slots[slot_id]
+
+    def renumber(self, renumber_slot):
+        "Move the keys along with the slots after a deletion, the backups of a deleted slot are no longer listed"
+        with self._lock:
+            slots = {renumber_slot(slot_id): key for slot_id, key in self._slots.items()}
+            slots.pop(None, None)
+            if slots != self._slots:
+                self._slots = slots
+                self._write(os.path.join(self._root, self._SLOTS), self._slots)
+
+    def known_chunks(self, destination: str) -> Set[str]:
+        with self._lock:
+            if destination not in self._chunks:
+                path = os.path.join(self._dir(destination), self._CHUNKS)
+                self._chunks[destination] = set()
+                if os.path.isfile(path):
+                    with open(path, "r") as f:
+                        self._chunks[destination] = set(json.load(f))
+            return set(self._chunks[destination])
+
+    def add_chunks(self, destination: str, digests: Set[str]):
+        self.known_chunks(destination)
+        with self._lock:
+            self._chunks[destination] |= digests
+            self._write(os.path.join(self._dir(destination), self._CHUNKS), sorted(self._chunks[destination]))
+
+    def versions(self, destination: str, slot_id: str) -> List[str]:
+        "Manifest names of a slot, oldest first"
+        prefix = _manifest_name(self.slot_key(slot_id), "")[:-len(".json")]
+        return sorted(n for n in os.listdir(self._dir(destination)) if n.startswith(prefix) and n.endswith(".json"))
+
+    def load(self, destination: str, name: str) -> Dict:
+        path = os.path.join(self._dir(destination), name)
+        if not os.path.isfile(path):
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def save(self, destination: str, name: str, manifest: Dict):
+        with self._lock:
+            self._write(os.path.join(self._dir(destination), name), manifest)
+
+    def latest(self, destination: str, slot_id: str) -> Dict:
+        versions = self.versions(destination, slot_id)
+        return self.load(destination, versions[-1]) if versions else None
+
+def backup_slot(driver, store: DeltaStore, directory: str, slot_id: str, stamp: str, token=None) -> bool:
+    """
+    Send the chunks the remote does not have yet, then the manifest.
+    Files with the same size and mtime as in the last manifest are not
+    even read. The token is checked between chunks.
+    """
+    destination = driver.destination
+    key = store.slot_key(slot_id)
+    previous = store.latest(destination, slot_id) or {"files": {}}
+    known = store.known_chunks(destination)
+    sent = set()
+    files = {}
+
+    try:
+        for root, _, names in os.walk(directory):
+            for name in sorted(names):
+                path = os.path.join(root, name)
+                relative = os.path.relpath(path, directory)
+                stat = os.stat(path)
+
+                entry = previous["files"].get(relative)
+                if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+                    files[relative] = entry
+                    continue
+
+                digests = []
+                with open(path, "rb") as f:
+                    for chunk in content_chunks(f):
+                        digest = hashlib.sha256(chunk).hexdigest()
+                        if digest not in known and digest not in sent:
+                            if token is not None:
+                                token.check()
+                            if not driver.upload_stream(iter([chunk]), _chunk_name(digest)):
+                                return False
+                            sent.add(digest)
+                        digests.append(digest)
+
+                files[relative] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "chunks": digests}
+    finally:
+        # chunks which made it are not sent again, even if this backup failed
+        if sent:
+            store.add_chunks(destination, sent)
+
+    manifest = {"slot": slot_id, "created": stamp, "files": files}
+    name = _manifest_name(key, stamp)
+    if not driver.upload_stream(iter([json.dumps(manifest).encode()]), name):
+        return False
+
+    store.save(destination, name, manifest)
+
+    # read back first, a list the remote cannot be asked for must not be replaced by a shorter one
+    try:
+        index = set(_remote_index(driver, key))
+    except Exception as e:
+        print("#" * 3, f"Reading the backups of {slot_id} on {destination} failed: {e}", flush=True)
+        return False
+    index |= set(store.versions(destination, slot_id))
+    return driver.upload_stream(iter([json.dumps(sorted(index)).encode()]), _index_name(key))
+
+def restore_slot(driver, store: DeltaStore, name: str, directory: str):
+    "Rebuild the directory as recorded in the manifest, fetching it from the remote if not known locally"
+    manifest = store.load(driver.destination, name)
+    if manifest is None:
+        manifest = json.loads(driver.download(name))
+
+    os.makedirs(directory, exist_ok=True)
+
+    for relative, entry in manifest["files"].items():
+        path = os.path.join(directory, relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        partial = path + ".part"
+        with open(partial, "wb") as f:
+            for digest in entry["chunks"]:
+                chunk = driver.download(_chunk_name(digest))
+                if hashlib.sha256(chunk).hexdigest() != digest:
+                    raise IOError(f"Chunk {digest} of {relative} is corrupted on {driver.destination}")
+                f.write(chunk)
+        os.replace(partial, path)
+
+    # files created after the version was taken
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            if os.path.relpath(path, directory) not in manifest["files"]:
+                os.remove(path)
@@ -0,0 +1,34 @@
+from typing import List
+from utils.mode import Mode
+
+class Lun():
+    """
+    Backing image exposed to the console as a logical unit of its own.
+    Roles tell which part of the console's tree lives on it, so saves
+    and media can be separate images taken offline independently.
+    """
+    SAVES = "saves"
+    MEDIA = "media"
+
+    name: str
+    index: int
+    block_storage: str
+    mount_point: str
+    roles: List[str]
+    scan_every: int
+    mode: Mode
+
+    def __init__(self, name: str, index: int, block_storage: str, mount_point: str, roles: List[str], scan_every: int=1) -> None:
+        self.name = name
+        self.index = index
+        self.block_storage = block_storage
+        self.mount_point = mount_point
+        self.roles = roles
+        self.scan_every = scan_every
+        self.mode = None # unknown until first set
+
+    def serves(self, role: str) -> bool:
+        return role in self.roles
+
+    def scan_due(self, scan: int) -> bool:
+        return scan % self.scan_every == 0
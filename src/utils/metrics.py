@@ -0,0 +1,152 @@
+import threading
+from time import perf_counter
+from bisect import bisect_left
+from typing import Dict, List, Tuple
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+def _format_labels(names: Tuple[str], values: Tuple, extra: str="") -> str:
+    labels = [f"{n}=\"{_escape(v)}\"" for n, v in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+class _Metric():
+    _lock: threading.Lock
+    _name: str
+    _help: str
+    _labels: Tuple[str]
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: List[str]) -> None:
+        self._lock = threading.Lock()
+        self._name = name
+        self._help = help
+        self._labels = tuple(labels)
+
+    def _key(self, labels: Dict) -> Tuple:
+        assert set(labels) == set(self._labels), f"{self._name} expects labels {self._labels}"
+        return tuple(labels[n] for n in self._labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self._name} {self._help}", f"# TYPE {self._name} {self.type}"]
+        with self._lock:
+            lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        return []
+
+class Counter(_Metric):
+    _values: Dict[Tuple, float]
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: List[str]) -> None:
+        super().__init__(name, help, labels)
+        self._values = {}
+
+    def inc(self, amount: float=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> List[str]:
+        return [f"{self._name}{_format_labels(self._labels, k)} {v}" for k, v in self._values.items()]
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class _Timer():
+    def __init__(self, histogram: "Histogram", labels: Dict) -> None:
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.elapsed = perf_counter() - self._start
+        self._histogram.observe(self.elapsed, **self._labels)
+
+class Histogram(_Metric):
+    _buckets: Tuple[float]
+    _counts: Dict[Tuple, List[int]]
+    _sums: Dict[Tuple, float]
+
+    type = "histogram"
+
+    DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self, name: str, help: str, labels: List[str], buckets: Tuple[float]=DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self._buckets = tuple(sorted(buckets))
+        self._counts = {}
+        self._sums = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * (len(self._buckets) + 1))
+            counts[bisect_left(self._buckets, value)] += 1
+            self._sums[key] = self._sums.get(key, 0.0) + value
+
+    def time(self, **labels) -> _Timer:
+        "Observe duration of the `with` block"
+        return _Timer(self, labels)
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self._buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                labels = _format_labels(self._labels, key, "le=\"" + le + "\"")
+                lines.append(f"{self._name}_bucket{labels} {cumulative}")
+            lines.append(f"{self._name}_sum{_format_labels(self._labels, key)} {self._sums[key]}")
+            lines.append(f"{self._name}_count{_format_labels(self._labels, key)} {cumulative}")
+        return lines
+
+class Registry():
+    _lock: threading.Lock
+    _metrics: Dict[str, _Metric]
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get(self, cls, name: str, *args, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, *args, **kwargs)
+            metric = self._metrics[name]
+        assert type(metric) is cls, f"Metric {name} already registered as {metric.type}"
+        return metric
+
+    def counter(self, name: str, help: str, labels: List[str]=[]) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str, labels: List[str]=[]) -> Gauge:
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name: str, help: str, labels: List[str]=[], buckets: Tuple[float]=Histogram.DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def render(self) -> str:
+        "Prometheus text exposition format"
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for m in metrics for line in m.render()) + "\n"
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
@@ -0,0 +1,35 @@
+import os
+from collections import Counter
+from typing import Dict, List
+from utils.records import MediaRecord
+
+def _by_size(media: Dict[str, MediaRecord]) -> List[str]:
+    return sorted(media, key=lambda name: -media[name].size)
+
+def _by_age(media: Dict[str, MediaRecord]) -> List[str]:
+    return sorted(media, key=lambda name: media[name].modified)
+
+def _by_game(media: Dict[str, MediaRecord]) -> List[str]:
+    # the game hogging the most space first, its largest clips first
+    totals = Counter()
+    for data in media.values():
+        totals[data.game] += data.size
+    return sorted(media, key=lambda name: (-totals[media[name].game], -media[name].size))
+
+EVACUATION_ORDERS = {
+    "size": _by_size,
+    "age": _by_age,
+    "game": _by_game,
+}
+
+def evacuation_order(media: Dict[str, MediaRecord], order: str) -> List[str]:
+    "Names in the order freeing space soonest according to the policy, arrival order for None"
+    return list(media) if order is None else EVACUATION_ORDERS[order](media)
+
+def free_space(mount_point: str) -> Dict[str, int]:
+    "Free and total bytes of the mounted image, as of its last mount, None if it cannot be told"
+    try:
+        stat = os.statvfs(mount_point)
+    except OSError:
+        return None
+    return {"free": stat.f_bavail * stat.f_frsize, "total": stat.f_blocks * stat.f_frsize}
@@ -0,0 +1,52 @@
+import threading
+from typing import Iterable
+from utils.state import State
+
+# listeners of several transfers update the same field
+_lock = threading.Lock()
+
+class TransferProgress():
+    """
+    Listener of TransferFiles keeping the progress of every file in the
+    "transfers" field of State, for clients other than the media list.
+    Calls are passed on to `listener`, like the media list, if given.
+    """
+    _state: State
+
+    def __init__(self, state: State, listener=None) -> None:
+        self._state = state
+        self._listener = listener
+
+    def _update(self, filename: str, **changes):
+        with _lock:
+            transfers = self._state.read("transfers") or {}
+            progress = transfers.setdefault(filename, {"size": 0, "done": 0, "action": ""})
+            # chunks are small, clients only hear about whole percents
+            before = progress["done"] * 100 // max(progress["size"], 1)
+            progress.update(changes)
+            if changes.keys() == {"done"} and progress["done"] * 100 // max(progress["size"], 1) == before:
+                return
+            self._state.write("transfers", transfers)
+
+    def set_media_size(self, filename: str, size: int):
+        if self._listener is not None:
+            self._listener.set_media_size(filename, size)
+        self._update(filename, size=size, done=0)
+
+    def set_media_progress(self, filename: str, cur: int):
+        if self._listener is not None:
+            self._listener.set_media_progress(filename, cur)
+        self._update(filename, done=cur)
+
+    def set_media_action(self, filename: str, action: str):
+        if self._listener is not None:
+            self._listener.set_media_action(filename, action)
+        self._update(filename, action=action)
+
+def forget_transfers(state: State, present: Iterable[str]):
+    "Drop the progress of files which are gone, uploaded and removed or deleted"
+    with _lock:
+        transfers = state.read("transfers") or {}
+        present = set(present)
+        if transfers.keys() - present:
+            state.write("transfers", {name: progress for name, progress in transfers.items() if name in present})
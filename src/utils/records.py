@@ -0,0 +1,72 @@
+import sys
+
+class SlotRecord():
+    """
+    Save slot as found by a scan. Records are never changed once made,
+    a scan makes new ones, so copies of the filesystem share them.
+    """
+    __slots__ = ("name", "description", "last_access")
+
+    name: str
+    description: str
+    last_access: int
+
+    def __init__(self, name: str, description: str, last_access: int) -> None:
+        self.name = name
+        self.description = description
+        self.last_access = last_access
+
+    def _key(self):
+        return (self.name, self.description, self.last_access)
+
+    def __eq__(self, other) -> bool:
+        return self is other or (type(other) is SlotRecord and self._key() == other._key())
+
+    def __hash__(self) -> int:
+        return hash(self._key())
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __repr__(self) -> str:
+        return f"SlotRecord{self._key()}"
+
+class MediaRecord():
+    "Media file as found by a scan, shared like slot records"
+    __slots__ = ("path", "game", "size", "modified", "is_active")
+
+    path: str
+    game: str
+    size: int
+    modified: int
+    is_active: bool
+
+    def __init__(self, path: str, game: str, size: int, modified: int, is_active: bool) -> None:
+        self.path = path
+        # thousands of clips share a handful of games
+        self.game = sys.intern(game)
+        self.size = size
+        self.modified = modified
+        self.is_active = is_active
+
+    def _key(self):
+        return (self.modified, self.size, self.is_active, self.path, self.game)
+
+    def __eq__(self, other) -> bool:
+        # mtime and size differ first when anything changed
+        return self is other or (type(other) is MediaRecord and self._key() == other._key())
+
+    def __hash__(self) -> int:
+        return hash(self._key())
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __setstate__(self, state):
+        # game names are interned again when unpickled from a snapshot
+        _, slots = state
+        for k, v in slots.items():
+            object.__setattr__(self, k, sys.intern(v) if k == "game" else v)
+
+    def __repr__(self) -> str:
+        return f"MediaRecord{self._key()}"
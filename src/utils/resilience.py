@@ -0,0 +1,113 @@
+import random
+import threading
+from time import monotonic, sleep
+from typing import Callable, Iterator
+from utils.metrics import REGISTRY
+
+_OPEN = REGISTRY.gauge("psberry_remote_circuit_open", "Whether uploads to a remote are stopped until it recovers.", ["remote"])
+_TRIPS = REGISTRY.counter("psberry_remote_circuit_trips_total", "Number of times a remote was given up on.", ["remote"])
+
+class SourceGone(Exception):
+    "File to upload is not there anymore, a failure of that file and not of the remote"
+    pass
+
+class RetryPolicy():
+    """
+    How often and how patiently a failed upload is attempted again.
+    Delays grow exponentially and are jittered, so remotes coming back
+    are not hit by every client at the same moment.
+    """
+    attempts: int
+    base: float
+    cap: float
+
+    def __init__(self, attempts: int=3, base: float=1, cap: float=30) -> None:
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+
+    def delays(self) -> Iterator[float]:
+        "Seconds to wait before each attempt, the first one starts right away"
+        yield 0
+        for attempt in range(1, self.attempts):
+            # "equal jitter", at least half of the exponential delay
+            delay = min(self.cap, self.base * 2 ** (attempt - 1))
+            yield delay / 2 + random.uniform(0, delay / 2)
+
+class CircuitBreaker():
+    """
+    Stops uploads to a remote after `threshold` uploads in a row failed
+    even with retries. A background probe checks the remote with growing
+    intervals and closes the breaker again once it answers.
+    """
+    _remote: str
+    _lock: threading.Lock
+    _threshold: int
+    _failures: int
+    _open: bool
+    _opened_at: float
+
+    _PROBE_BASE = 10
+    _PROBE_CAP = 300
+
+    def __init__(self, remote: str, threshold: int=3) -> None:
+        self._remote = remote
+        self._lock = threading.Lock()
+        self._threshold = threshold
+        self._failures = 0
+        self._open = False
+        self._opened_at = 0
+
+    @property
+    def is_open(self) -> bool:
+        return self._open
+
+    def allow(self) -> bool:
+        return not self._open
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+
+    def record_failure(self, probe: Callable[[], bool]):
+        "Count a failed upload, `probe` tells whether the remote is healthy again once tripped"
+        with self._lock:
+            self._failures += 1
+            if self._open or self._failures < self._threshold:
+                return
+            self._open = True
+            self._opened_at = monotonic()
+
+        print("#" * 3, f"Giving up on {self._remote} after {self._failures} failed uploads, probing it in the background", flush=True)
+        _OPEN.set(1, remote=self._remote)
+        _TRIPS.inc(remote=self._remote)
+        threading.Thread(target=self._probe, args=(probe,), name=f"Probe {self._remote}", daemon=True).start()
+
+    def _probe(self, probe: Callable[[], bool]):
+        interval = self._PROBE_BASE
+        while True:
+            sleep(interval * random.uniform(.8, 1.2))
+            try:
+                healthy = probe()
+            except Exception:
+                healthy = False
+            if healthy:
+                break
+            interval = min(interval * 2, self._PROBE_CAP)
+
+        with self._lock:
+            self._open = False
+            self._failures = 0
+        _OPEN.set(0, remote=self._remote)
+        print("#" * 3, f"{self._remote} is back after {monotonic() - self._opened_at:.0f}s", flush=True)
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def circuit_breaker(remote: str) -> CircuitBreaker:
+    "Breaker of a single remote, looked up by destination like its rate limit"
+    with _breakers_lock:
+        breaker = _breakers.get(remote)
+        if breaker is None:
+            breaker = _breakers[remote] = CircuitBreaker(remote)
+        return breaker
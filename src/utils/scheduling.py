@@ -0,0 +1,124 @@
+import threading
+from enum import IntEnum
+from time import monotonic, sleep
+from typing import Callable, Set
+
+class Priority(IntEnum):
+    "Lower runs first, and interactive operations preempt background ones"
+    INTERACTIVE = 0
+    NORMAL = 1
+    BACKGROUND = 2
+
+class Cancelled(Exception):
+    pass
+
+class Preempted(Exception):
+    pass
+
+class CancelToken():
+    """
+    Handed to a running operation and the drivers it calls, which check
+    it at safe points like chunk boundaries. The whole operation or
+    single items of it, like one media file, can be cancelled. Preemption
+    means the operation stops early and leaves the rest for later.
+    """
+    _lock: threading.Lock
+    _cancelled: bool
+    _keys: Set[str]
+    _preempt: Callable[[], bool]
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._keys = set()
+        self._preempt = None
+
+    def cancel(self, key: str=None):
+        with self._lock:
+            if key is None:
+                self._cancelled = True
+            else:
+                self._keys.add(key)
+
+    def is_cancelled(self, key: str=None) -> bool:
+        with self._lock:
+            return self._cancelled or key in self._keys
+
+    def preempt_when(self, condition: Callable[[], bool]):
+        self._preempt = condition
+
+    def is_preempted(self) -> bool:
+        return self._preempt is not None and self._preempt()
+
+    def check(self, key: str=None):
+        "Raise if the operation, or the given item of it, should stop here"
+        if self.is_cancelled(key):
+            raise Cancelled(key)
+        if self.is_preempted():
+            raise Preempted(key)
+
+    def wait(self, seconds: float, key: str=None):
+        "Sleep, checking the token every now and then"
+        deadline = monotonic() + seconds
+        while True:
+            self.check(key)
+            left = deadline - monotonic()
+            if left <= 0:
+                return
+            sleep(min(left, .25))
+
+class BackgroundRunner(threading.Thread):
+    """
+    Runs operations which do not need manage mode next to the watchdog,
+    one at a time and most important first. A LUN claimed for a manage
+    round trip or a remount gets no new work until it is released.
+    """
+    _lock: threading.Lock
+    _should_run: bool
+    _current: object
+    _claimed: Set[str]
+
+    _INTERVAL = .5
+
+    def __init__(self, next_operation: Callable, run_operation: Callable, lun_of: Callable) -> None:
+        self._lock = threading.Lock()
+        self._should_run = True
+        self._current = None
+        self._claimed = set()
+        self._next_operation = next_operation
+        self._run_operation = run_operation
+        self._lun_of = lun_of
+        threading.Thread.__init__(self, name="BackgroundRunner")
+
+    def kill(self):
+        self._should_run = False
+        with self._lock:
+            if self._current is not None:
+                self._current.token.cancel()
+
+    def claim(self, lun) -> bool:
+        "Reserve the LUN for manage mode, fails while an operation still works on it"
+        with self._lock:
+            if self._current is not None and self._lun_of(self._current) is lun:
+                return False
+            self._claimed.add(lun.name)
+            return True
+
+    def release(self, lun):
+        with self._lock:
+            self._claimed.discard(lun.name)
+
+    def run(self):
+        while self._should_run:
+            with self._lock:
+                self._current = self._next_operation(self._claimed)
+
+            if self._current is None:
+                sleep(self._INTERVAL)
+                continue
+
+            try:
+                self._run_operation(self._current)
+            finally:
+                with self._lock:
+                    self._current = None
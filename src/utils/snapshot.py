@@ -0,0 +1,113 @@
+import os
+import zlib
+import pickle
+import hashlib
+import threading
+from typing import Dict
+
+class Snapshot(threading.Thread):
+    """
+    Last known filesystem, media arrivals and queued operations on disk,
+    so the UI has something to show right after a restart. Written by a
+    thread at most every `interval` seconds, and only if it changed.
+    Operations which must not run twice flush it themselves once popped.
+    """
+    _path: str
+    _interval: float
+    _lock: threading.Lock
+    _flush_lock: threading.Lock
+    _wake: threading.Event
+    _should_run: bool
+    _parts: Dict
+    _dirty: bool
+    _digest: bytes
+
+    _VERSION = 2
+
+    def __init__(self, path: str, interval: float=10) -> None:
+        self._path = str(path)
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._should_run = True
+        self._parts = {"filesystem": None, "arrivals": {}, "operations": []}
+        self._dirty = False
+        self._digest = None
+        threading.Thread.__init__(self, name="Snapshot", daemon=True)
+
+    def load(self) -> Dict:
+        "Contents of the last snapshot, None if there is none usable"
+        try:
+            with open(self._path, "rb") as f:
+                data = pickle.loads(zlib.decompress(f.read()))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print("#" * 3, f"Ignoring unreadable snapshot {self._path}: {e}", flush=True)
+            return None
+
+        if data.get("version") != self._VERSION:
+            return None
+
+        operations = []
+        for blob in data["operations"]:
+            try:
+                operations.append(pickle.loads(blob))
+            except Exception as e:
+                # operation class changed or went away since
+                print("#" * 3, f"Dropping operation from snapshot: {e}", flush=True)
+
+        with self._lock:
+            self._parts = {"filesystem": data["filesystem"], "arrivals": data["arrivals"], "operations": data["operations"]}
+            self._digest = hashlib.sha1(self._encode()).digest()
+        return dict(self._parts, operations=operations)
+
+    def update(self, filesystem: Dict=None, arrivals: Dict=None, operations: list=None):
+        "Replace parts of the snapshot, written out with the next flush"
+        with self._lock:
+            if filesystem is not None:
+                self._parts["filesystem"] = filesystem
+            if arrivals is not None:
+                self._parts["arrivals"] = arrivals
+            if operations is not None:
+                # pickled right away, the operations might be run and changed meanwhile
+                self._parts["operations"] = [pickle.dumps(op, pickle.HIGHEST_PROTOCOL) for op in operations]
+            self._dirty = True
+
+    def _encode(self) -> bytes:
+        return pickle.dumps(dict(self._parts, version=self._VERSION), pickle.HIGHEST_PROTOCOL)
+
+    def flush(self):
+        # flushed by the thread and by the system, an older state must not be written last
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                self._dirty = False
+                encoded = self._encode()
+
+            # scans mostly find nothing new, spare the SD card the write
+            digest = hashlib.sha1(encoded).digest()
+            if digest == self._digest:
+                return
+
+            partial = self._path + ".part"
+            with open(partial, "wb") as f:
+                f.write(zlib.compress(encoded))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(partial, self._path)
+            self._digest = digest
+
+    def kill(self):
+        self._should_run = False
+        self._wake.set()
+
+    def run(self):
+        while self._should_run:
+            self._wake.wait(self._interval)
+            try:
+                self.flush()
+            except OSError as e:
+                print("#" * 3, f"Writing snapshot failed: {e}", flush=True)
@@ -0,0 +1,208 @@
+import os
+import json
+import shutil
+import threading
+from time import time, sleep
+from typing import Dict, List, Set
+from utils.scheduling import CancelToken, Cancelled
+from utils.resilience import SourceGone
+
+class Spool():
+    """
+    Staging area for media on the Pi's own storage, outside of the block
+    storage. Files are copied in as `.part` and renamed once synced, and
+    the index is replaced atomically, so a crash at any point leaves
+    either a leftover `.part` file or an entry to adopt on next start.
+
+    Pending files are never evicted, the spool stops accepting instead.
+    Uploaded files are kept as a safety copy until they get too old or
+    their space is needed, least recently used first.
+    """
+    _lock: threading.Lock
+    _root: str
+    _max_bytes: int
+    _max_age: float
+    _index: Dict[str, Dict]
+
+    _INDEX = "index.json"
+    _PENDING = "pending"
+    _UPLOADED = "uploaded"
+
+    def __init__(self, root: str, max_bytes: int, max_age: float) -> None:
+        self._lock = threading.Lock()
+        self._root = str(root)
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._index = {}
+
+        os.makedirs(self._root, exist_ok=True)
+        self._load()
+
+    def _index_file(self) -> str:
+        return os.path.join(self._root, self._INDEX)
+
+    def _load(self):
+        if os.path.isfile(self._index_file()):
+            with open(self._index_file(), "r") as f:
+                self._index = json.load(f)
+
+        files = set(os.listdir(self._root)) - {self._INDEX}
+
+        for name in files:
+            path = os.path.join(self._root, name)
+            if name.endswith(".part") or name.endswith(".tmp"):
+                os.remove(path) # interrupted copy, still in the block storage
+            elif name not in self._index:
+                # synced and renamed, but crashed before the index was saved
+                stat = os.stat(path)
+                self._index[name] = {"game": "", "size": stat.st_size, "added": stat.st_mtime, "used": stat.st_mtime, "state": self._PENDING}
+
+        for name in [n for n in self._index if n not in files]:
+            del self._index[name]
+
+        self._save()
+
+    def _save(self):
+        tmp = self._index_file() + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._index_file())
+
+    def _used_bytes(self) -> int:
+        return sum(e["size"] for e in self._index.values())
+
+    def _evict(self, needed: int=0):
+        uploaded = sorted((e["used"], n) for n, e in self._index.items() if e["state"] == self._UPLOADED)
+        now = time()
+
+        for used, name in uploaded:
+            if now - used < self._max_age and self._used_bytes() + needed <= self._max_bytes:
+                break
+            os.remove(os.path.join(self._root, name))
+            del self._index[name]
+
+    def path(self, name: str) -> str:
+        return os.path.join(self._root, name)
+
+    def contains(self, name: str) -> bool:
+        with self._lock:
+            return name in self._index
+
+    def add(self, source: str, name: str, game: str) -> bool:
+        "Copy source in, returns whether the source is now safe to delete"
+        size = os.stat(source).st_size
+
+        with self._lock:
+            if name in self._index:
+                return self._index[name]["size"] == size
+
+            self._evict(size)
+            if self._used_bytes() + size > self._max_bytes or shutil.disk_usage(self._root).free < size:
+                return False
+
+        partial = self.path(name) + ".part"
+        shutil.copyfile(source, partial)
+        with open(partial, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(partial, self.path(name))
+
+        with self._lock:
+            now = time()
+            self._index[name] = {"game": game, "size": size, "added": now, "used": now, "state": self._PENDING}
+            self._save()
+        return True
+
+    def pending(self) -> List[str]:
+        "Names waiting for upload, oldest first"
+        with self._lock:
+            return sorted((n for n, e in self._index.items() if e["state"] == self._PENDING), key=lambda n: self._index[n]["added"])
+
+    def delivered(self, name: str) -> Set[str]:
+        "Remotes which already have a pending file"
+        with self._lock:
+            return set(self._index[name].get("delivered", ())) if name in self._index else set()
+
+    def mark_delivered(self, name: str, destination: str):
+        "Remember a remote got the file, a restart does not send it there again"
+        with self._lock:
+            if name in self._index:
+                self._index[name]["delivered"] = sorted(set(self._index[name].get("delivered", ())) | {destination})
+                self._save()
+
+    def mark_uploaded(self, name: str):
+        with self._lock:
+            if name in self._index:
+                self._index[name]["state"] = self._UPLOADED
+                self._index[name]["used"] = time()
+                self._evict()
+                self._save()
+
+    def summary(self) -> Dict:
+        with self._lock:
+            pending = [e for e in self._index.values() if e["state"] == self._PENDING]
+            return {
+                "pending": len(pending),
+                "pending_bytes": sum(e["size"] for e in pending),
+                "used_bytes": self._used_bytes(),
+                "max_bytes": self._max_bytes,
+            }
+
+class SpoolUploader(threading.Thread):
+    "Drains the spool to the configured remotes in the background"
+    _should_run: bool
+    _token: CancelToken
+
+    _INTERVAL = 5
+
+    def __init__(self, spool: Spool, state) -> None:
+        self._should_run = True
+        self._spool = spool
+        self._state = state
+        self._token = CancelToken()
+        threading.Thread.__init__(self, name="SpoolUploader")
+
+    def kill(self):
+        self._should_run = False
+        self._token.cancel()
+
+    def run(self):
+        while self._should_run:
+            self._state.write("spool", self._spool.summary())
+            # staged files wait like the ones on the image while uploading automatically is off
+            drivers = self._state.read("drivers") if self._state.options.upload_automatically else None
+
+            for name in self._spool.pending() if drivers else []:
+                if not self._should_run:
+                    break
+
+                source = self._spool.path(name)
+                # remotes which have it already are not sent it again while another one is down
+                delivered = self._spool.delivered(name)
+                try:
+                    for driver in drivers:
+                        if driver.destination not in delivered and driver.upload(source, name, self, self._token):
+                            delivered.add(driver.destination)
+                            self._spool.mark_delivered(name, driver.destination)
+                except Cancelled:
+                    break # shutting down
+                except SourceGone:
+                    continue # pruned from the spool meanwhile
+
+                if all(driver.destination in delivered for driver in drivers):
+                    self._spool.mark_uploaded(name)
+                self._state.write("spool", self._spool.summary())
+
+            sleep(self._INTERVAL)
+
+    # listener interface used by drivers, uploads from spool have no GUI item
+
+    def set_media_size(self, filename: str, size: int):
+        pass
+
+    def set_media_progress(self, filename: str, cur: int):
+        pass
+
+    def set_media_action(self, filename: str, action: str):
+        pass
@@ -2,20 +2,92 @@ import pickle
 from pathlib import Path
 from threading import Lock
 from copy import deepcopy
-from typing import Dict, List, Type
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Type
+from utils.trace import TRACER
+from utils.lun import Lun
+from utils.scheduling import CancelToken, Priority
 
 class OperationBase():
+    # operations which only read can run against the read-only
+    # mount in USB mode, without disconnecting the console
+    requires_manage = True
+
+    # role of the LUN the operation works on, only that one is taken offline
+    lun = Lun.SAVES
+
+    # operations deleting data, after which freed space is handed back
+    frees_space = False
+
+    priority = Priority.NORMAL
+
+    # kept in the snapshot across restarts, the others are rebuilt by the first scan
+    persistent = False
+
+    @property
+    def ready(self) -> bool:
+        "False while the operation waits on something outside, like a remote to recover"
+        return True
+
+    def __init__(self) -> None:
+        self._token = CancelToken()
+
+    @property
+    def token(self) -> CancelToken:
+        return self._token
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["_token"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._token = CancelToken()
+
+    @property
+    def touched_slots(self) -> List[str]:
+        "Slots whose save data was changed by running, backed up afterwards"
+        return []
+
+    def renumber_slot(self, slot_id: str) -> str:
+        "Id of the slot after running, None if it is gone"
+        return slot_id
+
+    # attributes shared instead of deep copied, like remi GUI objects
+    _shared_fields = ()
+
     @property
     def overview(self) -> str:
         return "No operation overview..."
 
-    def run(self, mount_point: str):
+    def run(self, mount_point: str) -> List["OperationBase"]:
+        """
+        Returns follow-up operations to run in the same batch, like
+        deleting files which were just uploaded. Returning None is fine.
+        """
         assert False, "Operation not defined"
 
+    def merge(self, queued: "OperationBase") -> "OperationBase":
+        "Combine with the queued operation of the same type, replacing it by default"
+        return self
+
+    # State deep copies operations for its listeners
+    def __deepcopy__(self, memo):
+        cls = self.__class__
+        result = cls.__new__(cls)
+        memo[id(self)] = result
+        for k, v in self.__dict__.items():
+            # copies share the token, so cancelling a copy cancels the original
+            setattr(result, k, v if k in self._shared_fields or k == "_token" else deepcopy(v, memo))
+        return result
+
 class Options():
     _file: Path
     _remotes: List[Dict]
     _upload_automatically: bool
+    _upload_limit: int
+    _backup_slots: bool
 
     _FILE = "psberry_options.pickle"
 
@@ -23,6 +95,8 @@ class Options():
         self._file = Path(root) / self._FILE
         self._remotes = []
         self._upload_automatically = True
+        self._upload_limit = 0
+        self._backup_slots = True
 
         if not Path(self._file).is_file():
             return
@@ -36,8 +110,14 @@ class Options():
             if len(data) > 1:
                 self._upload_automatically = data[1]
 
+                if len(data) > 2:
+                    self._upload_limit = data[2]
+
+                    if len(data) > 3:
+                        self._backup_slots = data[3]
+
     def _dump(self):
-        data = [self._remotes, self._upload_automatically]
+        data = [self._remotes, self._upload_automatically, self._upload_limit, self._backup_slots]
         with open(self._file, "wb") as f:
             pickle.dump(data, f)
 
@@ -59,16 +139,40 @@ class Options():
         self._upload_automatically = value
         self._dump()
 
+    @property
+    def upload_limit(self) -> int:
+        "Global upload limit in KiB/s shared by all remotes, 0 for unlimited"
+        return self._upload_limit
+
+    @upload_limit.setter
+    def upload_limit(self, value: int):
+        self._upload_limit = value
+        self._dump()
+
+    @property
+    def backup_slots(self) -> bool:
+        "Back up changed save slots to the remotes"
+        return self._backup_slots
+
+    @backup_slots.setter
+    def backup_slots(self, value: bool):
+        self._backup_slots = value
+        self._dump()
+
 class State():
     def __init__(self, root: str) -> None:
         self._lock = Lock()
         self._data = {"operations": {}, "filesystem": {"slots": {}, "active_slot": "", "media": {}}, "drivers": []}
+        self._running = {}
+        # bumped on every change, so clients can tell whether they are up to date
+        self._versions = {}
         self._listeners = {}
         self._options = Options(root)
 
     def _call_listeners(self, field: str, value):
         for callback in self._listeners.get(field, []):
-            callback(value)
+            with TRACER.span(getattr(callback, "__qualname__", "listener"), "listener", field=field):
+                callback(value)
 
     def read(self, field):
         with self._lock:
@@ -80,10 +184,19 @@ class State():
                 return False
 
             self._data[field] = value
+            self._bump(field)
 
         self._call_listeners(field, value)
         return True
 
+    def _bump(self, field: str):
+        self._versions[field] = self._versions.get(field, 0) + 1
+
+    def version(self, field: str) -> int:
+        "Number of changes of the field so far"
+        with self._lock:
+            return self._versions.get(field, 0)
+
     def register(self, field: str, callback):
         with self._lock:
             if field not in self._listeners:
@@ -94,28 +207,121 @@ class State():
         with self._lock:
             assert "operations" in self._data
 
-            self._data["operations"][type(op).__name__] = op
+            queued = self._data["operations"].get(type(op).__name__)
+            self._data["operations"][type(op).__name__] = op if queued is None else op.merge(queued)
+            self._bump("operations")
             data = deepcopy(self._data["operations"])
 
         self._call_listeners("operations", data)
 
-    def cancel_operation(self, op_type: Type[OperationBase]):
+    def update_operation(self, op_type: Type[OperationBase], update: Callable[[OperationBase], OperationBase]):
+        "Replace the queued operation of the type by what `update` makes of it, None drops it, itself keeps it"
         with self._lock:
             assert "operations" in self._data
 
-            self._data["operations"].pop(op_type.__name__, None)
+            queued = self._data["operations"].get(op_type.__name__)
+            if queued is None:
+                return
+
+            updated = update(queued)
+            if updated is queued:
+                return
+            if updated is None:
+                del self._data["operations"][op_type.__name__]
+            else:
+                self._data["operations"][op_type.__name__] = updated
+            self._bump("operations")
             data = deepcopy(self._data["operations"])
 
         self._call_listeners("operations", data)
 
-    def pop_operations(self) -> Dict[str, OperationBase]:
+    def cancel_operation(self, op_type: Type[OperationBase], key: str=None):
+        """
+        Cancel the queued and the running operation of the type, or
+        with `key` only a single item of theirs, like one media file.
+        """
+        with self._lock:
+            assert "operations" in self._data
+
+            ops = [self._data["operations"].get(op_type.__name__), self._running.get(op_type.__name__)]
+            # a single item is only cancelled, the operation stays queued
+            removed = key is None and self._data["operations"].pop(op_type.__name__, None) is not None
+            if removed:
+                self._bump("operations")
+                data = deepcopy(self._data["operations"])
+
+        for op in ops:
+            if op is not None:
+                op.token.cancel(key)
+
+        if removed:
+            self._call_listeners("operations", data)
+
+    @contextmanager
+    def running(self, op: OperationBase):
+        "Keep track of the operation while it runs, so it can be cancelled"
+        with self._lock:
+            self._running[type(op).__name__] = op
+        try:
+            yield op
+        finally:
+            with self._lock:
+                if self._running.get(type(op).__name__) is op:
+                    del self._running[type(op).__name__]
+
+    def running_operation(self, op_type: Type[OperationBase]) -> OperationBase:
+        "Operation of the type running right now, None if there is none"
+        with self._lock:
+            return self._running.get(op_type.__name__)
+
+    def waiting_priority(self, roles: List[str]) -> Priority:
+        "Most important queued manage mode operation for the LUN roles, None if there is none"
+        with self._lock:
+            waiting = [op.priority for op in self._data["operations"].values() if op.requires_manage and op.lun in roles]
+        return min(waiting) if waiting else None
+
+    def pop_operation(self, requires_manage: bool, roles: List[str]) -> OperationBase:
+        "Pop the most important operation matching, None if there is none"
+        with self._lock:
+            assert "operations" in self._data
+
+            candidates = [(op.priority, name) for name, op in self._data["operations"].items() if op.requires_manage == requires_manage and op.lun in roles and op.ready]
+            if not candidates:
+                return None
+
+            op = self._data["operations"].pop(min(candidates)[1])
+            self._bump("operations")
+            data = deepcopy(self._data["operations"])
+
+        self._call_listeners("operations", data)
+        return op
+
+    def pop_operations(self, requires_manage: bool=None, roles: List[str]=None) -> Dict[str, OperationBase]:
+        "Pop all operations, or only those which do or do not require manage mode, or work on one of the LUN roles"
         with self._lock:
             assert "operations" in self._data
 
             ops = self._data.pop("operations")
             self._data["operations"] = {} # add it right back
 
-        self._call_listeners("operations", {})
+            if requires_manage is not None:
+                for name, op in list(ops.items()):
+                    if op.requires_manage != requires_manage:
+                        self._data["operations"][name] = ops.pop(name)
+
+            if roles is not None:
+                for name, op in list(ops.items()):
+                    if op.lun not in roles:
+                        self._data["operations"][name] = ops.pop(name)
+
+            if not ops:
+                # polled while lingering in manage mode, nothing changed
+                return ops
+
+            self._bump("operations")
+            data = deepcopy(self._data["operations"])
+
+        self._call_listeners("operations", data)
         return ops
 
     @property
@@ -0,0 +1,110 @@
+import threading
+from time import monotonic, sleep
+
+class TokenBucket():
+    "Blocking token bucket limiting throughput to `rate` bytes per second, 0 meaning unlimited"
+    _lock: threading.Lock
+    _rate: int
+    _burst: int
+    _tokens: float
+    _last: float
+
+    def __init__(self, rate: int=0, burst: int=0) -> None:
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._last = monotonic()
+        self.set_rate(rate, burst)
+
+    @property
+    def rate(self) -> int:
+        return self._rate
+
+    def set_rate(self, rate: int, burst: int=0):
+        with self._lock:
+            self._rate = max(int(rate), 0)
+            # by default allow a quarter of a second worth of bytes at once
+            self._burst = max(int(burst), self._rate // 4, 1)
+            self._tokens = min(self._tokens, self._burst)
+
+    def consume(self, amount: int):
+        while amount > 0:
+            with self._lock:
+                if self._rate == 0:
+                    return
+
+                now = monotonic()
+                self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+                self._last = now
+
+                # take whatever is available, chunks bigger than burst are paid in parts
+                taken = min(amount, self._burst)
+                if self._tokens >= taken:
+                    self._tokens -= taken
+                    amount -= taken
+                    continue
+
+                wait = (taken - self._tokens) / self._rate
+
+            sleep(wait)
+
+class UiActivity():
+    "Tracks web UI requests in flight, so background work can back off while they are served"
+    _lock: threading.Lock
+    _in_flight: int
+    _last: float
+    _linger: float
+
+    def __init__(self, linger: float=.5) -> None:
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._last = 0.0
+        self._linger = linger
+
+    def __enter__(self):
+        with self._lock:
+            self._in_flight += 1
+        return self
+
+    def __exit__(self, type, value, traceback):
+        with self._lock:
+            self._in_flight -= 1
+            self._last = monotonic()
+
+    def is_busy(self) -> bool:
+        with self._lock:
+            return self._in_flight > 0 or monotonic() - self._last < self._linger
+
+    def wait_until_idle(self, timeout: float=2.0, step: float=.05):
+        "Yield while the UI is busy, but never starve the caller for longer than `timeout`"
+        deadline = monotonic() + timeout
+        while self.is_busy() and monotonic() < deadline:
+            sleep(step)
+
+# shared by all drivers, configured from Options and the remi app
+upload_limit = TokenBucket()
+ui_activity = UiActivity()
+
+_remote_limits = {}
+_remote_limits_lock = threading.Lock()
+
+def remote_limit(remote: str, rate: int) -> TokenBucket:
+    """
+    Bucket of a single remote. Drivers get deep copied through State,
+    so the bucket is looked up by destination instead of being owned.
+    """
+    with _remote_limits_lock:
+        bucket = _remote_limits.get(remote)
+        if bucket is None:
+            bucket = _remote_limits[remote] = TokenBucket(rate)
+            return bucket
+
+    if bucket.rate != rate:
+        bucket.set_rate(rate)
+    return bucket
+
+def kib_to_rate(value) -> int:
+    "Convert a KiB/s value coming from UI or config into bytes per second, 0 on invalid input"
+    try:
+        return max(int(float(value) * 1024), 0)
+    except (TypeError, ValueError):
+        return 0
@@ -0,0 +1,124 @@
+import os
+import json
+import threading
+from time import perf_counter_ns
+from functools import wraps
+from typing import Dict
+
+class _Span():
+    def __init__(self, tracer: "Tracer", name: str, cat: str, args: Dict) -> None:
+        self._tracer = tracer
+        self._name = name
+        self._cat = cat
+        self._args = args
+
+    def __enter__(self):
+        self._start = perf_counter_ns()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._tracer.complete(self._name, self._cat, self._start, perf_counter_ns() - self._start, self._args)
+
+class _NoSpan():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+_NO_SPAN = _NoSpan()
+
+class Tracer():
+    """
+    Records spans in the Chrome trace-event JSON array format, which
+    Perfetto and chrome://tracing open directly. When the file grows
+    past the size cap it is moved to `<file>.1`, replacing the older one.
+    """
+    _lock: threading.Lock
+    _path: str
+    _max_bytes: int
+    _file = None
+    _written: int
+    _named_threads: set
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self._file is not None
+
+    def open(self, path: str, max_bytes: int):
+        with self._lock:
+            self._path = str(path)
+            self._max_bytes = max_bytes
+            self._start_file()
+
+    def close(self):
+        with self._lock:
+            self._end_file()
+
+    def _start_file(self):
+        self._file = open(self._path, "w")
+        self._file.write("[")
+        self._written = 1
+        self._named_threads = set()
+
+    def _end_file(self):
+        if self._file is not None:
+            self._file.write("\n]\n")
+            self._file.close()
+            self._file = None
+
+    def _write(self, event: Dict):
+        # a crashed process leaves the array unterminated, which trace viewers accept
+        line = ("\n" if self._written == 1 else ",\n") + json.dumps(event, separators=(",", ":"))
+        self._file.write(line)
+        self._written += len(line)
+
+    def complete(self, name: str, cat: str, start_ns: int, duration_ns: int, args: Dict=None):
+        "Record a span which already happened"
+        if self._file is None:
+            return
+
+        thread = threading.current_thread()
+        with self._lock:
+            if self._file is None:
+                return
+
+            if self._written > self._max_bytes:
+                self._end_file()
+                os.replace(self._path, self._path + ".1")
+                self._start_file()
+
+            if thread.ident not in self._named_threads:
+                self._named_threads.add(thread.ident)
+                self._write({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": thread.ident, "args": {"name": thread.name}})
+
+            self._write({
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "ts": start_ns / 1000,
+                "dur": duration_ns / 1000,
+                "pid": os.getpid(),
+                "tid": thread.ident,
+                "args": args or {},
+            })
+            self._file.flush()
+
+    def span(self, name: str, cat: str="psberry", **args):
+        "Record the `with` block as a span, does nothing when tracing is off"
+        return _Span(self, name, cat, args) if self._file is not None else _NO_SPAN
+
+TRACER = Tracer()
+
+def traced(name: str, cat: str="psberry"):
+    "Record every call of the decorated function as a span"
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with TRACER.span(name, cat):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
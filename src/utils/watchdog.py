@@ -1,13 +1,22 @@
 import threading
 from time import sleep
+from utils.metrics import REGISTRY
+from utils.trace import TRACER
+from utils.activity import IoActivity
+
+_CYCLE = REGISTRY.histogram("psberry_watchdog_cycle_seconds", "Duration of a watchdog cycle, excluding sleep.")
 
 class Watchdog(threading.Thread):
     _should_run: bool
     _idle_threshold: int
+    _activity: IoActivity
+    _quiet_period: float
 
-    def __init__(self, update_filesystem, update_idle, handle_operations):
+    def __init__(self, update_filesystem, update_idle, handle_operations, activity: IoActivity=None, quiet_period: float=3):
         self._should_run = True
         self._idle_threshold = 2
+        self._activity = activity
+        self._quiet_period = quiet_period
         self._update_filesystem = update_filesystem
         self._update_idle = update_idle
         self._handle_operations = handle_operations
@@ -16,19 +25,26 @@ class Watchdog(threading.Thread):
     def kill(self):
         self._should_run = False
 
+    def _is_idle(self, fs_idle: int) -> bool:
+        if self._activity is None or self._activity.failed:
+            # no block counters, filesystem has to look unchanged for multiple scans
+            return fs_idle >= self._idle_threshold
+        return self._activity.quiet_for() >= self._quiet_period
+
     def run(self):
         cycle = 0
         fs_idle = 0
         while self._should_run:
-            if cycle % 2 == 0:
-                # if filesystem changed, reset the idle counter state
-                fs_idle = 0 if self._update_filesystem() else fs_idle + 1
-                self._update_idle(fs_idle < self._idle_threshold)
-
-            if fs_idle >= self._idle_threshold:
-                # filesystem was idle for multiple cycles, should be safe to handle ops
-                fs_idle = 0 if self._handle_operations() else fs_idle
-                self._update_idle(fs_idle < self._idle_threshold)
+            with _CYCLE.time(), TRACER.span("watchdog_cycle", "watchdog", cycle=cycle):
+                if cycle % 2 == 0:
+                    # if filesystem changed, reset the idle counter state
+                    fs_idle = 0 if self._update_filesystem() else fs_idle + 1
+                    self._update_idle(not self._is_idle(fs_idle))
+
+                if self._is_idle(fs_idle):
+                    # storage was idle long enough, should be safe to handle ops
+                    fs_idle = 0 if self._handle_operations() else fs_idle
+                    self._update_idle(not self._is_idle(fs_idle))
 
             cycle = cycle + 1
             sleep(1)
\ No newline at end of file
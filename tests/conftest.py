@@ -0,0 +1,33 @@
+import os
+import pytest
+
+from helper import HelperError, HelperMock
+from utils.state import State
+
+class BusyHelper(HelperMock):
+    "Refuses to detach backing files, like the kernel while the console holds the medium locked"
+    def write(self, path: str, value: str):
+        if os.path.basename(path) == "file" and value == "":
+            self._call("write", path=path, value=value)
+            raise HelperError(f"[Errno 16] Device or resource busy: '{path}'")
+        super().write(path, value)
+
+@pytest.fixture
+def helper() -> HelperMock:
+    return HelperMock(delay=0)
+
+@pytest.fixture
+def busy_helper() -> HelperMock:
+    return BusyHelper(delay=0)
+
+@pytest.fixture
+def make_system(tmp_path):
+    "System of a backend on an image in tmp_path, with a UDC to bind to"
+    def make(cls, helper: HelperMock, **kwargs):
+        (tmp_path / "udc" / "fe980000.usb").mkdir(parents=True, exist_ok=True)
+        (tmp_path / "mount").mkdir(exist_ok=True)
+        block = tmp_path / "storage.bin"
+        block.write_bytes(b"")
+
+        return cls(State(str(tmp_path)), str(block), str(tmp_path / "mount"), 8080, "font.ttf", helper=helper, udc_class=str(tmp_path / "udc"), **kwargs)
+    return make
@@ -0,0 +1,50 @@
+import os
+import pytest
+
+from helper import HelperMock
+from system import ModeSwitchError, SystemConfigfs
+from utils.mode import Mode
+
+@pytest.fixture
+def make_gadget(make_system, tmp_path):
+    def make(helper: HelperMock) -> SystemConfigfs:
+        system = make_system(SystemConfigfs, helper, configfs=str(tmp_path / "configfs"))
+        system._setup_gadget()
+        system._set_mode(Mode.USB)
+        return system
+    return make
+
+def _lun_file(system: SystemConfigfs) -> str:
+    with open(os.path.join(system._lun_dir(system._luns[0]), "file")) as f:
+        return f.read()
+
+def test_setup_gadget_binds_udc(make_gadget, helper, tmp_path):
+    system = make_gadget(helper)
+
+    with open(tmp_path / "configfs" / "usb_gadget" / "psberry" / "UDC") as f:
+        assert f.read() == "fe980000.usb"
+    assert _lun_file(system) == str(tmp_path / "storage.bin")
+
+def test_manage_detaches_backing_file(make_gadget, helper):
+    system = make_gadget(helper)
+    lun = system._luns[0]
+
+    system._set_mode(Mode.MANAGE, lun)
+
+    assert lun.mode == Mode.MANAGE
+    assert _lun_file(system) == ""
+    assert helper.calls[-1] == ("mount", {"source": lun.block_storage, "target": lun.mount_point, "readonly": False, "options": ""})
+
+def test_locked_medium_stays_in_usb_mode(make_gadget, busy_helper, tmp_path):
+    system = make_gadget(busy_helper)
+    lun = system._luns[0]
+
+    with pytest.raises(ModeSwitchError):
+        system._set_mode(Mode.MANAGE, lun)
+
+    assert lun.mode == Mode.USB
+    assert _lun_file(system) == str(tmp_path / "storage.bin")
+    # never mounted read-write while the console has the image
+    mounts = [args for cmd, args in busy_helper.calls if cmd == "mount"]
+    assert all(args["readonly"] for args in mounts)
+    assert busy_helper.calls[-1][0] == "mount"
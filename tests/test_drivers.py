@@ -0,0 +1,120 @@
+import os
+import threading
+import http.server
+import pytest
+
+from drivers import DriverHTTP, DriverLocal
+from operations import NullListener
+
+_REAL_COPY_FILE_RANGE = getattr(os, "copy_file_range", None)
+
+@pytest.fixture
+def source(tmp_path):
+    # not a multiple of the chunk size, the last copy comes up short
+    path = tmp_path / "clip.mp4"
+    path.write_bytes(os.urandom(3 * 64 * 1024 + 123))
+    return path
+
+@pytest.fixture
+def local(tmp_path):
+    folder = tmp_path / "remote"
+    folder.mkdir()
+    driver = DriverLocal({"folder": str(folder)})
+    driver._chunk_size = 64 * 1024
+    return driver
+
+def test_local_copy_file_range(local, source, tmp_path, monkeypatch):
+    if _REAL_COPY_FILE_RANGE is None:
+        pytest.skip("no copy_file_range on this platform")
+    monkeypatch.delattr(os, "sendfile")
+    monkeypatch.delattr(os, "pwrite")
+
+    assert local.upload(str(source), "clip.mp4", NullListener())
+    assert (tmp_path / "remote" / "clip.mp4").read_bytes() == source.read_bytes()
+
+def test_local_sendfile(local, source, tmp_path, monkeypatch):
+    monkeypatch.delattr(os, "copy_file_range", raising=False)
+    monkeypatch.delattr(os, "pwrite")
+
+    assert local.upload(str(source), "clip.mp4", NullListener())
+    assert (tmp_path / "remote" / "clip.mp4").read_bytes() == source.read_bytes()
+
+def test_local_userspace_copy(local, source, tmp_path, monkeypatch):
+    monkeypatch.delattr(os, "copy_file_range", raising=False)
+    monkeypatch.delattr(os, "sendfile")
+
+    assert local.upload(str(source), "clip.mp4", NullListener())
+    assert (tmp_path / "remote" / "clip.mp4").read_bytes() == source.read_bytes()
+
+def test_local_falls_back_after_copy_file_range(local, source, tmp_path, monkeypatch):
+    if _REAL_COPY_FILE_RANGE is None:
+        pytest.skip("no copy_file_range on this platform")
+
+    def copy_first_chunk(src, dst, count, offset_src, offset_dst):
+        # like a filesystem refusing in the middle, the file position was never moved
+        if offset_src:
+            raise OSError(18, "Invalid cross-device link")
+        return _REAL_COPY_FILE_RANGE(src, dst, count, offset_src, offset_dst)
+
+    monkeypatch.setattr(os, "copy_file_range", copy_first_chunk)
+    monkeypatch.delattr(os, "sendfile")
+
+    assert local.upload(str(source), "clip.mp4", NullListener())
+    assert (tmp_path / "remote" / "clip.mp4").read_bytes() == source.read_bytes()
+
+class _PutHandler(http.server.BaseHTTPRequestHandler):
+    "Keeps PUT bodies in memory, sent chunked like the driver does"
+    files = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_PUT(self):
+        body = b""
+        while size := int(self.rfile.readline().split(b";")[0], 16):
+            body += self.rfile.read(size)
+            self.rfile.readline()
+        self.rfile.readline()
+
+        self.files[self.path] = body
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_HEAD(self):
+        if self.path.endswith("/"):
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+        elif self.path in self.files:
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(self.files[self.path])))
+        else:
+            self.send_response(404)
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path not in self.files:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.files[self.path])))
+        self.end_headers()
+        self.wfile.write(self.files[self.path])
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _PutHandler)
+    _PutHandler.files = {}
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_http_upload(server, source):
+    driver = DriverHTTP({"url": f"http://127.0.0.1:{server.server_port}/clips"})
+
+    assert driver.upload(str(source), "clip.mp4", NullListener())
+    assert _PutHandler.files["/clips/clip.mp4"] == source.read_bytes()
+    assert driver.download("clip.mp4") == source.read_bytes()
@@ -0,0 +1,59 @@
+import pytest
+
+from helper import HelperMock
+from system import ModeSwitchError, System
+from utils.mode import Mode
+
+@pytest.fixture
+def lun_dir(tmp_path):
+    # g_mass_storage puts its LUNs below the gadget of the UDC it is bound to
+    return tmp_path / "udc" / "fe980000.usb" / "device" / "gadget.0" / "lun0"
+
+@pytest.fixture
+def make_loaded(make_system, lun_dir, tmp_path):
+    def make(helper: HelperMock, loaded: bool=True) -> System:
+        if loaded:
+            lun_dir.mkdir(parents=True)
+            (lun_dir / "file").write_text(str(tmp_path / "storage.bin"))
+
+        system = make_system(System, helper)
+        system._luns[0].mode = Mode.USB
+        return system
+    return make
+
+def test_manage_detaches_only_the_lun(make_loaded, helper, lun_dir, tmp_path):
+    system = make_loaded(helper)
+    lun = system._luns[0]
+
+    system._set_mode(Mode.MANAGE, lun)
+
+    assert lun.mode == Mode.MANAGE
+    assert (lun_dir / "file").read_text() == ""
+    # the module is left alone, other LUNs do not see the device go away
+    assert not [cmd for cmd, _ in helper.calls if cmd in ("modprobe", "rmmod")]
+
+    system._set_mode(Mode.USB, lun)
+
+    assert (lun_dir / "file").read_text() == str(tmp_path / "storage.bin")
+    assert not [cmd for cmd, _ in helper.calls if cmd in ("modprobe", "rmmod")]
+
+def test_module_loaded_when_lun_is_missing(make_loaded, helper, tmp_path):
+    system = make_loaded(helper, loaded=False)
+    lun = system._luns[0]
+    lun.mode = Mode.MANAGE
+
+    system._set_mode(Mode.USB, lun)
+
+    modprobes = [args for cmd, args in helper.calls if cmd == "modprobe"]
+    assert modprobes == [{"module": "g_mass_storage", "params": [f"file={tmp_path / 'storage.bin'}", "removable=1", "ro=0", "stall=0"]}]
+
+def test_locked_medium_stays_in_usb_mode(make_loaded, busy_helper, lun_dir, tmp_path):
+    system = make_loaded(busy_helper)
+    lun = system._luns[0]
+
+    with pytest.raises(ModeSwitchError):
+        system._set_mode(Mode.MANAGE, lun)
+
+    assert lun.mode == Mode.USB
+    assert (lun_dir / "file").read_text() == str(tmp_path / "storage.bin")
+    assert all(args["readonly"] for cmd, args in busy_helper.calls if cmd == "mount")